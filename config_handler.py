@@ -0,0 +1,107 @@
+"""
+This module handles:
+    - loading the configuration file once and sharing it with all of the modules
+    - reloading the configuration file when it changes (by polling its modification time)
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import json
+import os
+import threading
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+class Config:
+    """
+    This class holds the parsed configuration file
+    A reload parses the whole file before swapping it in, so readers never see half a config
+    """
+
+    def __init__(self, filename = 'config.json', poll_interval = 2.0):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.values = {}
+        self.mtime = None
+        self.watcher = None
+        self.stop_watching = threading.Event()
+        self.load()
+
+    def load(self):
+        """
+        Reads and parses the configuration file
+        """
+        mtime = os.stat(self.filename).st_mtime_ns
+        with open(self.filename) as f:
+            values = json.load(f)
+
+        self.values = values
+        self.mtime = mtime
+        log.info("Loaded configuration file " + self.filename)
+
+    def get(self):
+        """
+        Returns the current configuration dictionary (which must not be changed)
+        """
+        return self.values
+
+    def reload_if_changed(self):
+        """
+        Reloads the configuration file if its modification time has changed
+        If the new file cannot be read, the previous configuration is kept
+        Returns True if the configuration was reloaded
+        """
+        try:
+            if os.stat(self.filename).st_mtime_ns == self.mtime:
+                return False
+            self.load()
+            return True
+        except (OSError, ValueError):
+            log.exception("Keeping previous configuration, could not reload " + self.filename)
+            return False
+
+    def watch(self):
+        """
+        Polls the configuration file every poll_interval seconds until stopped
+        """
+        while not self.stop_watching.wait(self.poll_interval):
+            self.reload_if_changed()
+
+    def start_watching(self):
+        """
+        Starts polling the configuration file in a background thread (only once)
+        """
+        if self.watcher is None:
+            self.watcher = threading.Thread(target = self.watch, name = "config-watcher", \
+                                            daemon = True)
+            self.watcher.start()
+
+#configuration shared by all of the modules, loaded at startup
+config = Config()
+
+def get_config():
+    """
+    Returns the current configuration dictionary
+    """
+    return config.get()
+
+def start_config_watcher():
+    """
+    Starts reloading the configuration file when it changes
+    """
+    config.start_watching()
+
+def locations():
+    """
+    This function extracts data from the configuration file to set up
+        the national_location and location variable
+    This will help set up the locations for data to be pulled from the API
+    """
+    config_dict = config.get()
+    nation_location = config_dict["nation_location"]
+    location = config_dict["location"]
+
+    return nation_location, location
@@ -0,0 +1,196 @@
+"""
+This module handles:
+    - rolling N-day sums and means over a covid time series
+    - week-over-week change, rates per 100,000 people and peak detection
+Every metric is laid out as one value per calendar day (oldest first) with prefix sums,
+    so once the series is loaded any window is worked out in constant time
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import threading
+import weakref
+import numpy as np
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#Metrics that can be aggregated and the CovidTimeSeries columns holding them
+#(deaths are cumulative, so their rolling sums are rarely useful, the means and peaks are)
+METRICS = {"new_cases": ("new_cases", "new_cases_mask"), \
+           "hospital_cases": ("hospital_cases", "hospital_cases_mask"), \
+           "deaths": ("deaths", "deaths_mask")}
+
+class RollingAggregates:
+    """
+    This class holds the prefix sums of every metric of one CovidTimeSeries
+    Days are numbered from the oldest date (day 0) to the newest (day len - 1),
+        days missing from the series count as days without a value
+    A window of days ending on day end covers days end - days + 1 to end
+    """
+
+    def __init__(self, time_series):
+        self.area_name = time_series.area_name
+        self.area_type = time_series.area_type
+        self.sums = {}
+        self.counts = {}
+
+        if len(time_series) == 0:
+            self.first_date = None
+            self.days_count = 0
+            return
+
+        self.first_date = time_series.dates.min()
+        self.days_count = int((time_series.dates.max() - self.first_date).astype(np.int64)) + 1
+        day_index = (time_series.dates - self.first_date).astype(np.int64)
+
+        for metric, (values_column, mask_column) in METRICS.items():
+            mask = getattr(time_series, mask_column)
+            values = np.zeros(self.days_count, dtype = np.int64)
+            present = np.zeros(self.days_count, dtype = np.int64)
+            values[day_index[mask]] = getattr(time_series, values_column)[mask]
+            present[day_index[mask]] = 1
+            #a leading 0 so the sum of days [start, end] is sums[end + 1] - sums[start]
+            self.sums[metric] = np.concatenate(([0], np.cumsum(values)))
+            self.counts[metric] = np.concatenate(([0], np.cumsum(present)))
+
+    def __len__(self):
+        return self.days_count
+
+    def day(self, date):
+        """
+        Returns the day number of a date (a string or numpy datetime64)
+        """
+        return int((np.datetime64(date, "D") - self.first_date).astype(np.int64))
+
+    def date(self, day):
+        """
+        Returns the date (YYYY-MM-DD) of a day number
+        """
+        return str(self.first_date + np.timedelta64(day, "D"))
+
+    def window(self, metric, days, end = None):
+        """
+        Returns (sum, number of values present) for the window of days ending on day end
+            (the newest day if end is None), cut short at the oldest day
+        """
+        prefix_sums = self.metric_sums(metric)
+        end = self.days_count - 1 if end is None else end
+        if days < 1 or end < 0 or end >= self.days_count:
+            raise ValueError("Window of {} days ending on day {} is outside the series".format( \
+                days, end))
+        start = max(0, end - days + 1)
+
+        return int(prefix_sums[end + 1] - prefix_sums[start]), \
+            int(self.counts[metric][end + 1] - self.counts[metric][start])
+
+    def rolling_sum(self, metric, days, end = None):
+        """
+        Returns the sum of a metric over the window of days ending on day end
+        """
+        return self.window(metric, days, end)[0]
+
+    def rolling_mean(self, metric, days, end = None):
+        """
+        Returns the mean of the values present in the window, or None if there are none
+        """
+        total, present = self.window(metric, days, end)
+
+        return None if present == 0 else total / present
+
+    def week_over_week(self, metric, end = None):
+        """
+        Returns the change of the 7 day sum ending on day end compared with the 7 days before,
+            as a fraction (0.25 is 25% up), or None if there is no previous week
+        """
+        end = self.days_count - 1 if end is None else end
+        if end - 7 < 0:
+            return None
+        previous = self.rolling_sum(metric, 7, end - 7)
+        if previous == 0:
+            return None
+
+        return (self.rolling_sum(metric, 7, end) - previous) / previous
+
+    def per_100k(self, metric, days, population, end = None):
+        """
+        Returns the sum of a metric over the window as a rate per 100,000 people
+        """
+        return self.rolling_sum(metric, days, end) * 100_000 / population
+
+    def rolling_sums(self, metric, days):
+        """
+        Returns the sum of every window of days as an array, one per day (oldest first)
+        """
+        prefix_sums = self.metric_sums(metric)
+        ends = np.arange(1, self.days_count + 1)
+
+        return prefix_sums[ends] - prefix_sums[np.maximum(0, ends - days)]
+
+    def peaks(self, metric, days = 7, min_distance = 14, count = 3):
+        """
+        Returns up to count peaks of the rolling sum, largest first, as (date, value)
+        A peak is the largest rolling sum within min_distance days either side of it
+        """
+        rolling = self.rolling_sums(metric, days)
+        if rolling.size == 0:
+            return []
+
+        padded = np.pad(rolling, min_distance, constant_values = -1)
+        windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * min_distance + 1)
+        candidates = np.flatnonzero((rolling == windows.max(axis = 1)) & (rolling > 0))
+        #keep the first day of a flat top, so a plateau counts once
+        candidates = candidates[np.concatenate(([True], np.diff(candidates) > min_distance))]
+        largest = candidates[np.argsort(-rolling[candidates], kind = "stable")][:count]
+
+        return [(self.date(int(day)), int(rolling[day])) for day in largest]
+
+    def metric_sums(self, metric):
+        """
+        Returns the prefix sums of a metric, raising ValueError for an unknown metric
+        """
+        if metric not in METRICS:
+            raise ValueError("Unknown metric " + str(metric))
+        if self.days_count == 0:
+            raise ValueError("There is no data for " + str(self.area_name))
+
+        return self.sums[metric]
+
+    def report(self, metric, days = 7, population = None):
+        """
+        Returns the aggregates of a metric for the newest window in a dictionary
+        Raises ValueError for an unknown metric or a series with no data
+        """
+        self.metric_sums(metric)
+        report = {"area_name": self.area_name, "area_type": self.area_type, \
+                  "metric": metric, "days": days, \
+                  "latest_date": self.date(self.days_count - 1), \
+                  "rolling_sum": self.rolling_sum(metric, days), \
+                  "rolling_mean": self.rolling_mean(metric, days), \
+                  "week_over_week": self.week_over_week(metric), \
+                  "peaks": [{"date": date, "value": value} \
+                            for date, value in self.peaks(metric, days)]}
+        if population:
+            report["per_100k"] = self.per_100k(metric, days, population)
+
+        return report
+
+#Aggregates already built, kept while their time series is in use
+built_aggregates = weakref.WeakKeyDictionary()
+built_aggregates_lock = threading.Lock()
+
+def get_aggregates(time_series):
+    """
+    Returns the RollingAggregates of a time series, building them the first time
+    """
+    with built_aggregates_lock:
+        aggregates = built_aggregates.get(time_series)
+    if aggregates is None:
+        aggregates = RollingAggregates(time_series)
+        with built_aggregates_lock:
+            built_aggregates[time_series] = aggregates
+        log.info("Built rolling aggregates for " + time_series.area_name)
+
+    return aggregates
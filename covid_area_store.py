@@ -0,0 +1,128 @@
+"""
+This module handles:
+    - storing the covid data for many areas (the multi-area dashboard)
+    - looking up the figures for any subset of areas without calling the API
+    - merging newer rows into the stored time series (incremental updates)
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import threading
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+class CovidAreaStore:
+    """
+    This class keeps the CovidTimeSeries and the dashboard figures for each area, keyed by area name
+    Areas that are not in an update keep their previous data
+    It also keeps when each area last had its full history fetched (refreshed_at)
+        and when it was last fetched at all, full history or newest dates (fetched_at)
+    """
+
+    def __init__(self):
+        self.time_series = {}
+        self.summaries = {}
+        self.full_refresh_times = {}
+        self.fetch_times = {}
+        self.lock = threading.Lock()
+
+    def update(self, time_series_by_area, refreshed_at = None):
+        """
+        Stores new time series (a dictionary of area name to CovidTimeSeries)
+        refreshed_at is the time the full history of these areas was fetched, if it was
+        """
+        summaries = {area_name: area_summary(time_series) \
+                     for area_name, time_series in time_series_by_area.items()}
+
+        with self.lock:
+            self.time_series.update(time_series_by_area)
+            self.summaries.update(summaries)
+            if refreshed_at is not None:
+                self.full_refresh_times.update(dict.fromkeys(time_series_by_area, refreshed_at))
+                self.fetch_times.update(dict.fromkeys(time_series_by_area, refreshed_at))
+        log.info("Covid area store updated for {} areas".format(len(summaries)))
+
+    def merge(self, time_series_by_area):
+        """
+        Merges newer rows (a dictionary of area name to CovidTimeSeries) into the stored
+            time series, only working out the figures again for areas with new rows
+        Returns the number of areas changed
+        """
+        changed = 0
+        with self.lock:
+            for area_name, newer in time_series_by_area.items():
+                if len(newer) == 0:
+                    continue
+                stored = self.time_series.get(area_name)
+                time_series = newer if stored is None else stored.merge(newer)
+                self.time_series[area_name] = time_series
+                self.summaries[area_name] = area_summary(time_series)
+                changed += 1
+        log.info("Covid area store merged newer rows for {} areas".format(changed))
+
+        return changed
+
+    def latest_date(self, area_name):
+        """
+        Returns the newest date stored for an area, or None if there is no data for it
+        """
+        with self.lock:
+            time_series = self.time_series.get(area_name)
+
+        return None if time_series is None else time_series.latest_date()
+
+    def refreshed_at(self, area_name):
+        """
+        Returns when the full history of an area was last fetched, or None if it never was
+        """
+        with self.lock:
+            return self.full_refresh_times.get(area_name)
+
+    def fetched_at(self, area_name):
+        """
+        Returns when an area was last fetched (full history or newest dates),
+            or None if it never was
+        """
+        with self.lock:
+            return self.fetch_times.get(area_name)
+
+    def set_fetched_at(self, area_names, fetched_at):
+        """
+        Records that the newest dates of the areas were fetched at fetched_at
+        """
+        with self.lock:
+            self.fetch_times.update(dict.fromkeys(area_names, fetched_at))
+
+    def get_summaries(self, area_names = None):
+        """
+        Returns the figures for the areas in area_names (or all areas), in that order
+        Areas with no data are left out
+        """
+        with self.lock:
+            if area_names is None:
+                return dict(self.summaries)
+
+            return {area_name: self.summaries[area_name] for area_name in area_names \
+                    if area_name in self.summaries}
+
+    def get_time_series(self, area_name):
+        """
+        Returns the CovidTimeSeries for an area, or None if there is no data for it
+        """
+        with self.lock:
+            return self.time_series.get(area_name)
+
+    def __len__(self):
+        return len(self.summaries)
+
+def area_summary(time_series):
+    """
+    Returns the dashboard figures of a time series along with its area type
+    """
+    summary = time_series.summary()
+    summary["area_type"] = time_series.area_type
+
+    return summary
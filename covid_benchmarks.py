@@ -0,0 +1,1075 @@
+"""
+This module handles the benchmarking of the dashboard
+Each benchmark compares the previous implementation with the current one
+The covid and news APIs are never called: the benchmarks use local stub servers or
+    the recorded responses in upstream_fakes.py, so they run offline
+Run it with: python covid_benchmarks.py [--only NAME ...] [--json FILE] [--compare FILE]
+"""
+
+#Importing modules
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import requests
+from uk_covid19 import Cov19API
+
+#importing the modules being benchmarked
+import covid_data_handler
+from covid_cache import CovidCache, MemoryCacheBackend
+from covid_data_handler import covid_API_request, fetch_covid_areas
+from covid_data_handler import optional_value
+import covid_news_handling
+import main
+import dashboard_api
+import dashboard_logging
+import metrics
+import scheduler
+from page_cache import get_page_cache, bump_data_version
+from config_handler import locations
+from scheduler import ScheduledUpdate, UpdatesScheduledStore
+from covid_news_handling import NewsArticleStore
+from covid_data_handler import process_covid_csv_file, process_covid_csv_data, parse_csv_data
+from covid_time_series import CovidTimeSeries
+from covid_aggregates import RollingAggregates
+from http_client import ConditionalGetClient, RateLimiter, create_session
+from upstream_fakes import offline_upstreams
+from schedule_time import ScheduleClock
+from single_flight import SingleFlight
+
+def best_time(function, repeats = 5):
+    """
+    Runs a function several times and returns the fastest time in seconds
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+def synthetic_api_rows(days, area_name = "Area", start = datetime.date(2020, 3, 1)):
+    """
+    Creates rows in the Cov19API json format for one area, newest first
+    Some values are left as None to match the gaps in the real data
+    """
+    rows = []
+    for day in range(days - 1, -1, -1):
+        date = start + datetime.timedelta(days = day)
+        rows.append({"areaCode": "E0000" + str(day % 10), "areaName": area_name, \
+                     "areaType": "ltla", "date": date.isoformat(), \
+                     "cumDailyNsoDeathsByDeathDate": None if day > days - 14 else day * 3, \
+                     "hospitalCases": None if day % 30 == 0 else day % 500, \
+                     "newCasesBySpecimenDate": None if day == days - 1 else (day * 7) % 5000})
+
+    return rows
+
+def legacy_csv_lines(rows, location, location_type):
+    """
+    The previous covid_API_request step which built csv lines from the json rows
+    """
+    csv_lines = []
+    for line in rows:
+        csv_line = line["areaCode"] + "," + location + "," + location_type + \
+            "," + line["date"] + "," + optional_value(line["cumDailyNsoDeathsByDeathDate"]) \
+                + "," + optional_value(line["hospitalCases"]) + "," + \
+                    optional_value(line["newCasesBySpecimenDate"]) + "\n"
+        csv_lines.append(csv_line)
+
+    return csv_lines
+
+def legacy_process_covid_csv_data(covid_csv_data):
+    """
+    The previous line by line process_covid_csv_data, kept here for comparison
+    """
+    last7days_cases = 0
+    current_hospital_cases = "0"
+    total_deaths = "0"
+    last7days_count = 0
+    last7days_cases_found = False
+
+    total_deaths_found = False
+    current_hospital_cases_found = False
+
+    for line in covid_csv_data:
+        item = line.split(",")
+
+        if (not current_hospital_cases_found) and (item[5].isdigit()):
+            current_hospital_cases = int(item[5])
+            current_hospital_cases_found = True
+
+        if last7days_cases_found and (item[6].strip().isdigit()) and (last7days_count < 7):
+            last7days_cases = last7days_cases + int(item[6].strip())
+            last7days_count +=1
+        if (not last7days_cases_found) and (item[6].strip().isdigit()):
+            last7days_cases_found = True
+
+        if (not total_deaths_found) and (item[4].isdigit()):
+            total_deaths = int(item[4])
+            total_deaths_found = True
+
+    return last7days_cases, current_hospital_cases, total_deaths
+
+def benchmark_time_series(areas = 200, days = 3 * 365):
+    """
+    Compares processing the API json for many areas over several years:
+        - previous: json -> csv lines -> line by line processing
+        - current: json -> CovidTimeSeries -> vectorized summary
+    """
+    area_rows = [synthetic_api_rows(days, "Area " + str(area)) for area in range(areas)]
+
+    def legacy():
+        return [legacy_process_covid_csv_data(legacy_csv_lines(rows, "Area", "ltla")) \
+                for rows in area_rows]
+
+    def columnar():
+        return [CovidTimeSeries.from_api_json(rows).summary() for rows in area_rows]
+
+    for legacy_result, summary in zip(legacy(), columnar()):
+        assert legacy_result == (summary["last7days_cases"], \
+            summary["current_hospital_cases"], summary["total_deaths"])
+
+    legacy_time = best_time(legacy)
+    columnar_time = best_time(columnar)
+
+    return {"name": "time_series", "areas": areas, "days": days, \
+            "legacy_seconds": legacy_time, "current_seconds": columnar_time, \
+                "speedup": legacy_time / columnar_time}
+
+def peak_memory(function):
+    """
+    Runs a function once and returns the peak memory allocated by Python in bytes
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def write_synthetic_csv(csv_filename, rows):
+    """
+    Writes a csv file (in the nation_2021-10-28.csv format) with the given number of rows
+    """
+    with open(csv_filename, 'w') as csv_file:
+        csv_file.write("areaCode,areaName,areaType,date,cumDailyNsoDeathsByDeathDate," \
+                       "hospitalCases,newCasesBySpecimenDate\n")
+        csv_file.writelines(legacy_csv_lines(synthetic_api_rows(rows), "Area", "ltla"))
+
+def benchmark_streaming_csv(sizes = (10_000, 100_000, 1_000_000, 2_000_000)):
+    """
+    Compares the time and peak memory of processing csv files of growing size:
+        - previous: readlines() then a full line by line pass
+        - current: process_covid_csv_file streaming from a memory map and stopping early
+    Also reports parse_csv_data then process_covid_csv_data (reading every line into a list)
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            csv_filename = os.path.join(directory, "area_" + str(size) + ".csv")
+            write_synthetic_csv(csv_filename, size)
+
+            def legacy():
+                with open(csv_filename, 'r') as csv_file:
+                    return legacy_process_covid_csv_data(csv_file.readlines()[1:])
+
+            def streaming():
+                return process_covid_csv_file(csv_filename)
+
+            def parsed():
+                return process_covid_csv_data(parse_csv_data(csv_filename))
+
+            assert legacy() == streaming() == parsed()
+
+            legacy_time = best_time(legacy, repeats = 1)
+            streaming_time = best_time(streaming, repeats = 1)
+            results.append({"name": "streaming_csv", "rows": size, \
+                            "legacy_seconds": legacy_time, "current_seconds": streaming_time, \
+                            "parse_seconds": best_time(parsed, repeats = 1), \
+                            "legacy_peak_bytes": peak_memory(legacy), \
+                            "current_peak_bytes": peak_memory(streaming), \
+                            "speedup": legacy_time / streaming_time})
+
+    return results
+
+class StubCovidAPIHandler(BaseHTTPRequestHandler):
+    """
+    This class answers Cov19API requests locally after a fixed delay
+    Page 1 holds the rows and page 2 is empty (204), like the real API
+    """
+
+    delay = 0.2
+    rows = synthetic_api_rows(30)
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        query = parse_qs(urlparse(self.path).query)
+        if query.get("page", ["1"])[0] != "1":
+            self.send_response(204)
+            self.end_headers()
+            return
+
+        body = json.dumps({"data": self.rows}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", "Thu, 28 Oct 2021 15:00:00 GMT")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@contextmanager
+def stub_covid_api(delay = 0.2):
+    """
+    Runs the stub covid API on a local port and points Cov19API at it
+    The covid cache is switched off so every request reaches the stub
+    """
+    handler = type("DelayedStubCovidAPIHandler", (StubCovidAPIHandler,), {"delay": delay})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    endpoint = Cov19API.endpoint
+    covid_cache = covid_data_handler.covid_cache
+    Cov19API.endpoint = "http://127.0.0.1:{}/v1/data".format(server.server_port)
+    covid_data_handler.covid_cache = CovidCache(MemoryCacheBackend(), ttl = 0, stale_ttl = 0)
+    try:
+        yield server
+    finally:
+        Cov19API.endpoint = endpoint
+        covid_data_handler.covid_cache = covid_cache
+        server.shutdown()
+        server.server_close()
+
+def benchmark_concurrent_fetch(extra_areas = 6, delay = 0.2):
+    """
+    Compares fetching the local, national and extra areas from a stub API:
+        - previous: one covid_API_request after another
+        - current: fetch_covid_areas running the requests at the same time
+    """
+    areas = [("Exeter", "ltla"), ("England", "nation")] + \
+        [("Area " + str(area), "ltla") for area in range(extra_areas)]
+
+    with stub_covid_api(delay):
+        def sequential():
+            return {area_name: covid_API_request(area_name, area_type) \
+                    for area_name, area_type in areas}
+
+        def concurrent():
+            return fetch_covid_areas(areas)
+
+        assert sequential() == concurrent()
+
+        sequential_time = best_time(sequential, repeats = 1)
+        concurrent_time = best_time(concurrent, repeats = 3)
+
+    return {"name": "concurrent_fetch", "areas": len(areas), "request_seconds": 2 * delay, \
+            "legacy_seconds": sequential_time, "current_seconds": concurrent_time, \
+                "speedup": sequential_time / concurrent_time}
+
+class StubDatedCovidAPIHandler(StubCovidAPIHandler):
+    """
+    This class answers Cov19API requests like StubCovidAPIHandler, keeping only the rows
+        for the date in the filters (if there is one) and counting the bytes sent
+    Each response takes delay seconds plus the time to send its body at bytes_per_second
+        (None for no limit), like a request over a real network
+    """
+
+    sent_bytes = [0]
+    bytes_per_second = None
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        filters = dict(part.split("=", 1) for part in query["filters"][0].split(";"))
+        rows = [row for row in self.rows if filters.get("date", row["date"]) == row["date"]]
+        if query.get("page", ["1"])[0] != "1" or not rows:
+            time.sleep(self.delay)
+            self.send_response(204)
+            self.end_headers()
+            return
+
+        body = json.dumps({"data": rows}).encode("utf-8")
+        self.sent_bytes[0] += len(body)
+        transfer_seconds = 0 if self.bytes_per_second is None else len(body) / self.bytes_per_second
+        time.sleep(self.delay + transfer_seconds)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", "Thu, 28 Oct 2021 15:00:00 GMT")
+        self.end_headers()
+        self.wfile.write(body)
+
+def benchmark_incremental_update(days = 700, refreshes = 10, latency = 0.02, \
+                                 bytes_per_second = 10_000_000):
+    """
+    Compares refreshing an area that is already stored, from a stub API answering each
+        request after latency seconds and sending bytes_per_second:
+        - previous: the whole history fetched and processed on every refresh
+        - current: covid_API_request, only the newest dates requested (at the same time)
+            and merged
+    """
+    start = datetime.date.today() - datetime.timedelta(days = days - 1)
+    rows = synthetic_api_rows(days, "Exeter", start)
+    sent_bytes = [0]
+    handler = type("BenchmarkDatedCovidAPIHandler", (StubDatedCovidAPIHandler,), \
+                   {"delay": latency, "bytes_per_second": bytes_per_second, "rows": rows, \
+                    "sent_bytes": sent_bytes})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    endpoint = Cov19API.endpoint
+    covid_cache = covid_data_handler.covid_cache
+    covid_area_store = covid_data_handler.covid_area_store
+    Cov19API.endpoint = "http://127.0.0.1:{}/v1/data".format(server.server_port)
+    covid_data_handler.covid_cache = CovidCache(MemoryCacheBackend(), ttl = 0, stale_ttl = 0)
+    covid_data_handler.covid_area_store = covid_data_handler.CovidAreaStore()
+
+    def full():
+        for _ in range(refreshes):
+            data = Cov19API(filters = ['areaType=ltla', 'areaName=Exeter'], \
+                            structure = covid_data_handler.CASES_AND_DEATHS).get_json()
+            summary = CovidTimeSeries.from_api_json(data["data"]).summary()
+        return summary
+
+    def incremental():
+        for _ in range(refreshes):
+            summary = covid_API_request("Exeter", "ltla")
+        return summary
+
+    try:
+        covid_API_request("Exeter", "ltla")
+        sent_bytes[0] = 0
+        full_time = best_time(full, repeats = 1)
+        full_bytes = sent_bytes[0]
+        sent_bytes[0] = 0
+        incremental_time = best_time(incremental, repeats = 1)
+        incremental_bytes = sent_bytes[0]
+        assert {key: value for key, value in incremental().items() if key != "area_type"} == full()
+    finally:
+        Cov19API.endpoint = endpoint
+        covid_data_handler.covid_cache = covid_cache
+        covid_data_handler.covid_area_store = covid_area_store
+        server.shutdown()
+        server.server_close()
+
+    return {"name": "incremental_update", "days": days, "refreshes": refreshes, \
+            "latency": latency, "legacy_bytes": full_bytes, "current_bytes": incremental_bytes, \
+                "legacy_seconds": full_time, "current_seconds": incremental_time, \
+                    "speedup": full_time / incremental_time}
+
+def load_dashboard_data(news_articles = 100):
+    """
+    Fills the dashboard with covid data and news articles so pages render without the APIs
+    """
+    covid_data_handler.publish_covid_data({"location_last7days_cases": 1234, \
+        "nation_last7days_cases": 240299, \
+            "nation_current_hospital_cases": "National Hospital Cases: 7019", \
+                "nation_total_deaths": "National Total Deaths: 141544", "areas": {}})
+    covid_news_handling.news_articles.clear()
+    covid_news_handling.news_articles.add_new([{"title": "Headline " + str(article), \
+        "content": "Article content " * 20} for article in range(news_articles)])
+
+def requests_per_second(client, url, requests, headers = None):
+    """
+    Makes requests to the Flask test client and returns the requests per second
+    """
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get(url, headers = headers)
+
+    return requests / (time.perf_counter() - start)
+
+def benchmark_page_cache(requests = 1000):
+    """
+    Load tests the 60 second /index refresh on the Flask test client:
+        - previous: every request renders index.html
+        - current: unchanged pages come from the page cache, or 304 with If-None-Match
+    """
+    load_dashboard_data()
+    client = main.app.test_client()
+    page_cache = get_page_cache()
+
+    page_cache.enabled = False
+    uncached = requests_per_second(client, "/index", requests)
+    page_cache.enabled = True
+    cached = requests_per_second(client, "/index", requests)
+    etag = client.get("/index").headers["ETag"]
+    not_modified = requests_per_second(client, "/index", requests, {"If-None-Match": etag})
+
+    return {"name": "page_cache", "requests": requests, "legacy_rps": uncached, \
+            "current_rps": cached, "not_modified_rps": not_modified, \
+                "speedup": cached / uncached}
+
+def benchmark_json_api(requests = 1000):
+    """
+    Load tests monitoring polls for the news on the Flask test client:
+        - previous: the whole dashboard page rendered (uncached) to read the news
+        - current: /api/news, serialized and gzip compressed once per data version
+    Also reports the bytes sent per poll
+    """
+    load_dashboard_data()
+    client = main.app.test_client()
+    page_cache = get_page_cache()
+    gzip_headers = {"Accept-Encoding": "gzip"}
+
+    page_cache.enabled = False
+    page_rps = requests_per_second(client, "/index", requests)
+    page_cache.enabled = True
+    page_bytes = len(client.get("/index").data)
+    api_rps = requests_per_second(client, "/api/news", requests, gzip_headers)
+    api_bytes = len(client.get("/api/news", headers = gzip_headers).data)
+
+    return {"name": "json_api", "requests": requests, "legacy_rps": page_rps, \
+            "current_rps": api_rps, "legacy_bytes": page_bytes, "current_bytes": api_bytes, \
+                "speedup": api_rps / page_rps}
+
+def benchmark_logging(requests = 500, updates = 200):
+    """
+    Load tests /index on the Flask test client with updates scheduled, where every request
+        logs the size of updates_scheduled and the scheduler queue:
+        - previous: logging.basicConfig, a line per scheduled update written and flushed
+            to the log file in the request on every request
+        - current: records handed to the background log writer, and the per-item dump
+            written on one request in dump_every
+    Returns the mean latency of a request in milliseconds
+    """
+    load_dashboard_data()
+    client = main.app.test_client()
+    root = logging.getLogger()
+    root_handlers, root_level = list(root.handlers), root.level
+    dump_every, dump_max_items = dashboard_logging.dump_sampler.dump_every, \
+        dashboard_logging.dump_sampler.max_items
+    store = scheduler.get_updates_scheduled()
+    titles = ["Logging benchmark " + str(update) for update in range(updates)]
+    store.add_all([ScheduledUpdate(title, "", "12:00", "covid-data", None, None, None, None, \
+                                   time.time() + 86400) for title in titles])
+    bump_data_version("logging benchmark updates added")
+
+    def mean_latency_ms():
+        client.get("/index")
+        return 1000 / requests_per_second(client, "/index", requests)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for handler in root_handlers:
+            root.removeHandler(handler)
+        try:
+            legacy_handler = logging.FileHandler(os.path.join(directory, "legacy.log"), \
+                                                 encoding = 'utf-8')
+            legacy_handler.setFormatter(logging.Formatter(dashboard_logging.FORMAT))
+            root.addHandler(legacy_handler)
+            root.setLevel(logging.DEBUG)
+            dashboard_logging.dump_sampler.dump_every = 1
+            dashboard_logging.dump_sampler.max_items = None
+            legacy = mean_latency_ms()
+            root.removeHandler(legacy_handler)
+            legacy_handler.close()
+
+            settings = dict(dashboard_logging.DEFAULT_LOGGING_SETTINGS, \
+                            filename = os.path.join(directory, "current.log"))
+            log_queue = queue.Queue(maxsize = settings["queue_size"])
+            queue_handler = dashboard_logging.DroppingQueueHandler(log_queue)
+            file_handler = dashboard_logging.BatchRotatingFileHandler(settings["filename"], \
+                encoding = 'utf-8', maxBytes = settings["max_bytes"], \
+                    backupCount = settings["backup_count"])
+            file_handler.setFormatter(logging.Formatter(dashboard_logging.FORMAT))
+            writer = dashboard_logging.LogWriter(log_queue, file_handler, settings["batch_size"])
+            writer.start()
+            root.addHandler(queue_handler)
+            dashboard_logging.dump_sampler.dump_every = settings["dump_every"]
+            dashboard_logging.dump_sampler.max_items = settings["dump_max_items"]
+            current = mean_latency_ms()
+            root.removeHandler(queue_handler)
+            writer.stop()
+        finally:
+            for handler in root_handlers:
+                root.addHandler(handler)
+            root.setLevel(root_level)
+            dashboard_logging.dump_sampler.dump_every = dump_every
+            dashboard_logging.dump_sampler.max_items = dump_max_items
+            for title in titles:
+                store.remove(title)
+            bump_data_version("logging benchmark updates removed")
+
+    return {"name": "logging", "requests": requests, "updates": updates, \
+            "legacy_ms": legacy, "current_ms": current, "dropped": queue_handler.dropped, \
+                "speedup": legacy / current}
+
+def benchmark_metrics(calls = 200_000, requests = 1000):
+    """
+    Measures the cost of leaving the metrics on:
+        - a call to a function with and without the timed decorator
+        - /index on the Flask test client (served from the page cache) with the metrics
+            turned off and on
+    """
+    def function():
+        return None
+
+    timed_function = metrics.timed(function)
+
+    def call(target):
+        def run():
+            for _ in range(calls):
+                target()
+        return run
+
+    plain_seconds = best_time(call(function))
+    timed_seconds = best_time(call(timed_function))
+
+    load_dashboard_data()
+    client = main.app.test_client()
+    metrics.registry.enabled = False
+    try:
+        off_rps = requests_per_second(client, "/index", requests)
+    finally:
+        metrics.registry.enabled = True
+    on_rps = requests_per_second(client, "/index", requests)
+
+    return {"name": "metrics", "calls": calls, \
+            "overhead_per_call_us": (timed_seconds - plain_seconds) / calls * 1e6, \
+                "requests": requests, "metrics_off_rps": off_rps, "metrics_on_rps": on_rps, \
+                    "overhead": off_rps / on_rps - 1}
+
+def benchmark_event_stream(tabs = 50, refreshes = 10):
+    """
+    Compares keeping open dashboard tabs up to date while the news changes once per minute:
+        - previous: every tab renders /index every 60 seconds (meta refresh)
+        - current: one /events stream per tab, each change encoded once and pushed to all tabs
+    """
+    load_dashboard_data()
+    client = main.app.test_client()
+    page_cache = get_page_cache()
+
+    def legacy():
+        page_cache.enabled = False
+        try:
+            for _ in range(refreshes):
+                for _ in range(tabs):
+                    client.get("/index")
+        finally:
+            page_cache.enabled = True
+
+    def pushed():
+        streams = [dashboard_api.event_stream(main.api_payloads, None, heartbeat = 60) \
+                   for _ in range(tabs)]
+        for stream in streams:
+            next(stream)
+        for refresh in range(refreshes):
+            covid_news_handling.news_articles.add_new([{"title": "Pushed " + str(time.time()) \
+                + " " + str(refresh), "content": "Article content"}])
+            bump_data_version("benchmark")
+            for stream in streams:
+                next(stream)
+        for stream in streams:
+            stream.close()
+
+    legacy_time = best_time(legacy, repeats = 1)
+    pushed_time = best_time(pushed, repeats = 1)
+
+    return {"name": "event_stream", "tabs": tabs, "refreshes": refreshes, \
+            "legacy_seconds": legacy_time, "current_seconds": pushed_time, \
+                "speedup": legacy_time / pushed_time}
+
+def legacy_locations():
+    """
+    The previous locations(), which opened and parsed config.json on every call
+    """
+    f = open('config.json',)
+    config_dict = json.load(f)
+
+    return config_dict["nation_location"], config_dict["location"]
+
+def benchmark_config(calls = 10_000):
+    """
+    Compares the per request cost of reading the locations from the configuration:
+        - previous: open and parse config.json on every call
+        - current: read the configuration loaded at startup
+    """
+    assert legacy_locations() == locations()
+
+    def legacy():
+        for _ in range(calls):
+            legacy_locations()
+
+    def shared():
+        for _ in range(calls):
+            locations()
+
+    legacy_time = best_time(legacy, repeats = 3)
+    shared_time = best_time(shared, repeats = 3)
+
+    return {"name": "config", "calls": calls, "legacy_us_per_call": legacy_time / calls * 1e6, \
+            "current_us_per_call": shared_time / calls * 1e6, "speedup": legacy_time / shared_time}
+
+def benchmark_updates_scheduled(updates = 100_000, due = 100, lookups = 1000):
+    """
+    Compares the updates_scheduled operations used on every request and review:
+        - previous: a list of dictionaries, scanned for each title lookup and each review
+        - current: UpdatesScheduledStore, a title dictionary plus a heap of due times
+    """
+    now = time.time()
+    due_times = [now - 1 if update < due else now + 3600 + update for update in range(updates)]
+    titles = ["update " + str(update) for update in range(updates)]
+
+    legacy_list = [{"title": title, "content": "", "update_time": "12:00", \
+                    "update_covid_data": "covid-data", "update_news": None, "repeat": None, \
+                    "update_covid_event": None, "update_news_event": None, \
+                    "absolute_delay_time": due_time} for title, due_time in zip(titles, due_times)]
+    store = UpdatesScheduledStore()
+    store.add_all([ScheduledUpdate(title, "", "12:00", "covid-data", None, None, None, None, \
+                                   due_time) for title, due_time in zip(titles, due_times)])
+
+    lookup_titles = titles[::updates // lookups]
+
+    def legacy():
+        for title in lookup_titles:
+            [item for item in legacy_list if item['title'] == title]
+        return [item for item in legacy_list if time.time() > item["absolute_delay_time"]]
+
+    def indexed():
+        for title in lookup_titles:
+            title in store
+        found_due = store.pop_due(time.time())
+        store.requeue(found_due)
+        return found_due
+
+    assert len(legacy()) == len(indexed()) == due
+
+    legacy_time = best_time(legacy, repeats = 1)
+    indexed_time = best_time(indexed, repeats = 3)
+
+    return {"name": "updates_scheduled", "updates": updates, "due": due, \
+            "lookups": len(lookup_titles), "legacy_seconds": legacy_time, "current_seconds": indexed_time, \
+                "speedup": legacy_time / indexed_time}
+
+def legacy_calculate_delay(hours_minutes, delay_delta_seconds):
+    """
+    The previous calculate_delay, which parsed the time and read the clock on every call
+    """
+    hours_minutes_list = hours_minutes.split(':')
+    hours = int(hours_minutes_list[0])
+    minutes = int (hours_minutes_list[1])
+    seconds = ( ( hours * 60 * 60) + (minutes * 60))
+
+    now = datetime.datetime.now()
+    seconds_since_midnight = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+
+    if seconds > (seconds_since_midnight + delay_delta_seconds):
+        return (seconds + delay_delta_seconds) - seconds_since_midnight
+
+    return ((24 * 60 * 60) + delay_delta_seconds + seconds) - seconds_since_midnight
+
+def benchmark_schedule_delays(updates = 10_000):
+    """
+    Compares working out the covid, news and absolute delays of a batch of scheduled updates
+        (e.g. restoring them at startup):
+        - previous: calculate_delay parsing the time and reading the clock each time
+        - current: one ScheduleClock for the batch, with each time parsed once
+    """
+    update_times = ["{:02d}:{:02d}".format(update % 24, update * 7 % 60) \
+                    for update in range(updates)]
+
+    def legacy():
+        return [(legacy_calculate_delay(update_time, 10), legacy_calculate_delay(update_time, 20), \
+                 time.time() + legacy_calculate_delay(update_time, 30)) \
+                for update_time in update_times]
+
+    def batched():
+        clock = ScheduleClock()
+        return [(clock.delay(update_time, 10), clock.delay(update_time, 20), \
+                 clock.absolute_time(update_time, 30)) for update_time in update_times]
+
+    assert all(abs(old[0] - new[0]) < 1 and abs(old[1] - new[1]) < 1 \
+               for old, new in zip(legacy(), batched()))
+    legacy_time = best_time(legacy)
+    batched_time = best_time(batched)
+
+    return {"name": "schedule_delays", "updates": updates, "legacy_seconds": legacy_time, \
+            "current_seconds": batched_time, "speedup": legacy_time / batched_time}
+
+def benchmark_news_dedup(seen = 50_000, displayed = 1000, updates = 20, articles = 100):
+    """
+    Compares news updates and dismissals with tens of thousands of seen titles:
+        - previous: seen titles and articles in lists, filtered and rebuilt on every change
+        - current: NewsArticleStore, with the titles in a set and an ordered dictionary
+    """
+    seen_titles = ["Seen headline " + str(title) for title in range(seen)]
+    shown = [{"title": "Shown headline " + str(title)} for title in range(displayed)]
+    batches = [[{"title": "Seen headline " + str((batch * articles + article) * 7 % seen)} \
+                if article % 2 else {"title": "New headline " + str(batch) + "-" + str(article)} \
+                for article in range(articles)] for batch in range(updates)]
+    dismissed = [article["title"] for article in shown[:updates]]
+
+    def legacy():
+        seen_news_articles = list(seen_titles)
+        news_articles = list(shown)
+        for batch, title in zip(batches, dismissed):
+            excluding_seen_news = [news_article for news_article in batch \
+                                   if news_article['title'] not in seen_news_articles]
+            existing_news_titles = list(map(lambda d: d['title'], news_articles))
+            news_articles.extend([news_article for news_article in excluding_seen_news \
+                                  if news_article['title'] not in existing_news_titles])
+            seen_news_articles.append(title)
+            news_articles = [news_article for news_article in news_articles \
+                             if news_article['title'] != title]
+        return len(news_articles)
+
+    def indexed():
+        store = NewsArticleStore()
+        store.seen_titles.update(seen_titles)
+        store.add_new(shown)
+        for batch, title in zip(batches, dismissed):
+            store.add_new(batch)
+            store.mark_seen(title)
+        return len(store)
+
+    assert legacy() == indexed()
+
+    legacy_time = best_time(legacy, repeats = 1)
+    indexed_time = best_time(indexed, repeats = 3)
+
+    return {"name": "news_dedup", "seen": seen, "displayed": displayed, "updates": updates, \
+            "legacy_seconds": legacy_time, "current_seconds": indexed_time, \
+                "speedup": legacy_time / indexed_time}
+
+class StubNewsAPIHandler(BaseHTTPRequestHandler):
+    """
+    This class answers news API requests locally with an ETag, keeping connections open
+    A request with a matching If-None-Match is answered 304 Not Modified
+    """
+
+    protocol_version = "HTTP/1.1"
+    body = json.dumps({"status": "ok", "articles": [{"title": "Headline " + str(article), \
+        "description": "Covid news " * 50} for article in range(100)]}).encode("utf-8")
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"news-v1"':
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", '"news-v1"')
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+def benchmark_news_requests(requests_count = 200):
+    """
+    Compares repeated news API requests for an unchanged response:
+        - previous: requests.get, a new connection and the whole response every time
+        - current: a pooled session with conditional requests (ETag, 304 Not Modified)
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubNewsAPIHandler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    url = "http://127.0.0.1:{}/v2/top-headlines?q=covid".format(server.server_port)
+
+    def legacy():
+        for _ in range(requests_count):
+            requests.get(url).json()
+
+    client = ConditionalGetClient(create_session(retries = 0))
+
+    def pooled():
+        for _ in range(requests_count):
+            client.get_json(url)
+
+    try:
+        legacy_time = best_time(legacy, repeats = 3)
+        pooled_time = best_time(pooled, repeats = 3)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {"name": "news_requests", "requests": requests_count, \
+            "legacy_seconds": legacy_time, "current_seconds": pooled_time, \
+                "speedup": legacy_time / pooled_time}
+
+def benchmark_news_fanout(queries = 2, countries = 3, delay = 0.1):
+    """
+    Compares fetching several news queries and countries (each request takes delay seconds):
+        - previous: one request after another
+        - current: fetch_news, all of the requests at the same time (rate limited)
+    """
+    query_list = ["query " + str(query) for query in range(queries)]
+    country_list = ["c" + str(country) for country in range(countries)]
+
+    def slow_news_API_request(covid_terms, country):
+        time.sleep(delay)
+        return {"articles": [{"title": covid_terms + " " + country, \
+                              "publishedAt": "2021-12-01T09:00:00Z"}]}
+
+    news_API_request = covid_news_handling.news_API_request
+    rate_limiter = covid_news_handling.news_rate_limiter
+    covid_news_handling.news_API_request = slow_news_API_request
+    covid_news_handling.news_rate_limiter = RateLimiter(rate = 100, burst = queries * countries)
+    try:
+        serial_time = best_time(lambda: [slow_news_API_request(query, country) \
+            for query in query_list for country in country_list], repeats = 3)
+        fanout_time = best_time(lambda: covid_news_handling.merge_news( \
+            covid_news_handling.fetch_news(query_list, country_list)), repeats = 3)
+    finally:
+        covid_news_handling.news_API_request = news_API_request
+        covid_news_handling.news_rate_limiter = rate_limiter
+
+    return {"name": "news_fanout", "requests": queries * countries, \
+            "legacy_seconds": serial_time, "current_seconds": fanout_time, \
+                "speedup": serial_time / fanout_time}
+
+def benchmark_rolling_aggregates(days = 1000, windows = 20_000, window_days = 28):
+    """
+    Compares rolling sums of new cases over many windows of a time series:
+        - previous: each window summed from the series columns (O(window) per query)
+        - current: RollingAggregates, built once then O(1) per window from prefix sums
+    """
+    time_series = CovidTimeSeries.from_api_json(synthetic_api_rows(days))
+    ends = [(window * 7919) % days for window in range(windows)]
+
+    def legacy():
+        totals = []
+        for end in ends:
+            #rows are newest first, so the window ending on day end is a slice of the columns
+            newest = days - 1 - end
+            window = slice(newest, newest + window_days)
+            totals.append(int(time_series.new_cases[window][time_series.new_cases_mask[window]].sum()))
+        return totals
+
+    def prefix_sums():
+        aggregates = RollingAggregates(time_series)
+        return [aggregates.rolling_sum("new_cases", window_days, end) for end in ends]
+
+    assert legacy() == prefix_sums()
+
+    legacy_time = best_time(legacy, repeats = 3)
+    prefix_time = best_time(prefix_sums, repeats = 3)
+
+    return {"name": "rolling_aggregates", "days": days, "windows": windows, \
+            "legacy_seconds": legacy_time, "current_seconds": prefix_time, \
+                "speedup": legacy_time / prefix_time}
+
+def benchmark_job_coalescing(updates = 10, minutes = 2):
+    """
+    Compares the upstream API calls made when several scheduled updates (each updating the
+        covid data and the news) fire in the same few minutes, using the recorded responses:
+        - previous: every job makes its own fetch
+        - current: jobs for the same fetch due within the coalescing window share one run
+    The jobs are run on a two thread pool, like the scheduler's job pool
+    """
+    start = time.time()
+    jobs = []
+    for update in range(updates):
+        fire_time = start + 60 * (update % minutes)
+        jobs.append((covid_data_handler.update_covid_data, \
+                     {"nation_location": "England", "location": "Exeter"}, fire_time + 10))
+        jobs.append((covid_news_handling.update_news, {}, fire_time + 20))
+    jobs.sort(key = lambda job: job[2])
+
+    def run_jobs(settings):
+        flights = scheduler.job_flights
+        scheduler.job_flights = SingleFlight()
+        try:
+            with offline_upstreams() as calls:
+                with ThreadPoolExecutor(max_workers = 2) as executor:
+                    list(executor.map(lambda job: scheduler.run_coalesced(*job, settings), jobs))
+                return calls.counts()
+        finally:
+            scheduler.job_flights = flights
+
+    legacy = run_jobs({"enabled": False})
+    current = run_jobs(dict(scheduler.DEFAULT_COALESCING_SETTINGS, enabled = True))
+
+    return {"name": "job_coalescing", "updates": updates, "jobs": len(jobs), \
+            "legacy_covid_requests": legacy["covid"], "legacy_news_requests": legacy["news"], \
+                "current_covid_requests": current["covid"], \
+                    "current_news_requests": current["news"], \
+                        "reduction": (legacy["covid"] + legacy["news"]) / \
+                            (current["covid"] + current["news"])}
+
+def benchmark_offline_refresh(refreshes = 20):
+    """
+    Measures a full refresh of the dashboard data from the recorded covid and news API
+        responses (update_covid_data then update_news), so only the dashboard's own
+        processing is timed
+    """
+    def refresh():
+        for _ in range(refreshes):
+            covid_data_handler.update_covid_data("England", "Exeter")
+            covid_news_handling.news_articles.clear()
+            covid_news_handling.update_news()
+
+    with offline_upstreams() as calls:
+        refresh_time = best_time(refresh, repeats = 3)
+        counts = calls.counts()
+
+    return {"name": "offline_refresh", "refreshes": refreshes, \
+            "current_seconds": refresh_time / refreshes, \
+                "covid_requests": counts["covid"], "news_requests": counts["news"]}
+
+def benchmark_index_end_to_end(requests = 500, updates = 2000):
+    """
+    Load tests /index on the Flask test client with the data fetched from the recorded
+        covid and news API responses and thousands of updates scheduled:
+        - previous: every request renders index.html
+        - current: unchanged pages come from the page cache
+    """
+    client = main.app.test_client()
+    page_cache = get_page_cache()
+    store = scheduler.get_updates_scheduled()
+    titles = ["End to end benchmark " + str(update) for update in range(updates)]
+
+    with offline_upstreams():
+        covid_data_handler.update_covid_data("England", "Exeter")
+        covid_news_handling.news_articles.clear()
+        covid_news_handling.update_news()
+    store.add_all([ScheduledUpdate(title, "", "12:00", "covid-data", None, None, None, None, \
+                                   time.time() + 86400) for title in titles])
+    bump_data_version("end to end benchmark updates added")
+
+    try:
+        page_cache.enabled = False
+        uncached = requests_per_second(client, "/index", requests // 10)
+        page_cache.enabled = True
+        client.get("/index")
+        cached = requests_per_second(client, "/index", requests)
+    finally:
+        page_cache.enabled = True
+        for title in titles:
+            store.remove(title)
+        bump_data_version("end to end benchmark updates removed")
+
+    return {"name": "index_end_to_end", "requests": requests, "updates": updates, \
+            "legacy_rps": uncached, "current_rps": cached, "speedup": cached / uncached}
+
+def print_result(result):
+    """
+    Prints one benchmark result on a single line
+    """
+    print(", ".join("{}={}".format(key, round(value, 4) if isinstance(value, float) \
+                                   else value) for key, value in result.items()))
+
+#Every benchmark, in the order they are run
+BENCHMARKS = [benchmark_time_series, benchmark_streaming_csv, benchmark_concurrent_fetch, \
+              benchmark_page_cache, benchmark_json_api, benchmark_event_stream, \
+              benchmark_logging, benchmark_metrics, benchmark_config, \
+              benchmark_updates_scheduled, benchmark_schedule_delays, benchmark_news_dedup, \
+              benchmark_news_requests, benchmark_news_fanout, benchmark_incremental_update, \
+              benchmark_rolling_aggregates, benchmark_job_coalescing, benchmark_offline_refresh, \
+              benchmark_index_end_to_end]
+
+def run_benchmarks(names = None):
+    """
+    Runs the benchmarks (only those named, e.g. "news_dedup", if names are given),
+        printing each result as it is made
+    Returns the list of results
+    """
+    results = []
+    for benchmark in BENCHMARKS:
+        if names and benchmark.__name__[len("benchmark_"):] not in names:
+            continue
+        benchmark_results = benchmark()
+        if isinstance(benchmark_results, dict):
+            benchmark_results = [benchmark_results]
+        for result in benchmark_results:
+            print_result(result)
+            results.append(result)
+
+    return results
+
+def current_commit():
+    """
+    Returns the git commit being benchmarked (None outside a git checkout)
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, \
+                              check = True, cwd = os.path.dirname(os.path.abspath(__file__))) \
+            .stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(filename, results):
+    """
+    Saves the results to a json file, with the commit, time and Python version they are for
+    """
+    report = {"commit": current_commit(), "time": datetime.datetime.now().isoformat(), \
+              "python": sys.version.split()[0], "platform": platform.platform(), \
+                  "results": results}
+    with open(filename, 'w', encoding = 'utf-8') as results_file:
+        json.dump(report, results_file, indent = 1)
+
+def result_key(result):
+    """
+    Returns what identifies a result between runs: its name and its sizes (e.g. rows)
+    """
+    return (result["name"],) + tuple(sorted((key, value) for key, value in result.items() \
+                                            if key in ("rows", "requests", "updates")))
+
+def compare_results(previous_results, results, tolerance = 0.10):
+    """
+    Compares the current timings with those saved by an earlier run
+    Returns a line for each timing that got worse by more than the tolerance
+        (a higher *_seconds, *_ms or *_us_per_call, or a lower *_rps)
+    """
+    previous_by_key = {result_key(result): result for result in previous_results}
+    regressions = []
+    for result in results:
+        previous = previous_by_key.get(result_key(result))
+        if previous is None:
+            continue
+        for key, value in result.items():
+            old_value = previous.get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old_value, (int, float)) \
+                    or not value or not old_value:
+                continue
+            if key.endswith(("_seconds", "_ms", "_us_per_call")):
+                change = value / old_value - 1
+            elif key.endswith("_rps"):
+                change = old_value / value - 1
+            else:
+                continue
+            if change > tolerance:
+                regressions.append("{} {}: {:.4g} -> {:.4g} ({:+.0%})".format( \
+                    result["name"], key, old_value, value, change))
+
+    return regressions
+
+if __name__ == '__main__':
+    """
+    Running the benchmarks
+    """
+    parser = argparse.ArgumentParser(description = "Benchmark the covid dashboard offline")
+    parser.add_argument("--only", nargs = "+", metavar = "NAME", \
+                        help = "benchmarks to run, e.g. news_dedup index_end_to_end")
+    parser.add_argument("--json", metavar = "FILE", help = "save the results to a json file")
+    parser.add_argument("--compare", metavar = "FILE", \
+                        help = "report timings more than 10%% worse than a saved json file")
+    arguments = parser.parse_args()
+
+    benchmark_results = run_benchmarks(arguments.only)
+    if arguments.json:
+        write_results(arguments.json, benchmark_results)
+    if arguments.compare:
+        with open(arguments.compare, encoding = 'utf-8') as previous_file:
+            previous_report = json.load(previous_file)
+        for regression in compare_results(previous_report["results"], benchmark_results):
+            print("Regression:", regression)
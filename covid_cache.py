@@ -0,0 +1,244 @@
+"""
+This module handles:
+    - caching covid API responses with a time to live (TTL)
+    - serving stale responses while they are refreshed in the background (stale-while-revalidate)
+    - an in-process (memory) backend and an on-disk (SQLite) backend for the cache
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#Default settings, used for anything missing from the "covid_cache" section of the config file
+DEFAULT_CACHE_SETTINGS = {"backend": "memory", "ttl": 300, "stale_ttl": 3600, \
+                          "max_entries": 128, "path": "covid_cache.sqlite3"}
+
+class MemoryCacheBackend:
+    """
+    This class stores cache entries in process, evicting the least recently used entry
+        once max_entries is reached
+    """
+
+    def __init__(self, max_entries = 128):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns (stored_at, value) for the key, or None if it is not cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key, stored_at, value):
+        """
+        Stores a value and evicts the least recently used entries over max_entries
+        """
+        with self.lock:
+            self.entries[key] = (stored_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted_key, _ = self.entries.popitem(last = False)
+                log.info("Evicted covid cache entry " + evicted_key)
+
+    def __len__(self):
+        return len(self.entries)
+
+class SQLiteCacheBackend:
+    """
+    This class stores cache entries in an SQLite file so the cache is still warm after a restart
+    Values are stored as json and the least recently used entries are evicted over max_entries
+    """
+
+    def __init__(self, path = "covid_cache.sqlite3", max_entries = 128):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS covid_cache (key TEXT PRIMARY KEY, " \
+                                    "stored_at REAL, last_used REAL, value TEXT)")
+
+    def get(self, key):
+        """
+        Returns (stored_at, value) for the key, or None if it is not cached
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT stored_at, value FROM covid_cache WHERE key = ?", \
+                                          (key,)).fetchone()
+            if row is None:
+                return None
+
+            self.connection.execute("UPDATE covid_cache SET last_used = ? WHERE key = ?", \
+                                    (time.time(), key))
+
+        return row[0], json.loads(row[1])
+
+    def set(self, key, stored_at, value):
+        """
+        Stores a value and evicts the least recently used entries over max_entries
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO covid_cache VALUES (?, ?, ?, ?)", \
+                                    (key, stored_at, time.time(), json.dumps(value)))
+            self.connection.execute("DELETE FROM covid_cache WHERE key NOT IN (SELECT key FROM " \
+                                    "covid_cache ORDER BY last_used DESC LIMIT ?)", \
+                                    (self.max_entries,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM covid_cache").fetchone()[0]
+
+class CovidCache:
+    """
+    This class is a keyed cache for covid API responses:
+    - younger than ttl seconds: returned straight from the cache (a hit)
+    - younger than ttl + stale_ttl seconds: returned straight away and refreshed
+        in a background thread (a stale hit), so callers never wait on the API
+    - otherwise: fetched from the API before returning (a miss)
+    """
+
+    def __init__(self, backend, ttl = 300, stale_ttl = 3600, clock = time.time):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.counters = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, \
+                         "refresh_errors": 0}
+        self.refreshing = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for the key, using loader() to fetch it when needed
+        """
+        _, value = self.get_entry(key, loader)
+
+        return value
+
+    def get_entry(self, key, loader):
+        """
+        Returns (stored_at, value) for the key, using loader() to fetch it when needed
+        stored_at is when the value was fetched from the API, which for a (stale) hit
+            is earlier than now
+        """
+        entry = self.backend.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            age = self.clock() - stored_at
+            if age < self.ttl:
+                self.count("hits")
+                return entry
+            if age < self.ttl + self.stale_ttl:
+                self.count("stale_hits")
+                self.revalidate(key, loader)
+                return entry
+
+        self.count("misses")
+        log.info("Covid cache miss for " + key)
+        value = loader()
+        stored_at = self.clock()
+        self.backend.set(key, stored_at, value)
+
+        return stored_at, value
+
+    def is_fresh(self, stored_at):
+        """
+        Returns True if a value fetched from the API at stored_at (None if never)
+            is still within the ttl, counting it as a hit
+        """
+        if stored_at is None or self.clock() - stored_at >= self.ttl:
+            return False
+        self.count("hits")
+
+        return True
+
+    def revalidate(self, key, loader):
+        """
+        Refreshes a stale entry in a background thread (one refresh per key at a time)
+        """
+        with self.lock:
+            if key in self.refreshing:
+                return
+            thread = threading.Thread(target = self.refresh, args = (key, loader), daemon = True)
+            self.refreshing[key] = thread
+
+        thread.start()
+
+    def refresh(self, key, loader):
+        """
+        Fetches a new value for the key, keeping the stale value if the fetch fails
+        """
+        try:
+            value = loader()
+            self.backend.set(key, self.clock(), value)
+            self.count("refreshes")
+        except Exception:
+            self.count("refresh_errors")
+            log.exception("Covid cache refresh failed for " + key)
+        finally:
+            with self.lock:
+                self.refreshing.pop(key, None)
+
+    def wait_for_refreshes(self, timeout = None):
+        """
+        Waits for any background refreshes to finish
+        """
+        with self.lock:
+            threads = list(self.refreshing.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def count(self, counter):
+        """
+        Increases one of the hit/miss counters
+        """
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """
+        Returns the counters and the number of cached entries
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        stats["entries"] = len(self.backend)
+
+        return stats
+
+def cache_key(location, location_type, structure):
+    """
+    Creates the key used for a covid API request
+    """
+    return json.dumps([location, location_type, structure], sort_keys = True)
+
+def create_covid_cache(settings):
+    """
+    Creates the cache described by the "covid_cache" section of the config file
+    The backend can be "memory" or "sqlite"
+    """
+    settings = dict(DEFAULT_CACHE_SETTINGS, **settings)
+    log.info("Creating covid cache with settings {}".format(settings))
+
+    if settings["backend"] == "sqlite":
+        backend = SQLiteCacheBackend(settings["path"], settings["max_entries"])
+    elif settings["backend"] == "memory":
+        backend = MemoryCacheBackend(settings["max_entries"])
+    else:
+        raise ValueError("Unknown covid cache backend: " + settings["backend"])
+
+    return CovidCache(backend, ttl = settings["ttl"], stale_ttl = settings["stale_ttl"])
@@ -8,104 +8,533 @@ This module handles:
 import logging
 
 #importing API and modules to access it
-import json
+import csv
+import datetime
+import threading
 import time
-from uk_covid19 import Cov19API
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+from http import HTTPStatus
+import certifi
+from uk_covid19 import Cov19API as BaseCov19API
+from uk_covid19.exceptions import FailedRequestError
+
+#importing the pooled HTTP session, so covid API requests have a timeout
+from http_client import create_session
+
+#importing the shared configuration
+from config_handler import get_config, locations
+
+#importing the columnar time series used to process the API data
+from covid_time_series import CovidTimeSeries, split_by_area
+
+#importing the csv streaming reader (csv rows are scanned, not stored as columns)
+from covid_time_series import iter_csv_lines, iter_csv_rows, scan_latest_values
+
+#importing the store used for the multi-area dashboard
+from covid_area_store import CovidAreaStore
+
+#importing the rolling aggregates worked out over the stored time series
+from covid_aggregates import get_aggregates
+
+#importing the cache for covid API responses
+from covid_cache import cache_key, create_covid_cache
+
+#importing the data version so cached pages are rendered again after an update
+from page_cache import bump_data_version
+
+#importing the copy-on-write state, so readers always see a whole update of the covid data
+from state import CopyOnWriteState, freeze, thaw
+
+#importing the metrics, so the covid API requests are timed and their bytes counted
+from metrics import timed, upstream_bytes, upstream_errors
 
 #importing from scheduler module to run scheduler function
-from scheduler import get_scheduler
+from scheduler import schedule_job, schedule_job_once
 
-#Setting up logging
-FORMAT = '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s'
+#Setting up logging (configured once at startup, see dashboard_logging.py)
 log = logging.getLogger(__name__)
-logging.basicConfig(filename = 'sys.log', encoding='utf-8', format = FORMAT, level=logging.DEBUG)
 
-#dictionary to contain covid data
-covid_data = {}
+#covid data, published as read-only snapshots which are replaced (never changed) by updates
+covid_state = CopyOnWriteState(freeze({}))
+
+#figures shown until the first covid data update has finished
+PLACEHOLDER_COVID_DATA = freeze({"location_last7days_cases": "Loading", \
+    "nation_last7days_cases": "Loading", \
+    "nation_current_hospital_cases": "National Hospital Cases: Loading", \
+    "nation_total_deaths": "National Total Deaths: Loading"})
+
+#covid data for every area in the multi-area dashboard
+covid_area_store = CovidAreaStore()
+
+#the metrics fetched from the covid API
+CASES_AND_DEATHS = {
+"areaCode": "areaCode",
+"areaName": "areaName",
+"areaType": "areaType",
+"date": "date",
+"cumDailyNsoDeathsByDeathDate": "cumDailyNsoDeathsByDeathDate",
+"hospitalCases": "hospitalCases",
+"newCasesBySpecimenDate": "newCasesBySpecimenDate",
+}
+
+#thread pool used to fetch several areas from the covid API at the same time
+COVID_FETCH_WORKERS = 8
+covid_fetch_executor = ThreadPoolExecutor(max_workers = COVID_FETCH_WORKERS, \
+                                          thread_name_prefix = "covid-fetch")
+
+#thread pool used to request the dates of an incremental update at the same time
+#(separate from covid_fetch_executor, as its workers wait for these requests)
+covid_date_executor = ThreadPoolExecutor(max_workers = COVID_FETCH_WORKERS, \
+                                         thread_name_prefix = "covid-dates")
+
+#fetches submitted to covid_fetch_executor by key, so a fetch still running from an earlier
+#   refresh is waited on again instead of taking another worker
+covid_fetches = {}
+covid_fetches_lock = threading.Lock()
+
+#shared session used for covid API requests, created when first used
+covid_session = None
+
+#bytes received from the covid API
+covid_bytes = upstream_bytes.labels("covid")
+
+class Cov19API(BaseCov19API):
+    """
+    This class is a uk_covid19 Cov19API which requests each page through a shared session
+        with a timeout (covid_request_timeout in the config file)
+    Without one, a request that hangs would keep its covid_fetch_executor worker for ever
+    The bytes of each page are counted in the upstream metrics (when they are enabled)
+    """
+
+    def __init__(self, filters, structure, latest_by = None, timeout = None):
+        super().__init__(filters, structure, latest_by)
+        self.timeout = covid_fetch_settings()[2] if timeout is None else timeout
+
+    def _get(self, format_as):
+        api_params = self.api_params
+        api_params.update({"format": format_as.value, "page": 1})
+        if self.latest_by is not None:
+            del api_params["page"]
+
+        while True:
+            with get_covid_session().get(self.endpoint, params = api_params, \
+                                         verify = certifi.where(), \
+                                             timeout = self.timeout) as response:
+                covid_bytes.inc(len(response.content))
+                if response.status_code >= HTTPStatus.BAD_REQUEST:
+                    raise FailedRequestError(response = response, params = api_params)
+
+                if self.latest_by is not None:
+                    yield response
+                    break
+                if response.status_code == HTTPStatus.NO_CONTENT:
+                    self._total_pages = api_params["page"] - 1
+                    break
+                self._last_update = response.headers["Last-Modified"]
+                yield response
+
+            if self.latest_by is None:
+                api_params["page"] += 1
+
+def get_covid_session():
+    """
+    This function returns the session used for covid API requests (created the first time)
+    """
+
+    global covid_session
+    if covid_session is None:
+        covid_session = create_session(retries = 1, pool_size = COVID_FETCH_WORKERS)
+
+    return covid_session
+
+def submit_covid_fetch(function, *args):
+    """
+    This function runs function(*args) on the covid_fetch_executor thread pool
+    If the same fetch from an earlier refresh is still running (e.g. it timed out),
+        that future is returned instead of starting the fetch again
+    """
+
+    key = (function.__name__,) + tuple(tuple(arg) if isinstance(arg, list) else arg \
+                                       for arg in args)
+    with covid_fetches_lock:
+        future = covid_fetches.get(key)
+        if future is not None and not future.done():
+            log.warning("Covid API request for {} is still running".format(args[0]))
+            return future
+        future = covid_fetch_executor.submit(function, *args)
+        covid_fetches[key] = future
+    future.add_done_callback(lambda done: forget_covid_fetch(key, done))
+
+    return future
+
+def forget_covid_fetch(key, future):
+    """
+    This function removes a finished fetch from covid_fetches
+    """
+
+    with covid_fetches_lock:
+        if covid_fetches.get(key) is future:
+            del covid_fetches[key]
+
+#cache of covid API responses, created from the config file when first used
+covid_cache = None
+
+#Default settings, used for anything missing from the "covid_incremental" section of the config file
+DEFAULT_INCREMENTAL_SETTINGS = {"enabled": True, "overlap_days": 2, "max_gap_days": 7, \
+                                "full_refresh": 86400}
 
 def get_covid_data():
     """
     This function handles fetching the covid data in order for schedules
+    Returns the current snapshot of the covid data (a read-only dictionary)
+    If there is no covid data yet, an update is handed to the scheduler worker and
+        the placeholder figures are returned, so a request never waits for the covid API
     """
 
+    covid_data = covid_state.snapshot()
     if not covid_data:
         nation_location, location = locations()
-        update_covid_data(nation_location = nation_location, location = location)
+        schedule_job_once(update_covid_data, \
+                          kwargs = {"nation_location": nation_location, "location": location})
+        return PLACEHOLDER_COVID_DATA
 
     return covid_data
 
+def publish_covid_data(data):
+    """
+    This function replaces the covid data with a read-only copy of data
+    """
+
+    covid_state.replace(freeze(data))
+    bump_data_version("covid data updated")
+
+def covid_api_payload():
+    """
+    This function returns the covid data for the json API:
+        the dashboard figures and the figures for each area fetched
+    """
+
+    data = get_covid_data()
+
+    return {"dashboard": {key: value for key, value in data.items() if key != "areas"}, \
+            "areas": thaw(data.get("areas", {}))}
+
 def parse_csv_data(csv_filename):
     """
     This function opens the csv file, extracts the data from the file and returns it
+    The lines are streamed from a memory map and the file is closed afterwards
     """
 
     log.info("Function parse_csv_data has opened file csv_filename: " + csv_filename)
-    lines = open(csv_filename, 'r').readlines()
+    lines = list(iter_csv_lines(csv_filename))
 
     return lines
 
+@timed
 def process_covid_csv_data(covid_csv_data):
     """
-    This function is used to iterate through and extract specfic data in the covid_csv_data file
-    As well as also being used in the covid_API_request for formating purposes
+    This function is used to extract specfic data in the covid_csv_data lines (newest first)
+    The lines are read lazily and reading stops once the newest figures have been found
     """
 
-    line_count = 0
-
-    last7days_cases = 0
-    current_hospital_cases = "0"
-    total_deaths = "0"
-    last7days_count = 0
-    last7days_cases_found = False
-
-    total_deaths_found = False
-    current_hospital_cases_found = False
-
-    for line in covid_csv_data:
-        line_count +=1
-
-        item = line.split(",")
-
-        if (not current_hospital_cases_found) and (item[5].isdigit()):
-            current_hospital_cases = int(item[5])
-            current_hospital_cases_found = True
+    last7days_cases, current_hospital_cases, total_deaths = \
+        scan_latest_values(csv.reader(covid_csv_data))
 
-        if last7days_cases_found and (item[6].strip().isdigit()) and (last7days_count < 7):
-            if last7days_cases_found:
-                new_cases_by_specimen_date = item[6].strip()
-                last7days_cases = last7days_cases + int(new_cases_by_specimen_date)
-                last7days_count +=1
-        if (not last7days_cases_found) and (item[6].strip().isdigit()):
-            last7days_cases_found = True
+    return last7days_cases, current_hospital_cases, total_deaths
 
-        if (not total_deaths_found) and (item[4].isdigit()):
-            total_deaths = int(item[4])
-            total_deaths_found = True
+def process_covid_csv_file(csv_filename):
+    """
+    This function streams a csv file and extracts the same data as process_covid_csv_data
+    Only the rows up to the oldest figure needed are read, however big the file is
+    """
 
-    return last7days_cases, current_hospital_cases, total_deaths
+    with closing(iter_csv_rows(csv_filename)) as rows:
+        return scan_latest_values(rows)
 
 def update_covid_data(nation_location = "England", location = "Exeter"):
     """
     This function handles updating the covid data to be used as a global function
         within scheduling any covid data updates
-    Stores covid data into a dictionary
+    The local, national and any extra configured areas are fetched at the same time
+    If an area fails or times out, its previous figures are kept so the rest still update
+    With "areas" in the config file (multi-area mode), there is one query per area type instead
+    Publishes the covid data as a new snapshot
     """
 
-    global covid_data
     log.info("Fetching covid data for both national (" + nation_location + \
              ") and local (" + location + ")")
 
-    ltla_covid_data = covid_API_request(location = location, location_type = "ltla")
-    nation_covid_data = covid_API_request(nation_location, "nation" )
+    extra_locations, configured_areas, request_timeout = covid_fetch_settings()
+    areas = [(location, "ltla"), (nation_location, "nation")] + extra_locations
+
+    if configured_areas:
+        area_covid_data = update_covid_areas(areas_by_type(areas, configured_areas), \
+                                             request_timeout)
+    else:
+        previous_areas = covid_state.snapshot().get("areas", {})
+        area_covid_data = fetch_covid_areas(areas, request_timeout)
+        for area_name, _ in areas:
+            if area_name not in area_covid_data and area_name in previous_areas:
+                log.warning("Keeping previous covid data for " + area_name)
+                area_covid_data[area_name] = previous_areas[area_name]
+
+    unavailable = {"last7days_cases": "Unavailable", "current_hospital_cases": "Unavailable", \
+                   "total_deaths": "Unavailable"}
+    ltla_covid_data = area_covid_data.get(location, unavailable)
+    nation_covid_data = area_covid_data.get(nation_location, unavailable)
 
     nation_current_hospital_cases = "National Hospital Cases: " \
         + str(nation_covid_data["current_hospital_cases"])
     nation_total_deaths = "National Total Deaths: " + str(nation_covid_data["total_deaths"])
 
-    covid_data = {"location_last7days_cases": ltla_covid_data["last7days_cases"], \
-                  "nation_last7days_cases" : nation_covid_data["last7days_cases"], \
-                      "nation_current_hospital_cases" : nation_current_hospital_cases, \
-                          "nation_total_deaths" : nation_total_deaths}
+    publish_covid_data({"location_last7days_cases": ltla_covid_data["last7days_cases"], \
+                        "nation_last7days_cases" : nation_covid_data["last7days_cases"], \
+                            "nation_current_hospital_cases" : nation_current_hospital_cases, \
+                                "nation_total_deaths" : nation_total_deaths, \
+                                    "areas" : area_covid_data})
+
+def fetch_covid_areas(areas, request_timeout = 30):
+    """
+    This function runs covid_API_request for every (location, location_type) in areas
+        at the same time on the covid_fetch_executor thread pool
+    Areas that fail or take longer than request_timeout seconds are logged and left out
+    (each request also has a socket timeout, see Cov19API, so a hung request frees its worker)
+    Returns a dictionary of the results for each location
+    """
+
+    futures = {submit_covid_fetch(covid_API_request, area_name, area_type): area_name \
+               for area_name, area_type in areas}
+    done, not_done = wait(futures, timeout = request_timeout)
+
+    area_covid_data = {}
+    for future in done:
+        area_name = futures[future]
+        try:
+            area_covid_data[area_name] = future.result()
+        except Exception:
+            log.exception("Covid API request failed for " + area_name)
+
+    for future in not_done:
+        future.cancel()
+        log.warning("Covid API request timed out for " + futures[future])
+
+    return area_covid_data
+
+def update_covid_areas(areas, request_timeout = 30):
+    """
+    This function updates the multi-area store with one covid API query per area type
+    areas is a dictionary of area type to a list of area names, e.g. {"ltla": ["Exeter"]}
+    Area types that fail or time out keep their previous data in the store
+    Returns the figures for all of the areas requested
+    """
+
+    futures = {submit_covid_fetch(covid_area_type_request, area_type, area_names): \
+               area_type for area_type, area_names in areas.items()}
+    done, not_done = wait(futures, timeout = request_timeout)
+
+    for future in done:
+        try:
+            future.result()
+        except Exception:
+            log.exception("Covid API request failed for area type " + futures[future])
+
+    for future in not_done:
+        future.cancel()
+        log.warning("Covid API request timed out for area type " + futures[future])
+
+    return covid_area_store.get_summaries([area_name for area_names in areas.values() \
+                                           for area_name in area_names])
+
+@timed
+def covid_area_type_request(area_type, area_names):
+    """
+    This function makes a single covid API request for every area of one type
+        and stores a CovidTimeSeries for each of the area_names found
+    Once the areas are stored, only the dates after the oldest of their newest dates
+        are requested (see incremental_dates), and nothing is requested while every area
+        was fetched within the covid cache ttl
+    Returns the time series fetched (or stored) for each area
+    """
+
+    cache = get_covid_cache()
+    fetch_times = [covid_area_store.fetched_at(area_name) for area_name in area_names]
+    if all(fetch_time is not None for fetch_time in fetch_times) and \
+            cache.is_fresh(min(fetch_times)):
+        log.info("Covid data for area type " + area_type + " fetched within the cache ttl")
+        return {area_name: covid_area_store.get_time_series(area_name) \
+                for area_name in area_names}
+
+    latest_dates = [covid_area_store.latest_date(area_name) for area_name in area_names]
+    refresh_times = [covid_area_store.refreshed_at(area_name) for area_name in area_names]
+    dates = None
+    if all(latest_date is not None for latest_date in latest_dates) and \
+            all(refresh_time is not None for refresh_time in refresh_times):
+        dates = incremental_dates(min(latest_dates), min(refresh_times), incremental_settings())
+
+    if dates is not None:
+        log.info("Requesting {} dates for area type {} ({} areas)".format(len(dates), \
+                 area_type, len(area_names)))
+        fetched_at = cache.clock()
+        rows = request_covid_dates(['areaType=' + area_type], dates)
+        time_series_by_area = split_by_area(rows, area_type, area_names)
+        covid_area_store.merge(time_series_by_area)
+        covid_area_store.set_fetched_at(area_names, fetched_at)
+        return time_series_by_area
+
+    log.info("Making a covid API request for area type " + area_type + \
+             " ({} areas)".format(len(area_names)))
+    api = Cov19API(filters=['areaType=' + area_type], structure=CASES_AND_DEATHS)
+
+    fetched_at, data = cache.get_entry(cache_key("", area_type, CASES_AND_DEATHS), \
+                                       lambda: covid_api_get_json(api))
+
+    time_series_by_area = split_by_area(data["data"], area_type, area_names)
+    covid_area_store.update(time_series_by_area, refreshed_at = fetched_at)
+
+    return time_series_by_area
+
+def areas_by_type(areas, configured_areas):
+    """
+    This function groups (location, location_type) pairs and the "areas" config section
+        into a dictionary of area type to a list of area names without duplicates
+    """
+
+    grouped = {area_type: list(area_names) for area_type, area_names in configured_areas.items()}
+    for area_name, area_type in areas:
+        area_names = grouped.setdefault(area_type, [])
+        if area_name not in area_names:
+            area_names.append(area_name)
+
+    return grouped
+
+def get_area_covid_data(area_names = None):
+    """
+    This function returns the figures for any subset of the areas already fetched
+    No API requests are made
+    """
+
+    areas = covid_state.snapshot().get("areas", {})
+    if area_names is None:
+        return dict(areas)
+
+    return {area_name: areas[area_name] for area_name in area_names if area_name in areas}
+
+def get_area_aggregates(area_name):
+    """
+    This function returns the RollingAggregates for an area already fetched,
+        or None if there is no data for it
+    No API requests are made
+    """
+
+    time_series = covid_area_store.get_time_series(area_name)
+    if time_series is None:
+        return None
+
+    return get_aggregates(time_series)
+
+def area_population(area_name):
+    """
+    This function returns the population of an area from the "populations" section
+        of the config file, or None if it is not set
+    """
+
+    return get_config().get("populations", {}).get(area_name)
+
+def dashboard_area_names():
+    """
+    This function returns the names of the areas in the "areas" section of the config file
+        which are shown on the dashboard by default (an empty list if it is not set)
+    """
+
+    _, configured_areas, _ = covid_fetch_settings()
+
+    return [area_name for area_names in configured_areas.values() for area_name in area_names]
+
+def covid_fetch_settings():
+    """
+    This function extracts the extra areas, the multi-area "areas" section
+        and the request timeout from the configuration file
+    extra_locations is a list of {"location": ..., "location_type": ...} dictionaries
+    areas is a dictionary of area type to a list of area names
+    """
+
+    config_dict = get_config()
+    extra_locations = [(extra["location"], extra["location_type"]) \
+                       for extra in config_dict.get("extra_locations", [])]
+    configured_areas = config_dict.get("areas", {})
+    request_timeout = config_dict.get("covid_request_timeout", 30)
+
+    return extra_locations, configured_areas, request_timeout
+
+def incremental_settings():
+    """
+    This function returns the "covid_incremental" section of the config file
+        with the defaults for anything missing
+    """
+
+    return dict(DEFAULT_INCREMENTAL_SETTINGS, **get_config().get("covid_incremental", {}))
+
+def incremental_dates(latest_date, refreshed_at, settings, now = None, today = None):
+    """
+    This function works out the dates to request for an incremental update of an area
+        whose newest stored date is latest_date and whose full history was fetched at refreshed_at
+    The last overlap_days stored dates are requested again, as their figures are still revised
+    Returns a list of dates (YYYY-MM-DD), or None when the full history should be fetched:
+        incremental updates are turned off, the full history is older than full_refresh
+        seconds, or more than max_gap_days days are missing
+    """
+
+    now = time.time() if now is None else now
+    today = datetime.date.today() if today is None else today
+    if not settings["enabled"] or now - refreshed_at >= settings["full_refresh"]:
+        return None
+
+    latest = latest_date.astype(datetime.date)
+    if (today - latest).days > settings["max_gap_days"]:
+        return None
+
+    first = latest - datetime.timedelta(days = settings["overlap_days"] - 1)
+
+    return [(first + datetime.timedelta(days = day)).isoformat() \
+            for day in range((today - first).days + 1)]
+
+def request_covid_dates(filters, dates):
+    """
+    This function requests the rows for each of the dates (a few rows per date instead of
+        the whole history) at the same time on covid_date_executor and returns them together
+    If any of the dates fails, its error is raised
+    """
+
+    futures = [covid_date_executor.submit(request_covid_date, filters, date) for date in dates]
+
+    rows = []
+    for future in futures:
+        rows.extend(future.result())
+
+    return rows
+
+def request_covid_date(filters, date):
+    """
+    This function requests the rows for one date
+    """
+
+    api = Cov19API(filters = filters + ['date=' + date], structure = CASES_AND_DEATHS)
+
+    return covid_api_get_json(api)["data"]
+
+def covid_api_get_json(api):
+    """
+    This function makes a Cov19API request and returns its json
+    Any failed requests are counted in the upstream metrics
+        (the bytes received are counted by Cov19API as each page arrives)
+    """
+
+    try:
+        return api.get_json()
+    except Exception:
+        upstream_errors.labels("covid").inc()
+        raise
 
 def update_covid_data_if_not_present(nation_location = "England", location = "Exeter"):
     """
@@ -113,14 +542,18 @@ def update_covid_data_if_not_present(nation_location = "England", location = "Ex
         by using the update_covid_data function
     """
 
-    if not covid_data:
+    if not covid_state.snapshot():
         update_covid_data(nation_location = "England", location = "Exeter")
 
+@timed
 def covid_API_request(location = "Exeter", location_type = "ltla"):
     """
     This function uses the uk_covid19 module and the API key from it
         to extract live data to be displayed on the flask interface
-    It also formats what order the data must be fetched in to be stored in a dictionary
+    The json rows are loaded straight into a CovidTimeSeries, kept in the covid_area_store
+        and summarised in a dictionary
+    Once an area is stored only its newest dates are requested (see incremental_dates),
+        and nothing is requested while the area was fetched within the covid cache ttl
     """
 
     log.info("Making a covid API request"  + location + ", type=" + location_type)
@@ -130,37 +563,48 @@ def covid_API_request(location = "Exeter", location_type = "ltla"):
     ]
     log.info("Location name fetched: " + location + ", location type fetched: " + location_type)
 
-    cases_and_deaths = {
-    "areaCode": "areaCode",
-    "areaName": "areaName",
-    "areaType": "areaType",
-    "date": "date",
-    "cumDailyNsoDeathsByDeathDate": "cumDailyNsoDeathsByDeathDate",
-    "hospitalCases": "hospitalCases",
-    "newCasesBySpecimenDate": "newCasesBySpecimenDate",
-    }
+    cache = get_covid_cache()
+    if cache.is_fresh(covid_area_store.fetched_at(location)):
+        log.info("Covid data for " + location + " fetched within the cache ttl")
+        return covid_area_store.get_summaries([location])[location]
 
-    api = Cov19API(filters=location_filter, structure=cases_and_deaths)
+    refreshed_at = covid_area_store.refreshed_at(location)
+    dates = None
+    if refreshed_at is not None and covid_area_store.latest_date(location) is not None:
+        dates = incremental_dates(covid_area_store.latest_date(location), refreshed_at, \
+                                  incremental_settings())
 
-    data = api.get_json()
+    if dates is not None:
+        log.info("Requesting {} dates for {}".format(len(dates), location))
+        fetched_at = cache.clock()
+        rows = request_covid_dates(location_filter, dates)
+        covid_area_store.merge({location: CovidTimeSeries.from_api_json(rows, \
+            area_name = location, area_type = location_type)})
+        covid_area_store.set_fetched_at([location], fetched_at)
+        return covid_area_store.get_summaries([location])[location]
 
-    csv_lines =[]
+    api = Cov19API(filters=location_filter, structure=CASES_AND_DEATHS)
 
-    """ Structuring data into lines to be read easily """
-    for line in data["data"]:
-        #areaCode,areaName,areaType,date,cumDailyNsoDeathsByDeathDate,
-            #hospitalCases,newCasesBySpecimenDate
-        csv_line = line["areaCode"] + "," + location + "," + location_type + \
-            "," + line["date"] + "," + optional_value(line["cumDailyNsoDeathsByDeathDate"]) \
-                + "," + optional_value(line["hospitalCases"]) + "," + \
-                    optional_value(line["newCasesBySpecimenDate"]) + "\n"
-        csv_lines.append(csv_line)
+    fetched_at, data = cache.get_entry(cache_key(location, location_type, CASES_AND_DEATHS), \
+                                       lambda: covid_api_get_json(api))
 
-    last7days_cases, current_hospital_cases, total_deaths = \
-        process_covid_csv_data(csv_lines)
+    time_series = CovidTimeSeries.from_api_json(data["data"], \
+                                                area_name = location, area_type = location_type)
+    covid_area_store.update({location: time_series}, refreshed_at = fetched_at)
+
+    return covid_area_store.get_summaries([location])[location]
+
+def get_covid_cache():
+    """
+    This function returns the cache used by covid_API_request
+    The cache is set up from the "covid_cache" section of the config file the first time
+    """
 
-    return {"last7days_cases": last7days_cases, "current_hospital_cases" \
-            : current_hospital_cases, "total_deaths": total_deaths}
+    global covid_cache
+    if covid_cache is None:
+        covid_cache = create_covid_cache(get_config().get("covid_cache", {}))
+
+    return covid_cache
 
 def optional_value(data):
     """
@@ -184,24 +628,9 @@ def schedule_covid_updates(update_interval, update_name):
 
     nation_location, location = locations()
 
-    scheduler = get_scheduler()
-    event = scheduler.enter(update_interval, 1, update_covid_data,\
+    event = schedule_job(update_interval, update_covid_data,\
                 kwargs = {"nation_location":nation_location, "location":location})
 
     log.info("Event for {} added to scheduler {}".format(update_name, event))
 
     return event
-
-def locations():
-    """
-    This function extracts data from the configuration file to set up
-        the national_location and location variable
-    This will help set up the locations for data to be pulled from the API
-    """
-
-    f = open('config.json',)
-    config_dict = json.load(f)
-    nation_location = config_dict["nation_location"]
-    location = config_dict["location"]
-
-    return nation_location, location
@@ -1,6 +1,7 @@
 """
 This module handles:
     - fetching news from the news API addres
+    - fetching several queries and countries at the same time and merging them
     - scheduled news updates
 """
 
@@ -8,79 +9,287 @@ This module handles:
 import logging
 
 #Importing modules
-import json
 import re
-import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from urllib.parse import quote
+
+#Importing the shared configuration
+from config_handler import get_config
+
+#Importing the pooled HTTP client, which makes conditional requests to the news API
+from http_client import create_client, create_rate_limiter
+
+#Importing the metrics, so the news API requests are timed
+from metrics import timed
+
+#Importing the copy-on-write state, so readers always see a whole change to the news
+from state import CopyOnWriteState
+
+#Importing the seen articles filter, saved so dismissed news stays hidden after a restart
+from seen_articles import DelayedSave, load_seen_articles, seen_articles_settings
+
+#Importing the data version so cached pages are rendered again after an update
+from page_cache import bump_data_version
 
 #Importing scheduler module to schedule news updates
-from scheduler import get_scheduler
+from scheduler import schedule_job, schedule_job_once
 
-#Setting up logging
-FORMAT = '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s'
+#Setting up logging (configured once at startup, see dashboard_logging.py)
 log = logging.getLogger(__name__)
-logging.basicConfig(filename = 'sys.log', encoding='utf-8', format = FORMAT, level=logging.DEBUG)
 
-#A list of current news articles to be displayed on the dashboard
-news_articles = []
+class NewsArticleStore:
+    """
+    This class holds the news articles to be displayed on the dashboard in an
+        ordered dictionary keyed by title (kept in display order)
+    The titles of news articles marked as "seen" are kept in seen_titles, a set or
+        a SeenArticles (Bloom filter) which holds them in a fixed amount of memory
+    Checking for an article does not depend on how many there are
+    The articles are published as read-only snapshots (copy-on-write): iterating never
+        blocks or sees half of a change, and changes (including to seen_titles)
+        are made one at a time
+    """
+
+    def __init__(self, seen_titles = None):
+        self.state = CopyOnWriteState(MappingProxyType(OrderedDict()))
+        self.seen_titles = seen_titles if seen_titles is not None else set()
+
+    @property
+    def articles(self):
+        """
+        The current snapshot of the articles, a read-only dictionary keyed by title
+        """
+        return self.state.snapshot()
+
+    def add_new(self, candidate_articles):
+        """
+        Adds the articles that are not seen or already present
+        Returns the list of articles added
+        """
+        new_news = []
+
+        def add(articles):
+            added = OrderedDict(articles)
+            for news_article in candidate_articles:
+                title = news_article['title']
+                if title not in self.seen_titles and title not in added:
+                    added[title] = news_article
+                    new_news.append(news_article)
+            return MappingProxyType(added) if new_news else articles
+
+        self.state.update(add)
+
+        return new_news
+
+    def mark_seen(self, title):
+        """
+        Marks a title as seen and removes its article
+        Returns True if an article was removed
+        """
+        removed = []
+
+        def remove(articles):
+            self.seen_titles.add(title)
+            if title not in articles:
+                return articles
+            removed.append(title)
+            remaining = OrderedDict(articles)
+            del remaining[title]
+            return MappingProxyType(remaining)
 
-#A list of news articles titles that have been marked as "seen"
-seen_news_articles = []
+        self.state.update(remove)
+
+        return bool(removed)
+
+    def is_seen(self, title):
+        """
+        Returns True if the title has been marked as seen
+        """
+        return title in self.seen_titles
+
+    def save_seen(self):
+        """
+        Saves the seen titles: they are copied while no other change is being made,
+            then written to the file without holding up other changes
+        """
+        copies = []
+
+        def copy(articles):
+            copies.append(self.seen_titles.to_bytes())
+            return articles
+
+        self.state.update(copy)
+        self.seen_titles.save(data = copies[0])
+
+    def sort_by_published(self):
+        """
+        Puts the articles in display order with the most recently published first
+        Articles without a publish time go last
+        """
+        def rank(articles):
+            ranked = sorted(articles.values(), \
+                            key = lambda news_article: news_article.get('publishedAt') or "", \
+                            reverse = True)
+            return MappingProxyType(OrderedDict((news_article['title'], news_article) \
+                                                for news_article in ranked))
+
+        self.state.update(rank)
+
+    def clear(self):
+        """
+        Removes all of the articles (the seen titles are kept)
+        """
+        self.state.replace(MappingProxyType(OrderedDict()))
+
+    def __iter__(self):
+        return iter(self.state.snapshot().values())
+
+    def __len__(self):
+        return len(self.state.snapshot())
+
+#The current news articles to be displayed on the dashboard
+#and the titles of the news articles that have been marked as "seen" (loaded from disk)
+news_articles = NewsArticleStore(load_seen_articles(get_config().get("seen_articles", {})))
+
+#Saves the seen titles in the background, at most once every save_delay seconds
+seen_articles_saver = DelayedSave(lambda: news_articles.save_seen(), \
+    seen_articles_settings(get_config().get("seen_articles", {}))["save_delay"])
+
+#HTTP client for the news API, set up when it is first used
+news_client = None
+
+#Rate limiter shared by every news API request, set up when it is first used
+news_rate_limiter = None
+
+#Thread pool used to fetch the news queries and countries at the same time
+news_fetch_executor = ThreadPoolExecutor(max_workers = 4, thread_name_prefix = "news-fetch")
 
 def get_news_articles():
     """
     Process checks the length of news articles, so that if less than 1
-    program updates the news articles so that news is present
+    a news update is handed to the scheduler worker (the request does not wait for it)
+    Returns a list of the news articles in display order
     """
     if len(news_articles) <1:
-        update_news()
+        schedule_job_once(update_news)
+
+    return list(news_articles)
 
-    return news_articles
+def news_api_payload():
+    """
+    Returns the news articles for the json API, keyed by title in display order
+    """
+    return {"articles": {news_article['title']: news_article \
+                         for news_article in get_news_articles()}}
 
 def add_seen_news_article(seen_article):
     """
-    Adding news articles that have been seen to the dictionary of
-    seen new articles
+    Adding news articles that have been seen to the set of
+    seen new articles and removing the article
     """
     log.info("Adding new seen article "+ seen_article)
-    seen_news_articles.append(seen_article)
 
-    global news_articles
-    news_articles = [news_article for news_article in news_articles \
-                     if news_article['title'] != seen_article]
+    if news_articles.mark_seen(seen_article):
+        bump_data_version("news article removed")
 
-def news_API_request(covid_terms = "Covid COVID-19 coronavirus"):
+    seen_articles_saver.request_save()
+
+@timed
+def news_API_request(covid_terms = "Covid COVID-19 coronavirus", country = "gb"):
     """
     Fetches API key from config file
     Searches for search terms for news articles
     """
-    f = open('config.json',)
-    config_dict = json.load(f)
+    config_dict = get_config()
     base_url = "https://newsapi.org/v2/top-headlines?"
     api_key = config_dict["covid_news_api_key"]
 
     search = create_search_query_term(covid_terms)
-    country = "gb"
     complete_url = base_url + search + "country=" + country + "&apiKey=" + api_key
     log.info(search)
-    response = requests.get(complete_url)
 
-    return response.json()
+    return get_news_client().get_json(complete_url)
+
+def get_news_client():
+    """
+    This function returns the HTTP client used by news_API_request
+    The client is set up from the "news_http" section of the config file the first time
+    """
+
+    global news_client
+    if news_client is None:
+        news_client = create_client(get_config().get("news_http", {}), api = "news")
+
+    return news_client
+
+def get_news_rate_limiter():
+    """
+    This function returns the rate limiter used by fetch_news
+    The rate limiter is set up from the "news_rate_limit" section of the config file the first time
+    """
+
+    global news_rate_limiter
+    if news_rate_limiter is None:
+        news_rate_limiter = create_rate_limiter(get_config().get("news_rate_limit", {}))
+
+    return news_rate_limiter
+
+def rate_limited_news_request(query, country):
+    """
+    Makes one news API request once the rate limiter allows it
+    """
+    get_news_rate_limiter().acquire()
+
+    return news_API_request(covid_terms = query, country = country)
+
+def fetch_news(queries, countries):
+    """
+    Fetches every query for every country at the same time on the news_fetch_executor
+    Returns the list of articles from each request that succeeded
+    A request that fails is logged and left out, so the other results are still used
+    """
+    futures = [(query, country, news_fetch_executor.submit(rate_limited_news_request, \
+                                                           query, country)) \
+               for query in queries for country in countries]
+
+    results = []
+    for query, country, future in futures:
+        try:
+            news_result = future.result()
+        except Exception:
+            log.exception("Could not fetch news for " + query + " in " + country)
+            continue
+        if "articles" not in news_result:
+            log.error("News API error for " + query + " in " + country + ": " \
+                      + str(news_result.get("message")))
+            continue
+        results.append(news_result["articles"])
+
+    return results
+
+def merge_news(results):
+    """
+    Merges the articles from several requests, keeping the first article with each title,
+        with the most recently published first
+    """
+    merged = OrderedDict()
+    for articles in results:
+        for news_article in articles:
+            merged.setdefault(news_article['title'], news_article)
+
+    return sorted(merged.values(), \
+                  key = lambda news_article: news_article.get('publishedAt') or "", \
+                  reverse = True)
 
 def create_search_query_term(covid_terms):
     """
     Querying the news to be in English and search covid terms
+    The words are joined with OR, so articles matching any of them are found
     """
-    search_query_term = "language=en&q="
     # change the covid terms to lower case and then split them into a list of words
-    words = re.split('\s+', covid_terms.lower())
-    first_word = True
-    for word in words:
-        if first_word:
-            first_word = False
-        else:
-            search_query_term = search_query_term + "&"
-
-        search_query_term = search_query_term + word
+    words = re.split(r'\s+', covid_terms.lower().strip())
+    search_query_term = "language=en&q=" + quote(" OR ".join(words)) + "&"
 
     return search_query_term
 
@@ -90,35 +299,44 @@ def covid_terms():
     """
     return "Covid COVID-19 coronavirus"
 
+def news_queries():
+    """
+    This function returns the queries and countries to fetch news for
+    They are taken from the config file, by default the covid terms in the UK
+    """
+    config_dict = get_config()
+
+    return config_dict.get("news_queries", [covid_terms()]), \
+        config_dict.get("news_countries", ["gb"])
+
 def find_new_news(excluding_seen_news, existing_news):
     """
     Finds new news from the API that is not currently in the list
     """
 
-    # https://stackoverflow.com/questions/7271482/getting-a-list-of-values-from-a-list-of-dicts
-    existing_news_titles = list(map(lambda d: d['title'], existing_news) )
+    existing_news_titles = {news_article['title'] for news_article in existing_news}
 
     return [news_article for news_article in excluding_seen_news if \
-            news_article['title'] not in  existing_news_titles]
+            news_article['title'] not in existing_news_titles]
 
 def update_news(id="update-id"):
     """
     Process to update news artciles and finds new news articles
-    Checks with function excluding_seen_news to know which news to filter out
+    Every configured query and country is fetched, and the results are merged
+    The news article store filters out seen news and news already present
     """
     log.info("News is being updated")
 
-    news_result = news_API_request(covid_terms = covid_terms())
-    current_news_articles = news_result["articles"]
-
-    excluding_seen_news = [news_article for news_article in current_news_articles \
-                           if news_article['title'] not in seen_news_articles]
+    queries, countries = news_queries()
+    current_news_articles = merge_news(fetch_news(queries, countries))
 
-    new_news = find_new_news(excluding_seen_news, news_articles)
+    new_news = news_articles.add_new(current_news_articles)
 
     log.info("Adding {} new news articles".format(len(new_news)))
 
-    news_articles.extend(new_news)
+    if new_news:
+        news_articles.sort_by_published()
+        bump_data_version("news articles added")
 
 def schedule_update_news(update_interval, update_name):
     """
@@ -126,8 +344,7 @@ def schedule_update_news(update_interval, update_name):
     This function works with the scheduler module and takes the time of the
         update, a name and whether it is to be repeated or not
     """
-    scheduler = get_scheduler()
-    event = scheduler.enter(update_interval, 1, update_news)
+    event = schedule_job(update_interval, update_news)
 
     log.info("News update event for {} added to scheduler {}".format(update_name, event))
 
@@ -2,6 +2,20 @@
 This module handles the testing of the scheduling and the covid data and new handling modules
 """
 
+#Importing modules
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo
+import pytest
+import requests
+
 #importing handler module functions
 from covid_data_handler import parse_csv_data
 from covid_data_handler import process_covid_csv_data
@@ -9,6 +23,64 @@ from covid_data_handler import covid_API_request
 from covid_data_handler import schedule_covid_updates
 from covid_data_handler import get_covid_data
 from covid_data_handler import optional_value
+from covid_data_handler import process_covid_csv_file
+
+#importing the covid time series
+from covid_time_series import CovidTimeSeries
+
+#importing the rolling aggregates
+from covid_aggregates import RollingAggregates
+
+#importing the covid data handler module to replace its API requests in tests
+import covid_data_handler
+
+#importing the covid API cache
+from covid_cache import CovidCache, MemoryCacheBackend, SQLiteCacheBackend
+
+#importing the shared configuration
+from config_handler import Config
+
+#importing the scheduler worker and the updates_scheduled store
+from scheduler import schedule_job, start_scheduler_worker, stop_scheduler_worker
+from scheduler import ScheduledUpdate, UpdatesScheduledStore
+import scheduler
+
+#importing the time arithmetic of update times
+from schedule_time import ScheduleClock, second_of_day
+
+#importing the single flight calls used to coalesce duplicate jobs
+from single_flight import SingleFlight
+
+#importing the updates_scheduled journal
+from scheduler_journal import UpdatesJournal
+
+#importing the seen articles filter
+from seen_articles import SeenArticles
+
+#importing the logging pipeline
+from dashboard_logging import BatchRotatingFileHandler, DroppingQueueHandler, LogWriter
+from dashboard_logging import DumpSampler
+
+#importing the metrics
+import metrics
+
+#importing the offline covid and news API fakes
+from upstream_fakes import offline_upstreams
+
+#importing the copy-on-write state
+from state import CopyOnWriteState, freeze
+
+#importing the page cache
+from page_cache import PageCache, bump_data_version, get_data_version
+
+#importing the load test report
+from load_test import latency_summary
+
+#importing the json API payloads
+from dashboard_api import ApiPayloadCache, StreamLimiter, event_stream, limited_stream
+
+#importing the pooled HTTP client
+from http_client import ConditionalGetClient, RateLimiter, create_session
 
 #importing news handling module functions
 from covid_news_handling import get_news_articles
@@ -18,6 +90,9 @@ from covid_news_handling import create_search_query_term
 from covid_news_handling import schedule_update_news
 from covid_news_handling import news_API_request
 from covid_news_handling import update_news
+from covid_news_handling import NewsArticleStore
+from covid_news_handling import fetch_news, merge_news
+import covid_news_handling
 
 
 # Covid Data Update tests
@@ -33,6 +108,871 @@ def test_process_covid_csv_data():
     assert current_hospital_cases == 7_019
     assert total_deaths == 141_544
 
+def test_process_covid_csv_file():
+    """
+    This test checks that streaming the csv file gives the same figures
+    """
+    assert process_covid_csv_file('nation_2021-10-28.csv') == (240_299, 7_019, 141_544)
+
+def test_process_covid_csv_data_stops_early():
+    """
+    This test checks that no lines are read after the newest figures are found
+    """
+    def lines():
+        yield "E1,Area,ltla,2021-10-09,5,3,\n"
+        for day in range(8, 0, -1):
+            yield "E1,Area,ltla,2021-10-0" + str(day) + ",4,2," + str(day) + "\n"
+        raise AssertionError("read past the newest figures")
+
+    assert process_covid_csv_data(lines()) == (7 + 6 + 5 + 4 + 3 + 2 + 1, 3, 5)
+
+def test_time_series_matches_csv_scan():
+    """
+    This test checks the columnar time series gives the same figures as process_covid_csv_data
+    """
+    rows = [row.strip().split(",") for row in parse_csv_data('nation_2021-10-28.csv')[1:]]
+    api_rows = [{"date": row[3], \
+                 "cumDailyNsoDeathsByDeathDate": int(row[4]) if row[4] else None, \
+                 "hospitalCases": int(row[5]) if row[5] else None, \
+                 "newCasesBySpecimenDate": int(row[6]) if row[6] else None} for row in rows]
+    summary = CovidTimeSeries.from_api_json(api_rows).summary()
+    assert summary == {"last7days_cases": 240_299, "current_hospital_cases": 7_019, \
+                       "total_deaths": 141_544}
+
+def test_time_series_from_api_json():
+    """
+    This test checks that missing values in the API json are skipped
+    """
+    rows = [{"date": "2021-10-0" + str(day), "cumDailyNsoDeathsByDeathDate": None, \
+             "hospitalCases": None if day == 9 else day, "newCasesBySpecimenDate": day * 10} \
+            for day in range(9, 0, -1)]
+    time_series = CovidTimeSeries.from_api_json(rows)
+    assert time_series.last7days_cases() == 80 + 70 + 60 + 50 + 40 + 30 + 20
+    assert time_series.current_hospital_cases() == 8
+    assert time_series.total_deaths() == 0
+
+def test_rolling_aggregates():
+    """
+    This test checks the rolling sums, means, week-over-week change, rate and peaks
+        against the values worked out directly
+    """
+    cases = [10, 20, 30, 40, 50, 40, 30, 20, 10, 0, 10, 20, 30, 40, 80, 40, 20, 10]
+    rows = [{"date": str(datetime.date(2021, 10, 1) + datetime.timedelta(days = day)), \
+             "cumDailyNsoDeathsByDeathDate": None, "hospitalCases": None if day == 16 else day, \
+             "newCasesBySpecimenDate": value} for day, value in enumerate(cases)]
+    aggregates = RollingAggregates(CovidTimeSeries.from_api_json(rows[::-1], "Exeter", "ltla"))
+
+    assert len(aggregates) == 18
+    assert aggregates.rolling_sum("new_cases", 7) == sum(cases[-7:])
+    assert aggregates.rolling_sum("new_cases", 3, aggregates.day("2021-10-05")) == 30 + 40 + 50
+    assert aggregates.rolling_mean("hospital_cases", 3) == (15 + 17) / 2
+    assert aggregates.week_over_week("new_cases") == (sum(cases[-7:]) - sum(cases[-14:-7])) \
+        / sum(cases[-14:-7])
+    assert aggregates.per_100k("new_cases", 7, 200_000) == sum(cases[-7:]) / 2
+    assert aggregates.peaks("new_cases", days = 1, min_distance = 3) == \
+        [("2021-10-15", 80), ("2021-10-05", 50)]
+
+def test_rolling_aggregates_report_of_empty_series():
+    """
+    This test checks the report of a series with no rows raises ValueError
+    """
+    aggregates = RollingAggregates(CovidTimeSeries.from_api_json([], "Exeter", "ltla"))
+    assert len(aggregates) == 0
+    with pytest.raises(ValueError):
+        aggregates.report("new_cases")
+
+def test_covid_cache_ttl_and_stale_while_revalidate():
+    """
+    This test checks fresh entries are hits and stale entries are returned
+        straight away while being refreshed in the background
+    """
+    now = [1000.0]
+    loads = []
+    def loader():
+        loads.append(now[0])
+        return {"data": len(loads)}
+
+    cache = CovidCache(MemoryCacheBackend(), ttl = 60, stale_ttl = 600, clock = lambda: now[0])
+    assert cache.get("key", loader) == {"data": 1}
+    assert cache.get("key", loader) == {"data": 1}
+    now[0] += 120
+    assert cache.get("key", loader) == {"data": 1}
+    cache.wait_for_refreshes()
+    assert cache.get("key", loader) == {"data": 2}
+    now[0] += 1000
+    assert cache.get("key", loader) == {"data": 3}
+    stats = cache.stats()
+    assert (stats["hits"], stats["stale_hits"], stats["misses"]) == (2, 1, 2)
+
+def test_covid_cache_lru_eviction():
+    """
+    This test checks the least recently used entry is evicted
+    """
+    backend = MemoryCacheBackend(max_entries = 2)
+    backend.set("a", 0, 1)
+    backend.set("b", 0, 2)
+    backend.get("a")
+    backend.set("c", 0, 3)
+    assert backend.get("b") is None
+    assert backend.get("a") == (0, 1)
+
+def test_covid_cache_sqlite_is_warm_after_restart(tmp_path):
+    """
+    This test checks the SQLite backend keeps entries between instances
+    """
+    path = str(tmp_path / "cache.sqlite3")
+    SQLiteCacheBackend(path).set("key", 5.0, {"data": [1, 2]})
+    assert SQLiteCacheBackend(path).get("key") == (5.0, {"data": [1, 2]})
+
+def test_update_covid_data_keeps_previous_area_on_failure(monkeypatch):
+    """
+    This test checks that when one area fails, the other areas still update
+        and the failed area keeps its previous figures
+    """
+    def fake_covid_API_request(location, location_type):
+        if location == "England" and covid_data_handler.covid_state.snapshot():
+            raise ConnectionError("national request failed")
+        return {"last7days_cases": len(covid_data_handler.covid_state.snapshot()) + 1, \
+                "current_hospital_cases": 2, "total_deaths": 3}
+
+    monkeypatch.setattr(covid_data_handler, "covid_API_request", fake_covid_API_request)
+    monkeypatch.setattr(covid_data_handler, "covid_state", CopyOnWriteState(freeze({})))
+    covid_data_handler.update_covid_data("England", "Exeter")
+    covid_data_handler.update_covid_data("England", "Exeter")
+
+    covid_data = covid_data_handler.covid_state.snapshot()
+    assert covid_data["location_last7days_cases"] == 6
+    assert covid_data["nation_last7days_cases"] == 1
+    assert covid_data["nation_total_deaths"] == "National Total Deaths: 3"
+
+def test_update_covid_areas_one_query_per_area_type(monkeypatch):
+    """
+    This test checks the multi-area mode makes one API query per area type
+        and any subset of areas can be read back without more queries
+    """
+    queries = []
+    class FakeCov19API:
+        def __init__(self, filters, structure):
+            queries.append(filters)
+            self.area_type = filters[0].split("=")[1]
+        def get_json(self):
+            names = ["England", "Wales"] if self.area_type == "nation" else \
+                ["Exeter", "Plymouth", "Leeds"]
+            return {"data": [{"areaName": name, "date": "2021-10-0" + str(day), \
+                    "cumDailyNsoDeathsByDeathDate": index, "hospitalCases": index, \
+                    "newCasesBySpecimenDate": 1} for index, name in enumerate(names) \
+                    for day in range(9, 0, -1)]}
+
+    monkeypatch.setattr(covid_data_handler, "Cov19API", FakeCov19API)
+    monkeypatch.setattr(covid_data_handler, "covid_cache", \
+                        CovidCache(MemoryCacheBackend(), ttl = 0, stale_ttl = 0))
+    monkeypatch.setattr(covid_data_handler, "covid_area_store", covid_data_handler.CovidAreaStore())
+    areas = covid_data_handler.update_covid_areas({"ltla": ["Exeter", "Plymouth"], \
+                                                   "nation": ["England"]})
+
+    assert sorted(queries) == [["areaType=ltla"], ["areaType=nation"]]
+    assert list(areas) == ["Exeter", "Plymouth", "England"]
+    assert areas["Plymouth"]["total_deaths"] == 1
+    assert areas["Exeter"]["last7days_cases"] == 7
+
+def test_covid_API_request_times_out_and_frees_worker(monkeypatch):
+    """
+    This test checks a covid API request that hangs fails after its timeout,
+        and a fetch still running is waited on again instead of being started twice
+    """
+    release = threading.Event()
+
+    class HangingCovidHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            release.wait(5)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HangingCovidHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    monkeypatch.setattr(covid_data_handler.Cov19API, "endpoint", \
+                        "http://127.0.0.1:{}/v1/data".format(server.server_port))
+    monkeypatch.setattr(covid_data_handler, "covid_session", create_session(retries = 0))
+    try:
+        api = covid_data_handler.Cov19API(['areaType=nation'], {"date": "date"}, timeout = 0.2)
+        start = time.perf_counter()
+        with pytest.raises(requests.RequestException):
+            api.get_json()
+        assert time.perf_counter() - start < 2
+
+        started = threading.Event()
+        def hanging_fetch(area_name):
+            started.set()
+            release.wait(5)
+        first = covid_data_handler.submit_covid_fetch(hanging_fetch, "Exeter")
+        started.wait(5)
+        assert covid_data_handler.submit_covid_fetch(hanging_fetch, "Exeter") is first
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+
+    first.result(5)
+    assert covid_data_handler.submit_covid_fetch(hanging_fetch, "Exeter") is not first
+
+def test_offline_upstreams_refresh_dashboard(monkeypatch):
+    """
+    This test checks the covid data and news are refreshed from the recorded API responses
+        without any network requests
+    """
+    monkeypatch.setattr(covid_data_handler, "covid_state", CopyOnWriteState(freeze({})))
+    monkeypatch.setattr(covid_news_handling, "news_articles", NewsArticleStore())
+    with offline_upstreams() as calls:
+        covid_data_handler.update_covid_data("England", "Exeter")
+        update_news()
+
+    covid_data = covid_data_handler.covid_state.snapshot()
+    assert covid_data["nation_last7days_cases"] == 240_299
+    assert covid_data["nation_total_deaths"] == "National Total Deaths: 141544"
+    assert covid_data["areas"]["Exeter"]["area_type"] == "ltla"
+    assert len(covid_news_handling.news_articles) == 20
+    assert calls.counts() == {"covid": 2, "news": 1}
+
+def test_covid_API_request_fetches_only_new_dates(monkeypatch):
+    """
+    This test checks that once an area is stored only its newest dates are requested
+        and the new rows are merged into the stored time series
+    """
+    today = datetime.date.today()
+    def row(days_ago, new_cases):
+        return {"date": (today - datetime.timedelta(days = days_ago)).isoformat(), \
+                "cumDailyNsoDeathsByDeathDate": 100 - days_ago, "hospitalCases": 5, \
+                "newCasesBySpecimenDate": new_cases}
+
+    queries = []
+    class FakeCov19API:
+        def __init__(self, filters, structure):
+            queries.append(filters)
+            self.date = filters[-1][5:] if filters[-1].startswith("date=") else None
+        def get_json(self):
+            if self.date is None:
+                return {"data": [row(days_ago, 10) for days_ago in range(1, 30)]}
+            return {"data": [new_row for new_row in [row(0, 20), row(1, 20)] \
+                             if new_row["date"] == self.date]}
+
+    monkeypatch.setattr(covid_data_handler, "Cov19API", FakeCov19API)
+    monkeypatch.setattr(covid_data_handler, "covid_cache", \
+                        CovidCache(MemoryCacheBackend(), ttl = 0, stale_ttl = 0))
+    monkeypatch.setattr(covid_data_handler, "covid_area_store", covid_data_handler.CovidAreaStore())
+    first = covid_API_request("Exeter", "ltla")
+    second = covid_API_request("Exeter", "ltla")
+
+    assert first["last7days_cases"] == 70 and first["total_deaths"] == 99
+    assert [query[-1] for query in queries[1:]] == ["date=" + (today - \
+        datetime.timedelta(days = days_ago)).isoformat() for days_ago in (2, 1, 0)]
+    assert second["last7days_cases"] == 20 + 6 * 10 and second["total_deaths"] == 100
+    assert len(covid_data_handler.covid_area_store.get_time_series("Exeter")) == 30
+
+def test_covid_API_request_within_ttl_makes_no_request(monkeypatch):
+    """
+    This test checks calls within the covid cache ttl make one upstream request, and the
+        newest dates are only requested again once the ttl has passed since the last fetch
+    """
+    today = datetime.date.today()
+    queries = []
+    class FakeCov19API:
+        def __init__(self, filters, structure):
+            queries.append(filters)
+        def get_json(self):
+            return {"data": [{"areaName": "Exeter", "date": today.isoformat(), \
+                              "cumDailyNsoDeathsByDeathDate": 1, "hospitalCases": 1, \
+                              "newCasesBySpecimenDate": 1}]}
+
+    now = [time.time()]
+    covid_cache = CovidCache(MemoryCacheBackend(), ttl = 60, stale_ttl = 0, \
+                             clock = lambda: now[0])
+    monkeypatch.setattr(covid_data_handler, "Cov19API", FakeCov19API)
+    monkeypatch.setattr(covid_data_handler, "covid_cache", covid_cache)
+    monkeypatch.setattr(covid_data_handler, "covid_area_store", covid_data_handler.CovidAreaStore())
+    covid_API_request("Exeter", "ltla")
+    covid_API_request("Exeter", "ltla")
+    covid_data_handler.covid_area_type_request("ltla", ["Exeter"])
+    assert len(queries) == 1 and covid_cache.stats()["hits"] == 2
+
+    now[0] += 61
+    covid_API_request("Exeter", "ltla")
+    incremental_queries = len(queries)
+    assert incremental_queries > 1 and queries[-1][-1].startswith("date=")
+    covid_API_request("Exeter", "ltla")
+    assert len(queries) == incremental_queries
+
+def test_covid_API_request_stale_hit_keeps_fetch_time(monkeypatch):
+    """
+    This test checks that an area stored from a stale cache hit keeps the time its data
+        was fetched from the API, not the time of the hit
+    """
+    class FakeCov19API:
+        def __init__(self, filters, structure):
+            pass
+        def get_json(self):
+            return {"data": [{"date": "2021-10-01", "cumDailyNsoDeathsByDeathDate": 1, \
+                              "hospitalCases": 1, "newCasesBySpecimenDate": 1}]}
+
+    now = [1000.0]
+    covid_cache = CovidCache(MemoryCacheBackend(), ttl = 10, stale_ttl = 100, \
+                             clock = lambda: now[0])
+    monkeypatch.setattr(covid_data_handler, "Cov19API", FakeCov19API)
+    monkeypatch.setattr(covid_data_handler, "covid_cache", covid_cache)
+    monkeypatch.setattr(covid_data_handler, "covid_area_store", covid_data_handler.CovidAreaStore())
+    covid_API_request("Exeter", "ltla")
+    assert covid_data_handler.covid_area_store.refreshed_at("Exeter") == 1000.0
+
+    now[0] = 1050.0
+    monkeypatch.setattr(covid_data_handler, "covid_area_store", covid_data_handler.CovidAreaStore())
+    covid_API_request("Exeter", "ltla")
+    covid_cache.wait_for_refreshes(5)
+    assert covid_cache.stats()["stale_hits"] == 1
+    assert covid_data_handler.covid_area_store.refreshed_at("Exeter") == 1000.0
+
+def test_page_cache_renders_again_after_data_change():
+    """
+    This test checks a cached page is reused until the data version changes
+    """
+    renders = []
+    def render():
+        renders.append(get_data_version())
+        return "page " + str(len(renders))
+
+    page_cache = PageCache()
+    first = page_cache.get_or_render(get_data_version(), render)
+    assert page_cache.get_or_render(get_data_version(), render) == first
+    bump_data_version("test")
+    body, etag = page_cache.get_or_render(get_data_version(), render)
+    assert body == b"page 2"
+    assert etag != first[1]
+
+def test_api_payload_cache_sends_changes_since_version():
+    """
+    This test checks payloads are encoded once per data version and that
+        ?since= gets only the items added, changed or removed since then
+    """
+    articles = {"a": {"title": "a"}, "b": {"title": "b"}}
+    builds = []
+    def build():
+        builds.append(1)
+        return {"articles": dict(articles)}
+
+    payload_cache = ApiPayloadCache(build)
+    encodings, etag = payload_cache.get()
+    assert payload_cache.get() == (encodings, etag) and len(builds) == 1
+    first = json.loads(gzip.decompress(encodings["gzip"]))
+    assert first["full"] and first["data"] == {"articles": articles}
+
+    del articles["a"]
+    articles["c"] = {"title": "c"}
+    bump_data_version("test")
+    encodings, _ = payload_cache.get(since = first["version"])
+    changes = json.loads(encodings["identity"])
+    assert not changes["full"] and changes["version"] == get_data_version()
+    assert changes["changed"] == {"articles": {"c": {"title": "c"}}}
+    assert changes["removed"] == {"articles": ["a"]}
+    assert json.loads(payload_cache.get(since = -5)[0]["identity"])["full"]
+
+def test_event_stream_pushes_only_changed_payloads():
+    """
+    This test checks the events stream sends nothing but a heartbeat until the data
+        changes, then one event with the diff for each payload that changed
+    """
+    articles = {"a": {"title": "a"}}
+    payload_caches = {"news": ApiPayloadCache(lambda: {"articles": dict(articles)}), \
+                      "schedule": ApiPayloadCache(lambda: {"updates": {}})}
+    stream = event_stream(payload_caches, None, heartbeat = 0.01)
+
+    assert next(stream).startswith("retry:")
+    assert next(stream) == ": keep-alive\n\n"
+    articles["b"] = {"title": "b"}
+    bump_data_version("test")
+    event = next(stream)
+    stream.close()
+
+    assert event.count("event: ") == 1
+    assert event.startswith("id: {}\nevent: news\n".format(get_data_version()))
+    assert json.loads(event.split("data: ")[1])["changed"] == {"articles": {"b": {"title": "b"}}}
+
+def test_event_streams_are_limited_and_end_after_max_lifetime():
+    """
+    This test checks a stream ends with the id of its data version after max_lifetime,
+        and once max_streams are open another stream only asks the browser to reconnect
+        later, until a stream is closed
+    """
+    now = [0.0]
+    payload_caches = {"news": ApiPayloadCache(lambda: {"articles": {}})}
+    stream = event_stream(payload_caches, None, heartbeat = 0.01, max_lifetime = 10, \
+                          clock = lambda: now[0])
+    assert next(stream).startswith("retry:")
+    assert next(stream) == ": keep-alive\n\n"
+    now[0] = 10.0
+    assert next(stream) == "id: {}\n\n".format(get_data_version())
+    assert list(stream) == []
+
+    limiter = StreamLimiter(max_streams = 1)
+    first = limited_stream(limiter, event_stream(payload_caches, None, heartbeat = 0.01))
+    assert next(first).startswith("retry: 5000")
+    assert list(limited_stream(limiter, iter([]), busy_retry = 30)) == ["retry: 30000\n\n"]
+    first.close()
+    assert limiter.open_streams == 0
+    second = limited_stream(limiter, event_stream(payload_caches, None, heartbeat = 0.01))
+    assert next(second).startswith("retry: 5000")
+    second.close()
+
+def test_load_test_latency_summary():
+    """
+    This test checks the load test percentiles use the nearest rank
+    """
+    summary = latency_summary([index / 1000 for index in range(100, 0, -1)], errors = 2, \
+                              seconds = 2.0)
+    assert (summary["requests"], summary["errors"], summary["rps"]) == (102, 2, 51.0)
+    assert (summary["p50_ms"], summary["p90_ms"], summary["p99_ms"]) == (50.0, 90.0, 99.0)
+    assert summary["max_ms"] == 100.0
+
+def test_log_writer_batches_and_rotates(tmp_path):
+    """
+    This test checks queued records are written by the log writer, the log file is rotated
+        at max_bytes and records are dropped (not waited for) when the queue is full
+    """
+    path = str(tmp_path / "test.log")
+    log_queue = queue.Queue(maxsize = 1000)
+    handler = DroppingQueueHandler(log_queue)
+    logger = logging.getLogger("test_log_writer")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    writer = LogWriter(log_queue, BatchRotatingFileHandler(path, maxBytes = 2000, \
+                                                           backupCount = 1))
+    try:
+        for index in range(1500):
+            logger.info("record %d", index)
+        assert handler.dropped == 500
+        writer.start()
+        logger.info("last record")
+    finally:
+        writer.stop()
+        logger.removeHandler(handler)
+
+    with open(path) as log_file:
+        assert log_file.read().splitlines()[-1] == "last record"
+    assert os.path.exists(path + ".1") and not os.path.exists(path + ".2")
+
+def test_dump_sampler_picks_one_call_in_dump_every():
+    """
+    This test checks the per-item DEBUG dumps are written on one call in dump_every,
+        with at most max_items items, and never when DEBUG is not enabled
+    """
+    logger = logging.getLogger("test_dump_sampler")
+    logger.setLevel(logging.DEBUG)
+    sampler = DumpSampler(dump_every = 10, max_items = 3)
+    assert [sampler.sample(logger) for _ in range(20)].count(True) == 2
+    assert list(sampler.items(range(100))) == [0, 1, 2]
+    logger.setLevel(logging.INFO)
+    assert not any(sampler.sample(logger) for _ in range(20))
+
+def test_metrics_render_prometheus_text():
+    """
+    This test checks counters, gauges and timed functions (including ones that raise)
+        are written in the Prometheus text format with cumulative histogram buckets
+    """
+    requests_count = metrics.counter("test_requests_total", "Test requests", ("api",))
+    requests_count.labels("covid").inc()
+    requests_count.labels("covid").inc(2)
+    metrics.gauge("test_queue_depth", "Test depth").labels().set_function(lambda: 7)
+    lag = metrics.histogram("test_lag_seconds", "Test lag", buckets = (0.1, 1.0)).labels()
+    lag.observe(0.05)
+    lag.observe(0.5)
+    lag.observe(5)
+
+    @metrics.timed
+    def test_failing_function():
+        raise ValueError("failed")
+    try:
+        test_failing_function()
+    except ValueError:
+        pass
+
+    lines = metrics.render_metrics().splitlines()
+    assert 'test_requests_total{api="covid"} 3' in lines
+    assert "test_queue_depth 7" in lines
+    assert "# TYPE test_lag_seconds histogram" in lines
+    assert ['test_lag_seconds_bucket{le="0.1"} 1', 'test_lag_seconds_bucket{le="1"} 2', \
+            'test_lag_seconds_bucket{le="+Inf"} 3'] == \
+        [line for line in lines if line.startswith("test_lag_seconds_bucket")]
+    assert "test_lag_seconds_count 3" in lines
+    assert 'dashboard_function_seconds_count{function="test_failing_function"} 1' in lines
+
+def test_covid_bytes_counted_from_responses_only_when_enabled(monkeypatch):
+    """
+    This test checks the covid API bytes are the size of the responses received,
+        and that nothing is counted or timed while the metrics are turned off
+    """
+    body = json.dumps({"data": [{"date": "2021-10-01"}]}).encode("utf-8")
+
+    class StubCovidHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if "page=1" not in self.path:
+                self.send_response(204)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Last-Modified", "Thu, 28 Oct 2021 15:00:00 GMT")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubCovidHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    monkeypatch.setattr(covid_data_handler.Cov19API, "endpoint", \
+                        "http://127.0.0.1:{}/v1/data".format(server.server_port))
+    monkeypatch.setattr(covid_data_handler, "covid_bytes", metrics.CounterValue())
+    seconds = metrics.HistogramValue((1.0,))
+    try:
+        api = covid_data_handler.Cov19API(['areaType=nation'], {"date": "date"}, timeout = 5)
+        covid_data_handler.covid_api_get_json(api)
+        assert covid_data_handler.covid_bytes.value == len(body)
+
+        monkeypatch.setattr(metrics.registry, "enabled", False)
+        covid_data_handler.covid_api_get_json(api)
+        with seconds.time():
+            pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert covid_data_handler.covid_bytes.value == len(body)
+    assert seconds.counts == [0, 0]
+
+def test_metrics_turned_off_record_nothing(monkeypatch):
+    """
+    This test checks no counter or histogram changes while the metrics are turned off:
+        upstream bytes and errors, job lag, runs and coalesced jobs, and request latency
+    """
+    #main is imported here as importing it starts the scheduler worker, which is stopped
+    import main
+    stop_scheduler_worker(timeout = 5)
+
+    #the values recorded so far (label values used for the first time are still 0)
+    def recorded():
+        return [line for metric in list(metrics.registry.metrics.values()) \
+                if metric.kind != "gauge" for line in metric.render() if not line.endswith(" 0")]
+
+    class FailingResponse:
+        content = b'{"status": "error"}'
+        status_code = 500
+        ok = False
+        headers = {}
+        def json(self):
+            return {"status": "error"}
+    class FailingSession:
+        def get(self, url, **kwargs):
+            return FailingResponse()
+    class FailingCov19API:
+        def get_json(self):
+            raise ConnectionError("covid API down")
+    def job():
+        return "done"
+
+    monkeypatch.setattr(scheduler, "job_flights", SingleFlight())
+    monkeypatch.setattr(metrics.registry, "enabled", False)
+    before = recorded()
+
+    ConditionalGetClient(FailingSession()).get_json("http://news.invalid/v2/everything")
+    with pytest.raises(ConnectionError):
+        covid_data_handler.covid_api_get_json(FailingCov19API())
+    scheduler.job_slots.acquire()
+    scheduler.run_job(job, {}, due_time = time.time() - 1)
+    scheduler.run_coalesced(job, {}, time.time(), {"enabled": True, "window": 60})
+    main.app.test_client().get("/api/aggregates?area=Nowhere")
+
+    assert recorded() == before
+
+def test_config_reloads_when_file_changes(tmp_path):
+    """
+    This test checks the configuration is reloaded after the file changes
+        and kept if the new file cannot be parsed
+    """
+    config_file = tmp_path / "config.json"
+    config_file.write_text('{"location" : "Exeter"}')
+    config = Config(str(config_file))
+    assert not config.reload_if_changed()
+
+    config_file.write_text('{"location" : "Plymouth"}')
+    os.utime(config_file, ns = (0, config.mtime + 1))
+    assert config.reload_if_changed()
+    assert config.get() == {"location" : "Plymouth"}
+
+    config_file.write_text('{"location" : ')
+    os.utime(config_file, ns = (0, config.mtime + 2))
+    assert not config.reload_if_changed()
+    assert config.get() == {"location" : "Plymouth"}
+
+def test_scheduler_worker_runs_jobs_in_background():
+    """
+    This test checks scheduled jobs run on time without a request, away from the calling thread
+    """
+    job_ran = threading.Event()
+    job_threads = []
+    def job(name):
+        job_threads.append(threading.current_thread().name)
+        job_ran.set()
+
+    start_scheduler_worker()
+    try:
+        schedule_job(0.05, job, kwargs = {"name": "test"})
+        assert job_ran.wait(5)
+    finally:
+        stop_scheduler_worker(5)
+    assert job_threads[0].startswith("scheduled-job")
+
+def test_single_flight_shares_overlapping_and_nearby_calls():
+    """
+    This test checks calls with the same key share one call while it is running or when
+        due within the window, and a failed call is tried again
+    """
+    flights = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch():
+        calls.append("slow")
+        started.set()
+        release.wait(5)
+        return "slow result"
+
+    leader = threading.Thread(target = flights.run, args = ("covid", slow_fetch, 0.0))
+    leader.start()
+    started.wait(5)
+    shared, ran = flights.run("covid", lambda: calls.append("duplicate"), 1000.0, window = 60)
+    release.set()
+    leader.join()
+    assert not ran and shared.result() == "slow result"
+
+    assert flights.run("covid", lambda: calls.append("nearby"), 50.0, window = 60)[1] is False
+    assert flights.run("news", lambda: calls.append("news"), 50.0, window = 60)[1] is True
+    assert flights.run("covid", lambda: calls.append("later"), 120.0, window = 60)[1] is True
+
+    def failing_fetch():
+        calls.append("failed")
+        raise ConnectionError("covid API down")
+    failed, _ = flights.run("failing", failing_fetch, 0.0, window = 60)
+    assert isinstance(failed.exception(), ConnectionError)
+    assert flights.run("failing", lambda: calls.append("retried"), 1.0, window = 60)[1] is True
+    assert calls == ["slow", "news", "later", "failed", "retried"]
+    assert flights.counters == {"calls": 5, "coalesced": 2}
+
+def test_instant_job_does_not_share_a_finished_run(monkeypatch):
+    """
+    This test checks an instant job (an "update now") runs again even when the same job
+        finished within the coalescing window, while a timed job still shares that run
+    """
+    monkeypatch.setattr(scheduler, "job_flights", SingleFlight())
+    settings = {"enabled": True, "window": 60}
+    calls = []
+    def update_covid_data():
+        calls.append(len(calls))
+        return len(calls)
+
+    assert scheduler.run_coalesced(update_covid_data, {}, 1000.0, settings) == 1
+    assert scheduler.run_coalesced(update_covid_data, {}, 1010.0, settings, instant = True) == 2
+    assert scheduler.run_coalesced(update_covid_data, {}, 1020.0, settings) == 2
+    assert calls == [0, 1]
+
+    def no_update():
+        return None
+    instant_event = schedule_job(0, no_update)
+    timed_event = schedule_job(3600, no_update)
+    assert instant_event.argument[2] is True and timed_event.argument[2] is False
+    scheduler.cancel_job(instant_event)
+    scheduler.cancel_job(timed_event)
+
+def test_updates_scheduled_store_pops_only_due_updates():
+    """
+    This test checks only due updates are returned, once, and removed, re-added or
+        rescheduled updates are not returned for their old due time
+    """
+    store = UpdatesScheduledStore()
+    for title, absolute_delay_time in [("a", 10), ("b", 20), ("c", 30), ("d", 100)]:
+        store.add(ScheduledUpdate(title, "", "12:00", "covid-data", None, None, None, None, \
+                                  absolute_delay_time))
+    store.remove("b")
+    store.reschedule("c", 200)
+
+    assert [entry.title for entry in store.pop_due(50)] == ["a"]
+    assert "b" not in store and "a" in store
+    assert store.next_due_time() == 100
+    assert [entry.title for entry in store] == ["a", "c", "d"]
+    assert store.pop_due(50) == []
+
+    store.remove("d")
+    store.add(ScheduledUpdate("d", "", "12:00", "covid-data", None, None, None, None, 100))
+    assert [entry.title for entry in store.pop_due(150)] == ["d"]
+    assert store.pop_due(150) == []
+
+def test_updates_scheduled_store_keeps_retry_time_when_tidied():
+    """
+    This test checks an update requeued with a retry time keeps it when the heap
+        is tidied, so it is not due again straight away
+    """
+    store = UpdatesScheduledStore()
+    store.add(ScheduledUpdate("retry", "", "12:00", "covid-data", None, "repeat", None, None, 10))
+    store.requeue(store.pop_due(50), retry_time = 1000)
+    for count in range(100):
+        store.reschedule("retry", 10)
+        store.requeue(store.pop_due(50), retry_time = 1000)
+    assert len(store.due_heap) < 100
+    assert store.pop_due(50) == [] and store.next_due_time() == 1000
+    assert [entry.title for entry in store.pop_due(1001)] == ["retry"]
+
+def test_review_requeues_update_that_cannot_be_rescheduled(monkeypatch):
+    """
+    This test checks a due repeating update whose jobs cannot be created is put back
+        on the heap (due again after REVIEW_RETRY_DELAY), its other job is cancelled,
+        and the update is rescheduled once the jobs can be created
+    """
+    #main is imported here as importing it starts the scheduler worker, which is stopped
+    import main
+    stop_scheduler_worker(timeout = 5)
+
+    store = UpdatesScheduledStore()
+    store.add(ScheduledUpdate("repeat", "", "12:00", "covid-data", "news", "repeat", None, None, \
+                              time.time() - 1))
+    failures = []
+    cancelled = []
+    def schedule_update_news(update_interval, update_name):
+        if not failures:
+            failures.append(update_name)
+            raise RuntimeError("scheduler unavailable")
+        return "news event"
+    monkeypatch.setattr(main, "get_updates_scheduled", lambda: store)
+    monkeypatch.setattr(main, "schedule_covid_updates", lambda interval, name: "covid event")
+    monkeypatch.setattr(main, "schedule_update_news", schedule_update_news)
+    monkeypatch.setattr(main, "cancel_job", cancelled.append)
+    monkeypatch.setattr(main, "reschedule_update_scheduled", \
+                        lambda title, update_time, clock, **events: store.reschedule(title, \
+                            clock.timestamp + 86400, **events))
+
+    main.review_updates_scheduled()
+    assert failures == ["repeat"] and cancelled == ["covid event"]
+    assert "repeat" in store and store.pop_due(time.time()) == []
+    assert store.next_due_time() > time.time() + main.REVIEW_RETRY_DELAY - 5
+
+    monkeypatch.setattr(main, "read_clock", lambda: ScheduleClock(now = time.time() + \
+                                                                   main.REVIEW_RETRY_DELAY))
+    main.review_updates_scheduled()
+    assert store.get("repeat").update_news_event == "news event"
+    assert store.get("repeat").update_covid_event == "covid event"
+
+def test_copy_on_write_state_readers_never_see_half_a_change():
+    """
+    This test checks readers iterating the news articles, scheduled updates and covid data
+        while writers change them never get an error or half of a change
+    """
+    news_store = NewsArticleStore()
+    updates_store = UpdatesScheduledStore()
+    covid_state = CopyOnWriteState(freeze({"first": 0, "second": 0}))
+    errors = []
+    stop = threading.Event()
+
+    def write(index):
+        try:
+            for count in range(300):
+                title = "article " + str(index) + " " + str(count)
+                news_store.add_new([{"title": title, "content": ""}])
+                news_store.mark_seen(title)
+                updates_store.add(ScheduledUpdate(title, "", "12:00", "covid-data", None, None, \
+                                                  None, None, count))
+                updates_store.pop_due(count)
+                covid_state.replace(freeze({"first": count, "second": count}))
+        except Exception as error:
+            errors.append(error)
+
+    def read():
+        try:
+            while not stop.is_set():
+                for news_article in news_store:
+                    assert "title" in news_article
+                for entry in updates_store:
+                    assert entry.absolute_delay_time is not None
+                snapshot = covid_state.snapshot()
+                assert snapshot["first"] == snapshot["second"]
+        except Exception as error:
+            errors.append(error)
+
+    readers = [threading.Thread(target = read) for _ in range(4)]
+    writers = [threading.Thread(target = write, args = (index,)) for index in range(4)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    assert errors == []
+    assert len(news_store) == 0 and news_store.is_seen("article 3 299")
+
+def test_schedule_clock_matches_previous_delays():
+    """
+    This test checks the delays from one reading of the clock match the previous
+        calculate_delay for every kind of update time (earlier, later and just due)
+    """
+    now = datetime.datetime(2021, 11, 26, 12, 0, 5, 250000)
+    clock = ScheduleClock(now = now.timestamp())
+    seconds_since_midnight = 12 * 60 * 60 + 5.25
+
+    assert second_of_day("12:30") == 45_000
+    for update_time, delay_delta_seconds, expected in [ \
+            ("12:30", 10, 45_000 + 10 - seconds_since_midnight), \
+            ("12:00", 10, 24 * 60 * 60 + 43_200 + 10 - seconds_since_midnight), \
+            ("12:01", 60, 24 * 60 * 60 + 43_260 + 60 - seconds_since_midnight), \
+            ("00:00", 30, 24 * 60 * 60 + 30 - seconds_since_midnight)]:
+        assert abs(clock.delay(update_time, delay_delta_seconds) - expected) < 1e-6
+    assert clock.delays(["12:30", "12:30"], 20) == [clock.delay("12:30", 20)] * 2
+
+def test_schedule_clock_daylight_saving_time():
+    """
+    This test checks the delays are the real seconds until the update time on the days
+        the clocks go forward and back
+    """
+    london = ZoneInfo("Europe/London")
+    spring = datetime.datetime(2021, 3, 27, 23, 0, tzinfo = london).timestamp()
+    autumn = datetime.datetime(2021, 10, 31, 0, 30, tzinfo = london).timestamp()
+
+    assert ScheduleClock(london, spring).delay("12:00", 0) == 12 * 60 * 60
+    assert ScheduleClock(london, autumn).delay("03:00", 0) == 3.5 * 60 * 60
+
+def test_updates_journal_replays_and_compacts(tmp_path):
+    """
+    This test checks the journal replays adds, removes and reschedules,
+        ignores a partly written last line and is compacted to the live updates
+    """
+    path = str(tmp_path / "journal.jsonl")
+    journal = UpdatesJournal(path, compact_after = 10)
+    for title in ["a", "b"]:
+        journal.record_add(ScheduledUpdate(title, "", "12:00", "covid-data", None, "repeat", \
+                                           None, None, 1.0))
+    journal.record_remove("a")
+    journal.record_reschedule("b", 2.0)
+    with open(path, 'a') as journal_file:
+        journal_file.write('{"op": "add", "tit')
+
+    replayed = UpdatesJournal(path, compact_after = 10)
+    assert [(record["title"], record["absolute_delay_time"]) for record in replayed.replay()] \
+        == [("b", 2.0)]
+
+    for _ in range(10):
+        replayed.record_reschedule("b", 3.0)
+    with open(path) as journal_file:
+        assert len(journal_file.readlines()) == 1
+    assert UpdatesJournal(path).replay()[0]["absolute_delay_time"] == 3.0
+
 def test_covid_API_request():
     data = covid_API_request()
     assert isinstance(data, dict)
@@ -44,6 +984,25 @@ def test_get_covid_data():
     data = get_covid_data()
     assert isinstance(data, dict)
 
+def test_empty_stores_are_filled_in_the_background(monkeypatch):
+    """
+    This test ensures a request finding no covid data or news hands one update of each
+        to the scheduler worker and returns straight away, however many requests are made
+    """
+    queued = []
+    monkeypatch.setattr(scheduler, "queued_jobs", set())
+    monkeypatch.setattr(scheduler, "schedule_job", \
+                        lambda delay, action, kwargs = None: queued.append((delay, action)))
+    monkeypatch.setattr(covid_data_handler, "covid_state", CopyOnWriteState(freeze({})))
+    monkeypatch.setattr(covid_news_handling, "news_articles", NewsArticleStore())
+
+    for _ in range(3):
+        assert get_covid_data() == covid_data_handler.PLACEHOLDER_COVID_DATA
+        assert get_news_articles() == []
+
+    assert queued == [(0, covid_data_handler.update_covid_data), \
+                      (0, covid_news_handling.update_news)]
+
 def test_schedule_covid_updates():
     """
     This test checks that the scheduled covid data updates are running
@@ -75,6 +1034,83 @@ def test_news_API_request():
 def test_update_news():
     update_news('test')
 
+def test_conditional_get_client_reuses_connection_and_response():
+    """
+    This test ensures an unchanged response is a 304 answered from the kept json
+        and that both requests share one keep-alive connection
+    """
+    seen = {"clients": set(), "not_modified": 0}
+
+    class StubNewsHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            seen["clients"].add(self.client_address)
+            if self.headers.get("If-None-Match") == '"v1"':
+                seen["not_modified"] += 1
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps({"articles": [{"title": "Covid live"}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubNewsHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    try:
+        client = ConditionalGetClient(create_session(retries = 0), timeout = 5)
+        url = "http://127.0.0.1:{}/v2/top-headlines".format(server.server_port)
+        first = client.get_json(url)
+        second = client.get_json(url)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert first == second == {"articles": [{"title": "Covid live"}]}
+    assert seen["not_modified"] == 1 and client.counters["not_modified"] == 1
+    assert len(seen["clients"]) == 1
+
+def test_fetch_news_merges_queries_and_countries(monkeypatch):
+    """
+    This test checks every query and country is fetched, a failed request is left out,
+        and the results are merged without duplicate titles, newest first
+    """
+    def fake_news_API_request(covid_terms, country):
+        if country == "us":
+            raise ConnectionError("news API unavailable")
+        return {"articles": [{"title": "Shared", "publishedAt": "2021-12-01T09:00:00Z"}, \
+            {"title": covid_terms, "publishedAt": "2021-12-0" + str(len(covid_terms)) + "T09:00:00Z"}]}
+
+    monkeypatch.setattr(covid_news_handling, "news_API_request", fake_news_API_request)
+    monkeypatch.setattr(covid_news_handling, "news_rate_limiter", RateLimiter(100, 10))
+    results = fetch_news(["covid", "vaccine"], ["gb", "us"])
+    merged = merge_news(results)
+
+    assert len(results) == 2
+    assert [news_article['title'] for news_article in merged] == ["vaccine", "covid", "Shared"]
+
+def test_rate_limiter_waits_for_tokens():
+    """
+    This test checks requests beyond the burst wait for the token rate
+    """
+    now = [0.0]
+    def sleep(seconds):
+        now[0] += seconds
+
+    limiter = RateLimiter(rate = 2.0, burst = 2, clock = lambda: now[0], sleep = sleep)
+    waits = [limiter.acquire() for _ in range(4)]
+
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == waits[3] == 0.5
+    assert now[0] == 1.0
+
 def test_find_one_new_news():
     """
     This test ensures that news is correctly found
@@ -107,11 +1143,70 @@ def test_get_news_articles():
     news_articles = get_news_articles()
     assert isinstance(news_articles, list)
 
-def test_add_seen_news_article():
+def test_add_seen_news_article(monkeypatch, tmp_path):
     """
-    This test checks that a news article has been seen
+    This test checks that a news article has been seen and the seen titles are saved
     """
+    path = str(tmp_path / "seen_articles.bin")
+    store = NewsArticleStore(SeenArticles(path = path))
+    monkeypatch.setattr(covid_news_handling, "news_articles", store)
+    saver = covid_news_handling.DelayedSave(lambda: store.save_seen(), delay = 60)
+    monkeypatch.setattr(covid_news_handling, "seen_articles_saver", saver)
+
     add_seen_news_article("seen article")
+    add_seen_news_article("another seen article")
+    assert store.is_seen("seen article") and not os.path.exists(path)
+
+    saver.flush()
+    loaded = SeenArticles.load(path)
+    assert "seen article" in loaded and "another seen article" in loaded
+
+def test_news_article_store():
+    """
+    This test checks seen and duplicate articles are not added
+        and dismissed articles are removed while keeping the display order
+    """
+    store = NewsArticleStore()
+    assert len(store.add_new([{'title': 'a'}, {'title': 'b'}, {'title': 'c'}])) == 3
+    assert store.mark_seen('b')
+    assert store.add_new([{'title': 'a'}, {'title': 'b'}, {'title': 'd'}]) == [{'title': 'd'}]
+    assert [news_article['title'] for news_article in store] == ['a', 'c', 'd']
+    assert store.is_seen('b') and not store.mark_seen('b')
+
+def test_seen_articles_bounded_and_saved(tmp_path):
+    """
+    This test checks the seen titles stay in a fixed amount of memory with
+        a false positive rate close to the one asked for, and are kept after saving
+    """
+    seen_articles = SeenArticles(capacity = 1000, error_rate = 0.01, recent_size = 10)
+    memory_bytes = seen_articles.memory_bytes()
+    seen_articles.update("seen " + str(title) for title in range(5000))
+    assert seen_articles.memory_bytes() == memory_bytes
+    assert all("seen " + str(title) in seen_articles for title in range(4000, 5000))
+    false_positives = sum("unseen " + str(title) in seen_articles for title in range(10000))
+    assert false_positives < 10000 * 0.01 * 3
+
+    path = str(tmp_path / "seen.bin")
+    seen_articles.save(path)
+    loaded = SeenArticles.load(path)
+    assert all("seen " + str(title) in loaded for title in range(4000, 5000))
+    assert "seen 4999" in loaded.recent
+
+def test_seen_articles_load_empty_or_cut_short_file(tmp_path):
+    """
+    This test checks an empty or cut short seen articles file starts with no seen titles
+        instead of stopping the dashboard from starting
+    """
+    path = tmp_path / "seen_articles.bin"
+    seen_articles = SeenArticles(capacity = 1000, error_rate = 0.01, path = str(path))
+    seen_articles.add("seen title")
+    seen_articles.save()
+    saved = path.read_bytes()
+
+    for contents in (b"", saved[:20], saved[:-10]):
+        path.write_bytes(contents)
+        loaded = SeenArticles.load(str(path))
+        assert "seen title" not in loaded and len(loaded.recent) == 0
 
 def test_create_search_query_term():
     """
@@ -119,7 +1214,7 @@ def test_create_search_query_term():
         and the news is filtered correctly
     """
     search_query_term = create_search_query_term("Covid COVID-19 coronavirus")
-    assert search_query_term == "language=en&q=covid&covid-19&coronavirus"
+    assert search_query_term == "language=en&q=covid%20OR%20covid-19%20OR%20coronavirus&"
 
 def test_schedule_update_news():
     """
@@ -0,0 +1,216 @@
+"""
+This module handles:
+    - storing the covid data for an area as NumPy columns (a time series)
+    - building the time series from the covid API json
+    - calculating the dashboard figures with vectorized operations
+    - streaming csv files through a memory map, stopping once the newest figures are found
+        (csv files are scanned row by row instead of being loaded into a time series,
+        as only their newest few rows are needed)
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import csv
+import mmap
+import os
+from contextlib import closing
+import numpy as np
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#Column positions in the csv files
+#areaCode,areaName,areaType,date,cumDailyNsoDeathsByDeathDate,hospitalCases,newCasesBySpecimenDate
+AREA_CODE_COLUMN = 0
+DEATHS_COLUMN = 4
+HOSPITAL_CASES_COLUMN = 5
+NEW_CASES_COLUMN = 6
+
+#Number of case values added up for the 7 day figure (after skipping the newest, incomplete value)
+LAST7DAYS_COUNT = 7
+
+class CovidTimeSeries:
+    """
+    This class holds the covid data for one area as columns
+    Every metric is a NumPy array with a null mask that is True where a value is present
+    Rows are kept newest first, the same order the API uses
+    It is only built from the API json, csv files are scanned row by row (scan_latest_values)
+    """
+
+    def __init__(self, dates, deaths, deaths_mask, hospital_cases, hospital_cases_mask, \
+            new_cases, new_cases_mask, area_name = "", area_type = ""):
+        order = np.argsort(-dates.astype(np.int64), kind = "stable")
+
+        self.area_name = area_name
+        self.area_type = area_type
+        self.dates = dates[order]
+        self.deaths = deaths[order]
+        self.deaths_mask = deaths_mask[order]
+        self.hospital_cases = hospital_cases[order]
+        self.hospital_cases_mask = hospital_cases_mask[order]
+        self.new_cases = new_cases[order]
+        self.new_cases_mask = new_cases_mask[order]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def latest_date(self):
+        """
+        Returns the newest date (a numpy datetime64), or None if there are no rows
+        """
+        if len(self.dates) == 0:
+            return None
+
+        return self.dates[0]
+
+    def merge(self, newer):
+        """
+        Returns a new time series with the rows of newer (another CovidTimeSeries) added
+        Rows of newer replace the rows for the same dates, so revised figures are picked up
+        """
+        kept = ~np.isin(self.dates, newer.dates)
+
+        return CovidTimeSeries(np.concatenate((newer.dates, self.dates[kept])), \
+            np.concatenate((newer.deaths, self.deaths[kept])), \
+            np.concatenate((newer.deaths_mask, self.deaths_mask[kept])), \
+            np.concatenate((newer.hospital_cases, self.hospital_cases[kept])), \
+            np.concatenate((newer.hospital_cases_mask, self.hospital_cases_mask[kept])), \
+            np.concatenate((newer.new_cases, self.new_cases[kept])), \
+            np.concatenate((newer.new_cases_mask, self.new_cases_mask[kept])), \
+            area_name = self.area_name, area_type = self.area_type)
+
+    @classmethod
+    def from_api_json(cls, rows, area_name = "", area_type = ""):
+        """
+        Builds the time series from the "data" list returned by Cov19API.get_json()
+        Missing (None) and negative values are treated as nulls
+        """
+        dates = np.array([row["date"] for row in rows], dtype = "datetime64[D]")
+        deaths = metric_array(rows, "cumDailyNsoDeathsByDeathDate")
+        hospital_cases = metric_array(rows, "hospitalCases")
+        new_cases = metric_array(rows, "newCasesBySpecimenDate")
+
+        return cls(dates, deaths, deaths >= 0, hospital_cases, hospital_cases >= 0, \
+                   new_cases, new_cases >= 0, area_name = area_name, area_type = area_type)
+
+    def last7days_cases(self):
+        """
+        Sums the 7 newest case values, skipping the newest one as it is incomplete
+        """
+        present = np.flatnonzero(self.new_cases_mask)[1:LAST7DAYS_COUNT + 1]
+        return int(self.new_cases[present].sum())
+
+    def current_hospital_cases(self):
+        """
+        Returns the newest hospital cases value
+        """
+        return latest_value(self.hospital_cases, self.hospital_cases_mask)
+
+    def total_deaths(self):
+        """
+        Returns the newest cumulative deaths value
+        """
+        return latest_value(self.deaths, self.deaths_mask)
+
+    def summary(self):
+        """
+        Returns the figures shown on the dashboard in a dictionary
+        """
+        return {"last7days_cases": self.last7days_cases(), \
+                "current_hospital_cases": self.current_hospital_cases(), \
+                    "total_deaths": self.total_deaths()}
+
+def split_by_area(rows, area_type, area_names = None):
+    """
+    Splits API rows covering many areas (e.g. one query for every ltla) into
+        a CovidTimeSeries for each area, keeping only area_names if given
+    """
+    wanted = None if area_names is None else set(area_names)
+    area_rows = {}
+    for row in rows:
+        area_name = row["areaName"]
+        if wanted is None or area_name in wanted:
+            area_rows.setdefault(area_name, []).append(row)
+
+    return {area_name: CovidTimeSeries.from_api_json(rows_for_area, area_name = area_name, \
+                                                     area_type = area_type) \
+            for area_name, rows_for_area in area_rows.items()}
+
+def metric_array(rows, metric):
+    """
+    Extracts one metric from the API rows into an integer array, with -1 for missing values
+    """
+    return np.fromiter((-1 if row[metric] is None else row[metric] for row in rows), \
+                       dtype = np.int64, count = len(rows))
+
+def latest_value(values, mask):
+    """
+    Returns the first (newest) value present, or 0 if there are none
+    """
+    present = np.flatnonzero(mask)
+    if present.size == 0:
+        return 0
+
+    return int(values[present[0]])
+
+def iter_csv_lines(csv_filename):
+    """
+    Yields the lines of a csv file one at a time from a memory map of the file
+    Only the lines being read are paged in, so memory use does not grow with the file size
+    The file is closed when the generator is finished or closed
+    """
+    log.info("Streaming csv file: " + csv_filename)
+    with open(csv_filename, 'rb') as csv_file:
+        if os.fstat(csv_file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(csv_file.fileno(), 0, access = mmap.ACCESS_READ) as mapped_file:
+            for line in iter(mapped_file.readline, b""):
+                yield line.decode("utf-8")
+
+def iter_csv_rows(csv_filename):
+    """
+    Yields the rows of a csv file lazily as lists of string values (not NumPy columns)
+    """
+    lines = iter_csv_lines(csv_filename)
+    with closing(lines):
+        yield from csv.reader(lines)
+
+def scan_latest_values(rows):
+    """
+    Goes through rows (newest first) and stops as soon as the newest
+        7 valid case values (after the incomplete newest one), hospital cases and deaths are found
+    Returns last7days_cases, current_hospital_cases, total_deaths
+    """
+    last7days_cases = 0
+    case_values_found = 0
+    current_hospital_cases = None
+    total_deaths = None
+
+    for row in rows:
+        if not row or row[AREA_CODE_COLUMN] == "areaCode":
+            continue
+
+        if current_hospital_cases is None and row[HOSPITAL_CASES_COLUMN].strip().isdigit():
+            current_hospital_cases = int(row[HOSPITAL_CASES_COLUMN])
+
+        if case_values_found <= LAST7DAYS_COUNT and row[NEW_CASES_COLUMN].strip().isdigit():
+            if case_values_found > 0:
+                last7days_cases = last7days_cases + int(row[NEW_CASES_COLUMN])
+            case_values_found +=1
+
+        if total_deaths is None and row[DEATHS_COLUMN].strip().isdigit():
+            total_deaths = int(row[DEATHS_COLUMN])
+
+        if case_values_found > LAST7DAYS_COUNT and current_hospital_cases is not None \
+                and total_deaths is not None:
+            break
+
+    if current_hospital_cases is None:
+        current_hospital_cases = 0
+    if total_deaths is None:
+        total_deaths = 0
+
+    return last7days_cases, current_hospital_cases, total_deaths
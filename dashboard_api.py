@@ -0,0 +1,254 @@
+"""
+This module handles:
+    - the json payloads of the dashboard data (covid data, news articles and scheduled updates)
+    - serializing and compressing each payload once per data version
+    - working out what changed since an earlier data version (?since=)
+    - the server-sent events stream pushing those changes to the dashboard (/events),
+        limited to max_streams open at once in this process and ended after max_lifetime
+        seconds (the browser reconnects), as each open stream holds a server thread
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+#brotli is optional, gzip is used when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#Importing the data version, increased whenever the dashboard data changes
+from page_cache import get_data_version, wait_for_data_version
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#Default settings, used for anything missing from the "events" section of the config file
+DEFAULT_EVENTS_SETTINGS = {"max_streams": 8, "max_lifetime": 300, "busy_retry": 30}
+
+def encode_payload(payload):
+    """
+    Serializes a payload to compact json and compresses it
+    Returns a dictionary of content encoding to body, and the ETag of the json
+    """
+    body = json.dumps(payload, separators = (",", ":")).encode("utf-8")
+    encodings = {"identity": body, "gzip": gzip.compress(body, compresslevel = 6)}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(body)
+
+    return encodings, hashlib.sha1(body).hexdigest()
+
+def diff_payload(old, new):
+    """
+    Compares two payloads made of sections (dictionaries keyed by e.g. area name or title)
+    Returns the items added or changed and the keys removed in each section
+    """
+    changed = {}
+    removed = {}
+    for section, items in new.items():
+        old_items = old.get(section, {})
+        section_changed = {key: value for key, value in items.items() \
+                           if key not in old_items or old_items[key] != value}
+        section_removed = [key for key in old_items if key not in items]
+        if section_changed:
+            changed[section] = section_changed
+        if section_removed:
+            removed[section] = section_removed
+
+    return {"changed": changed, "removed": removed}
+
+class ApiPayloadCache:
+    """
+    This class serves one json payload (built by calling build()) and the changes to it
+    Responses are serialized and compressed once per (data version, since) and reused
+        until the data changes
+    The payloads of the last history_size data versions are kept, so a client sending
+        ?since=<version> gets only the changes since then (or the full payload if that
+        version is too old)
+    """
+
+    def __init__(self, build, history_size = 64, max_entries = 32):
+        self.build = build
+        self.history_size = history_size
+        self.max_entries = max_entries
+        self.history = OrderedDict()
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get(self, since = None):
+        """
+        Returns (encodings, etag) for the payload, or for the changes since a data version
+        """
+        _, encodings, etag, _ = self.respond(since)
+
+        return encodings, etag
+
+    def get_changes(self, since):
+        """
+        Returns (data version, json body) of the changes since a data version,
+            with a body of None if nothing in this payload changed
+        """
+        data_version, encodings, _, changed = self.respond(since)
+
+        return data_version, encodings["identity"] if changed else None
+
+    def respond(self, since):
+        """
+        Returns (data version, encodings, etag, changed) for the payload or the changes since
+            a data version, where changed is False for changes with nothing in them
+        """
+        data_version = get_data_version()
+        key = (data_version, since)
+        with self.lock:
+            response = self.responses.get(key)
+            if response is not None:
+                self.responses.move_to_end(key)
+                self.counters["hits"] += 1
+                return response
+            self.counters["misses"] += 1
+
+        payload = self.build()
+        #Only remember the payload if no data changed while it was being built
+        stable = get_data_version() == data_version
+
+        with self.lock:
+            previous = None if since is None else self.history.get(since)
+            if stable:
+                self.remember(data_version, payload)
+
+        if previous is None:
+            body = {"version": data_version, "full": True, "data": payload}
+            changed = True
+        else:
+            body = dict(diff_payload(previous, payload), version = data_version, \
+                        since = since, full = False)
+            changed = bool(body["changed"] or body["removed"])
+        response = (data_version,) + encode_payload(body) + (changed,)
+
+        if stable:
+            with self.lock:
+                self.responses[key] = response
+                while len(self.responses) > self.max_entries:
+                    self.responses.popitem(last = False)
+
+        return response
+
+    def remember(self, data_version, payload):
+        """
+        Keeps the payload of a data version, the lock must already be held
+        An unchanged payload is shared with the previous version
+        """
+        if self.history:
+            last_payload = next(reversed(self.history.values()))
+            if last_payload == payload:
+                payload = last_payload
+        self.history[data_version] = payload
+        while len(self.history) > self.history_size:
+            self.history.popitem(last = False)
+
+def event_stream(payload_caches, since, heartbeat = 15.0, max_lifetime = None, \
+                 clock = time.monotonic):
+    """
+    Yields server-sent events with the changes to the payloads (a dictionary of event name
+        to ApiPayloadCache) each time the data version changes, starting from since
+    Nothing is sent until the data changes apart from a comment every heartbeat seconds,
+        and the changes for a version are encoded once however many streams are open
+    After max_lifetime seconds (if given) the stream ends with the id of the data version
+        it has reached, and the browser reconnects from there (Last-Event-ID)
+    """
+    version = get_data_version() if since is None else since
+    if version == get_data_version():
+        #Remembering the current payloads, so the first change is sent as a diff
+        for payload_cache in payload_caches.values():
+            payload_cache.get()
+    yield "retry: 5000\n\n"
+
+    end_time = None if max_lifetime is None else clock() + max_lifetime
+    while True:
+        timeout = heartbeat
+        if end_time is not None:
+            timeout = min(timeout, end_time - clock())
+            if timeout <= 0:
+                yield "id: {}\n\n".format(version)
+                return
+
+        if wait_for_data_version(version, timeout) == version:
+            yield ": keep-alive\n\n"
+            continue
+
+        events = []
+        latest_version = version
+        for name, payload_cache in payload_caches.items():
+            data_version, body = payload_cache.get_changes(version)
+            latest_version = max(latest_version, data_version)
+            if body is not None:
+                events.append("id: {}\nevent: {}\ndata: {}\n\n".format(data_version, name, \
+                                                                       body.decode("utf-8")))
+        version = latest_version
+        if events:
+            yield "".join(events)
+
+class StreamLimiter:
+    """
+    This class counts the open event streams, so no more than max_streams are open at once
+    The count is kept in the process (it guards that process's threads), it is not shared
+        with other processes
+    """
+
+    def __init__(self, max_streams = 8):
+        self.max_streams = max_streams
+        self.open_streams = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a place for a stream, returns False if all of them are taken
+        """
+        with self.lock:
+            if self.open_streams >= self.max_streams:
+                return False
+            self.open_streams += 1
+
+            return True
+
+    def release(self):
+        """
+        Gives back the place of a stream that has ended
+        """
+        with self.lock:
+            self.open_streams -= 1
+
+def limited_stream(limiter, stream, busy_retry = 30):
+    """
+    Yields from stream (a generator of server-sent events) while holding a place in limiter
+    If every place is taken, the browser is only told to reconnect in busy_retry seconds,
+        so open dashboard tabs cannot take every server thread
+    """
+    if not limiter.acquire():
+        log.warning("Too many event streams open, asking the browser to reconnect later")
+        yield "retry: {}\n\n".format(int(busy_retry * 1000))
+        return
+
+    try:
+        yield from stream
+    finally:
+        stream.close()
+        limiter.release()
+
+def best_encoding(accept_encodings, encodings):
+    """
+    Returns the best content encoding the client accepts out of those available
+        (request.accept_encodings in flask), preferring brotli then gzip
+    """
+    offered = [encoding for encoding in ("br", "gzip") if encoding in encodings]
+
+    return accept_encodings.best_match(offered, default = "identity") or "identity"
@@ -0,0 +1,195 @@
+"""
+This module handles:
+    - setting up logging once for the whole dashboard (the "logging" section of the config)
+    - handing log records to a queue, so logging in a request never waits for the log file
+    - writing the queued records to the log file in batches from a background thread,
+        starting a new file when it reaches max_bytes (keeping backup_count old files)
+    - sampling the DEBUG dumps of every scheduled update and job, which are only
+        written on one call in dump_every
+"""
+
+#Importing modules
+import atexit
+import itertools
+import logging
+import logging.handlers
+import queue
+import threading
+
+#Importing the shared configuration
+from config_handler import get_config
+
+#Format of the lines in the log file
+FORMAT = '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s'
+
+DEFAULT_LOGGING_SETTINGS = {"filename": "sys.log", "level": "DEBUG", "max_bytes": 10_000_000, \
+                            "backup_count": 3, "queue_size": 10_000, "batch_size": 500, \
+                                "dump_every": 100, "dump_max_items": 20}
+
+class BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    This class is a RotatingFileHandler which flushes the file once per batch of records
+        (by calling flush_batch) instead of after every record
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        """
+        Flushes the records written since the last batch to the file
+        """
+        super().flush()
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    This class puts log records on a bounded queue without waiting
+    When the queue is full (the log file cannot keep up) the record is dropped and counted
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogWriter:
+    """
+    This class writes the records put on a queue to a handler from a background thread
+    Every record waiting on the queue (up to batch_size) is written before the handler
+        is flushed, so a burst of records costs one flush
+    """
+
+    def __init__(self, log_queue, handler, batch_size = 500):
+        self.queue = log_queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the background thread
+        """
+        self.thread = threading.Thread(target = self.run, name = "log-writer", daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Writes the records already queued and stops the background thread
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.handler.close()
+
+    def run(self):
+        """
+        Writes batches of queued records until stop() is called
+        """
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is None:
+                    stopping = True
+                elif record.levelno >= self.handler.level:
+                    self.handler.handle(record)
+            self.handler.flush_batch()
+
+class DumpSampler:
+    """
+    This class decides which calls write a DEBUG dump of every item (e.g. every
+        scheduled update), so only one call in every dump_every does
+    """
+
+    def __init__(self, dump_every = 100, max_items = 20):
+        self.dump_every = max(1, dump_every)
+        self.max_items = max_items
+        self.calls = itertools.count()
+
+    def sample(self, logger):
+        """
+        Returns True if this call should write its dump to the logger
+        """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return False
+
+        return next(self.calls) % self.dump_every == 0
+
+    def items(self, items):
+        """
+        Returns the items to write in a dump (at most max_items of them)
+        """
+        return itertools.islice(items, self.max_items)
+
+#The background log writer (None until configure_logging is called)
+log_writer = None
+queue_handler = None
+
+#Sampler for the DEBUG dumps of the scheduled updates and scheduler jobs
+dump_sampler = DumpSampler(DEFAULT_LOGGING_SETTINGS["dump_every"], \
+                           DEFAULT_LOGGING_SETTINGS["dump_max_items"])
+
+def logging_settings():
+    """
+    Returns the logging settings from the config file, filled in with the defaults
+    """
+    settings = dict(DEFAULT_LOGGING_SETTINGS)
+    settings.update(get_config().get("logging", {}))
+
+    return settings
+
+def configure_logging(settings = None):
+    """
+    Sets up the root logger to hand records to the background log writer
+    Only the first call does anything, so every entry point can call it
+    Returns the log writer
+    """
+    global log_writer, queue_handler
+    if log_writer is not None:
+        return log_writer
+    if settings is None:
+        settings = logging_settings()
+
+    file_handler = BatchRotatingFileHandler(settings["filename"], encoding = 'utf-8', \
+                                            maxBytes = settings["max_bytes"], \
+                                            backupCount = settings["backup_count"])
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+    log_queue = queue.Queue(maxsize = settings["queue_size"])
+    queue_handler = DroppingQueueHandler(log_queue)
+
+    root = logging.getLogger()
+    root.setLevel(settings["level"])
+    root.addHandler(queue_handler)
+    dump_sampler.dump_every = max(1, settings["dump_every"])
+    dump_sampler.max_items = settings["dump_max_items"]
+
+    log_writer = LogWriter(log_queue, file_handler, settings["batch_size"])
+    log_writer.start()
+    atexit.register(stop_logging)
+
+    return log_writer
+
+def stop_logging():
+    """
+    Writes the queued records and removes the logging set up by configure_logging
+    """
+    global log_writer, queue_handler
+    if log_writer is None:
+        return
+
+    logging.getLogger().removeHandler(queue_handler)
+    log_writer.stop()
+    log_writer = None
+    queue_handler = None
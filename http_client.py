@@ -0,0 +1,166 @@
+"""
+This module handles:
+    - a shared, pooled HTTP session (keep-alive connections) with timeouts and retries
+    - conditional GET requests (ETag / Last-Modified), so unchanged responses are cheap 304s
+    - a token bucket rate limiter, so concurrent requests stay within an API quota
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import threading
+import time
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#Importing the metrics of the bytes and errors of upstream requests
+from metrics import upstream_bytes, upstream_errors
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#Default settings, used for anything missing from the "news_http" section of the config file
+DEFAULT_HTTP_SETTINGS = {"timeout": 10, "retries": 3, "backoff_factor": 0.5, \
+                         "backoff_jitter": 0.5, "pool_size": 10}
+
+#Default settings, used for anything missing from the "news_rate_limit" section of the config file
+DEFAULT_RATE_LIMIT_SETTINGS = {"rate": 1.0, "burst": 5}
+
+def create_session(retries = 3, backoff_factor = 0.5, backoff_jitter = 0.5, pool_size = 10):
+    """
+    Creates a requests session that keeps connections open and retries failed GET requests
+        (connection errors, 429 and 5xx) with exponential backoff and random jitter
+    """
+    retry = Retry(total = retries, backoff_factor = backoff_factor, \
+                  backoff_jitter = backoff_jitter, status_forcelist = (429, 500, 502, 503, 504), \
+                  allowed_methods = ("GET",), respect_retry_after_header = True, \
+                  raise_on_status = False)
+    adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, \
+                          max_retries = retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+class ConditionalGetClient:
+    """
+    This class makes GET requests for json through a shared session
+    The ETag and Last-Modified of each successful response are kept with its json, and sent
+        back as If-None-Match / If-Modified-Since, so an unchanged response is a 304
+        and the kept json is returned without downloading or parsing it again
+    The bytes received and the failed requests are counted in the upstream metrics under api
+    """
+
+    def __init__(self, session, timeout = 10, max_entries = 64, api = "http"):
+        self.session = session
+        self.bytes_received = upstream_bytes.labels(api)
+        self.errors = upstream_errors.labels(api)
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "not_modified": 0}
+
+    def get_json(self, url, params = None):
+        """
+        Returns the json for the url, from the kept response if the server answers 304
+        Responses that are not successful are returned but not kept
+        """
+        key = url if not params else url + "?" + repr(sorted(params.items()))
+        with self.lock:
+            cached = self.responses.get(key)
+            self.counters["requests"] += 1
+
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        try:
+            response = self.session.get(url, params = params, headers = headers, \
+                                        timeout = self.timeout)
+        except requests.RequestException:
+            self.errors.inc()
+            raise
+        self.bytes_received.inc(len(response.content))
+        if response.status_code >= 400:
+            self.errors.inc()
+
+        if response.status_code == 304 and cached is not None:
+            with self.lock:
+                self.counters["not_modified"] += 1
+                self.responses.move_to_end(key)
+            log.info("Response not modified, using kept json")
+            return cached[2]
+
+        data = response.json()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.ok and (etag or last_modified):
+            with self.lock:
+                self.responses[key] = (etag, last_modified, data)
+                self.responses.move_to_end(key)
+                while len(self.responses) > self.max_entries:
+                    self.responses.popitem(last = False)
+
+        return data
+
+def create_client(settings, api = "http"):
+    """
+    Creates a ConditionalGetClient from the "news_http" section of the config file
+    """
+    settings = dict(DEFAULT_HTTP_SETTINGS, **settings)
+    session = create_session(settings["retries"], settings["backoff_factor"], \
+                             settings["backoff_jitter"], settings["pool_size"])
+
+    return ConditionalGetClient(session, timeout = settings["timeout"], api = api)
+
+class RateLimiter:
+    """
+    This class is a token bucket shared by all of the threads making requests
+    Tokens are added at rate per second up to burst, and each request takes one,
+        waiting for the next token when the bucket is empty
+    """
+
+    def __init__(self, rate = 1.0, burst = 5, clock = time.monotonic, sleep = time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one is available
+        Returns the number of seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+            waited += wait
+
+def create_rate_limiter(settings):
+    """
+    Creates a RateLimiter from the "news_rate_limit" section of the config file
+    """
+    settings = dict(DEFAULT_RATE_LIMIT_SETTINGS, **settings)
+
+    return RateLimiter(settings["rate"], settings["burst"])
@@ -0,0 +1,117 @@
+"""
+This module load tests the dashboard and reports the latency percentiles (p50, p90, p99)
+
+Against a running dashboard:
+    python load_test.py --url http://127.0.0.1:5000 --paths /index /api/news
+
+Without --url, the dashboard is served in this process on a threaded Werkzeug server,
+    filled with sample data so no API requests are made
+"""
+
+#Importing modules
+import argparse
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the value at a fraction (0 to 1) of a sorted list (nearest rank)
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, min(len(sorted_values), math.ceil(fraction * len(sorted_values))))
+
+    return sorted_values[rank - 1]
+
+def latency_summary(latencies, errors, seconds):
+    """
+    Returns the request count, errors, requests per second and latency
+        percentiles (in milliseconds) of a load test
+    """
+    latencies = sorted(latencies)
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {"requests": len(latencies) + errors, "errors": errors, \
+            "rps": round((len(latencies) + errors) / seconds, 1), \
+            "p50_ms": milliseconds(percentile(latencies, 0.50)), \
+            "p90_ms": milliseconds(percentile(latencies, 0.90)), \
+            "p99_ms": milliseconds(percentile(latencies, 0.99)), \
+            "max_ms": milliseconds(latencies[-1] if latencies else None)}
+
+def run_load_test(url, paths, concurrency = 16, requests_count = 2000, headers = None):
+    """
+    Sends requests_count GET requests spread over the paths from concurrency threads
+        (each with its own keep-alive session) and returns the latency summary
+    Requests that fail or get a 4xx/5xx status are counted as errors
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    sessions = threading.local()
+
+    def send(index):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        path = paths[index % len(paths)]
+        start = time.perf_counter()
+        try:
+            response = sessions.session.get(url + path, headers = headers, timeout = 30)
+            failed = response.status_code >= 400
+        except requests.RequestException:
+            failed = True
+        elapsed = time.perf_counter() - start
+        with lock:
+            if failed:
+                errors[0] += 1
+            else:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        list(executor.map(send, range(requests_count)))
+
+    return latency_summary(latencies, errors[0], time.perf_counter() - start)
+
+def serve_dashboard():
+    """
+    Serves the dashboard (filled with sample data) on a local port in a background thread
+    Returns the server and its url
+    """
+    from werkzeug.serving import make_server
+    from covid_benchmarks import load_dashboard_data
+    import main
+
+    load_dashboard_data()
+    server = make_server("127.0.0.1", 0, main.app, threaded = True)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    return server, "http://127.0.0.1:{}".format(server.server_port)
+
+if __name__ == '__main__':
+    """
+    Running the load test from the command line
+    """
+    parser = argparse.ArgumentParser(description = "Load test the covid dashboard")
+    parser.add_argument("--url", help = "dashboard to test (default: serve one in this process)")
+    parser.add_argument("--paths", nargs = "+", default = ["/index", "/api/covid", "/api/news"])
+    parser.add_argument("--concurrency", type = int, default = 16)
+    parser.add_argument("--requests", type = int, default = 2000)
+    arguments = parser.parse_args()
+
+    server = None
+    url = arguments.url
+    if url is None:
+        server, url = serve_dashboard()
+    try:
+        for path in arguments.paths:
+            result = run_load_test(url.rstrip("/"), [path], arguments.concurrency, \
+                                   arguments.requests)
+            print(path, ", ".join("{}={}".format(key, value) for key, value in result.items()))
+    finally:
+        if server is not None:
+            server.shutdown()
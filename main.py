@@ -8,21 +8,35 @@ This is the main module, it handles:
 import logging
 
 #Importing modules
-import json
 import time
 
 #Importing flask modules to run flask
 from flask import Flask
-from flask import render_template, request
+from flask import render_template, request, make_response, jsonify
+from flask import Response, stream_with_context, g
+
+#Importing the shared configuration
+from config_handler import get_config, locations, start_config_watcher
+
+#Setting up the logging pipeline before the other modules start logging
+from dashboard_logging import configure_logging
+configure_logging()
 
 #Importing covid_data_handler module
 from covid_data_handler import schedule_covid_updates, update_covid_data, get_covid_data
+from covid_data_handler import get_area_covid_data, dashboard_area_names
+from covid_data_handler import get_area_aggregates, area_population
+from covid_data_handler import covid_api_payload
 
 #Importing covid_news_handling modules
 from covid_news_handling import add_seen_news_article
 from covid_news_handling import update_news
 from covid_news_handling import schedule_update_news
 from covid_news_handling import get_news_articles
+from covid_news_handling import news_api_payload
+
+#Importing the page cache and data version
+from page_cache import get_page_cache, get_data_version
 
 #Importing scheduler modules
 from scheduler import get_updates_scheduled
@@ -30,40 +44,186 @@ from scheduler import add_new_update_scheduled
 from scheduler import remove_scheduled_job
 from scheduler import log_scheduler
 from scheduler import log_updates_scheduled
-from scheduler import run_scheduler
+from scheduler import schedule_job
+from scheduler import start_scheduler_worker
 from scheduler import update_name_in_updates_scheduled
 from scheduler import remove_item_from_scheduled_updates
 from scheduler import calculate_delay
-from scheduler import calc_absolute_delay_time
+from scheduler import reschedule_update_scheduled
+from scheduler import set_updates_journal
+from scheduler import schedule_api_payload
+from scheduler import cancel_job
+
+#Importing the reading of the clock shared by a batch of scheduled updates
+from schedule_time import read_clock
+
+#Importing the cached, compressed json payloads served by the API
+from dashboard_api import ApiPayloadCache, best_encoding, event_stream
+from dashboard_api import DEFAULT_EVENTS_SETTINGS, StreamLimiter, limited_stream
+
+#Importing the journal used to restore updates_scheduled after a restart
+from scheduler_journal import UpdatesJournal
+
+#Importing the metrics served on /metrics
+import metrics
 
 #Calling Flask and assigning it to a variable
 app = Flask(__name__)
 
+#Reloading the configuration file when it changes
+start_config_watcher()
+
 #Title of the Dashboard
 title = "Covid Data Dashboard"
 
-#Setting up logging
-FORMAT = '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s'
+#Seconds before a scheduled update that could not be reviewed is tried again
+REVIEW_RETRY_DELAY = 60
+
+#json payloads served by /api/covid, /api/news and /api/schedule
+api_payloads = {"covid": ApiPayloadCache(covid_api_payload), \
+                "news": ApiPayloadCache(news_api_payload), \
+                "schedule": ApiPayloadCache(schedule_api_payload)}
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
 log = logging.getLogger(__name__)
-logging.basicConfig(filename = 'sys.log',  encoding='utf-8', \
-                    format = FORMAT, level=logging.DEBUG)
 
+#Limits on the /events streams, each of which holds a server thread while it is open
+events_settings = dict(DEFAULT_EVENTS_SETTINGS, **get_config().get("events", {}))
+event_streams = StreamLimiter(events_settings["max_streams"])
+
+#Recording the metrics unless they are turned off in the config file
+metrics.registry.enabled = get_config().get("metrics", {}).get("enabled", True)
+
+#Seconds taken to handle each route (until the response is returned)
+request_seconds = metrics.histogram("dashboard_request_seconds", \
+                                    "Seconds taken to handle a request", \
+                                    ("route", "method", "status"))
+
+#Seconds taken to render index.html (only when the page is not in the page cache)
+render_seconds = metrics.function_seconds.labels("render_index")
+
+#Number of /events streams open
+metrics.gauge("dashboard_event_streams", "Open server-sent event streams").labels() \
+    .set_function(lambda: event_streams.open_streams)
+
+@app.before_request
+def start_request_timer():
+    """
+    Notes when the request started, for dashboard_request_seconds
+    """
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    """
+    Records the seconds taken by the request under its route (e.g. /index), method and status
+    """
+    if "request_start" in g:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        request_seconds.labels(route, request.method, response.status_code) \
+            .observe(time.perf_counter() - g.request_start)
+
+    return response
+
+@app.route('/metrics')
+def metrics_page():
+    """
+    Returns the dashboard's metrics in the Prometheus text format
+    """
+    return Response(metrics.render_metrics(), content_type = metrics.CONTENT_TYPE)
 
 @app.route('/')
 def home_page():
     """
     Opening the home page, fetches the area and area type from the config file
         to be used to insert data into the render template
+    Any subset of the fetched areas can be shown with ?areas=Exeter,Plymouth
     """
     log.info("Home page is running")
 
-    nation_location, location = locations()
+    return render_index()
 
-    covid_data =  get_covid_data()
-    updates_scheduled = get_updates_scheduled()
-    news_articles = get_news_articles()
+@app.route('/api/covid')
+def covid_api():
+    """
+    Returns the covid data as json (see api_response)
+    """
+    return api_response(api_payloads["covid"])
+
+@app.route('/api/news')
+def news_api():
+    """
+    Returns the news articles as json (see api_response)
+    """
+    return api_response(api_payloads["news"])
+
+@app.route('/api/schedule')
+def schedule_api():
+    """
+    Returns the scheduled updates as json (see api_response)
+    """
+    return api_response(api_payloads["schedule"])
+
+def api_response(payload_cache):
+    """
+    Process serves a json payload, compressed with brotli or gzip if the client accepts it
+    With ?since=<version> (the version of an earlier response) only the changes are sent
+    Clients sending a matching If-None-Match header get 304 Not Modified
+    """
+    since = request.args.get('since', type = int)
+    encodings, etag = payload_cache.get(since)
+    encoding = best_encoding(request.accept_encodings, encodings)
+
+    response = make_response(encodings[encoding])
+    response.mimetype = "application/json"
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag + "-" + encoding)
+
+    return response.make_conditional(request)
+
+@app.route('/events')
+def events():
+    """
+    Streams server-sent events to the dashboard page: one "covid", "news" or "schedule"
+        event with the changes (as in ?since=) each time the data changes
+    The stream starts from ?since=<version> (the data version of the page), or from
+        the Last-Event-ID header when the browser reconnects
+    At most max_streams are open at once and each ends after max_lifetime seconds
+        (the "events" section of the config file), after which the browser reconnects
+    """
+    since = request.args.get('since', type = int)
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+
+    stream = event_stream(api_payloads, since, max_lifetime = events_settings["max_lifetime"])
+
+    return Response(stream_with_context(limited_stream(event_streams, stream, \
+                                                       events_settings["busy_retry"])), \
+                    mimetype = "text/event-stream", \
+                    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/api/aggregates')
+def covid_aggregates_api():
+    """
+    Returns the rolling aggregates of a metric for an area as json, e.g.
+        /api/aggregates?area=Exeter&metric=new_cases&days=7
+    The area defaults to the local area in the config file
+    """
+    area_name = request.args.get('area') or locations()[1]
+    metric = request.args.get('metric', 'new_cases')
+    days = request.args.get('days', 7, type = int)
+
+    aggregates = get_area_aggregates(area_name)
+    if aggregates is None or len(aggregates) == 0:
+        return jsonify({"error": "No covid data for " + area_name}), 404
 
-    return render_template("index.html", updates = updates_scheduled, title = title,location= location, local_7day_infections = covid_data["location_last7days_cases"], nation_location = nation_location, national_7day_infections = covid_data["nation_last7days_cases"], hospital_cases = covid_data["nation_current_hospital_cases"], deaths_total = covid_data["nation_total_deaths"], news_articles = news_articles, image = "covid_molecule.jpg")
+    try:
+        return jsonify(aggregates.report(metric, days, area_population(area_name)))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
 
 @app.route('/index')
 def process_index_url():
@@ -72,20 +232,18 @@ def process_index_url():
     - adding a scheduled (in future or instant)
     - deleting schedule
     - delete news item
-    - automatic refresh from the index.html page every minute
-        (from  <meta http-equiv="refresh" content="60;url='/index'">)
+    - loading the page (after the first load, changes to the data are pushed to the
+        page over /events, the meta refresh every minute is only used by browsers
+        without JavaScript, from <noscript> in index.html)
 
-    As well as processing the data from the web page, also run the scheduler and
-    check if any items in the updates_scheduled that need reviewing
+    The scheduler and the review of updates_scheduled are run by the background
+    scheduler worker, so no scheduled job runs during a request
     """
 
     log.info("request on /index ============")
     log_updates_scheduled("on /index")
     log_scheduler("on /index")
 
-    run_scheduler()
-    review_updates_scheduled()
-
     news_article = request.args.get('notif')
     update_item = request.args.get('update_item')
 
@@ -104,6 +262,7 @@ def schedule_data_updates(update_name):
     """
     This can be an instant update (schedule now if nothing is in the
         update field or at a later date if there is something in the update field)
+    Instant updates are also handed to the scheduler worker rather than run in the request
     No update is made if the update title (label) is already used
     """
 
@@ -123,25 +282,13 @@ def schedule_data_updates(update_name):
         log.warning("Title is already on the updates scheduled - ignoring request")
     elif update_time:
         log.info("scheduling an update")
+        clock = read_clock()
 
-        if (news_selected is not None):
-            update_interval = calculate_delay(update_time, 20)
-            update_news_event = schedule_update_news(update_interval \
-                                                     = update_interval, update_name = update_name)
-            log_scheduler("News Update Job Added")
-        else:
-            update_news_event = None
-
-        if (covid_data_selected is not None):
-            update_interval = calculate_delay(update_time, 10)
-            update_covid_event = schedule_covid_updates \
-                (update_interval = update_interval, update_name = update_name)
-            log_scheduler("Covid Data Update Job Added")
-        else:
-            update_covid_event = None
+        update_news_event, update_covid_event = schedule_update_jobs(update_name, update_time, \
+            news_selected, covid_data_selected, clock)
 
         """ Adding a new schedule update event with all needed data """
-        add_new_update_scheduled(title = update_name, content = content, update_time = update_time, update_covid_data = covid_data_selected, update_news = news_selected, repeat = repeat_selected, update_covid_event = update_covid_event, update_news_event = update_news_event)
+        add_new_update_scheduled(title = update_name, content = content, update_time = update_time, update_covid_data = covid_data_selected, update_news = news_selected, repeat = repeat_selected, update_covid_event = update_covid_event, update_news_event = update_news_event, clock = clock)
         log_updates_scheduled("New Schedule added with title: " + update_name)
 
         """ Checking whether value is None,
@@ -150,30 +297,49 @@ def schedule_data_updates(update_name):
         logging.warning("No time entered - instant update has been done")
         if (news_selected is not None):
             log.info("News update requested")
-            update_news()
+            schedule_job(0, update_news)
 
         if (covid_data_selected is not None):
             log.info("Covid data update requested")
-            update_covid_data(nation_location, location)
+            schedule_job(0, update_covid_data, \
+                         kwargs = {"nation_location":nation_location, "location":location})
 
-    news_articles = get_news_articles()
-    covid_data = get_covid_data()
-    updates_scheduled = get_updates_scheduled()
+    return render_index()
+
+def schedule_update_jobs(update_name, update_time, news_selected, covid_data_selected, \
+                         clock = None):
+    """
+    Creates the python scheduler jobs for a scheduled update at update_time (HH:MM)
+    The delays are worked out from clock (a ScheduleClock, a new reading if None)
+    Returns the news and covid data events (None for a job that is not selected)
+    """
+    if clock is None:
+        clock = read_clock()
+
+    if (news_selected is not None):
+        update_interval = calculate_delay(update_time, 20, clock)
+        update_news_event = schedule_update_news(update_interval \
+                                                 = update_interval, update_name = update_name)
+        log_scheduler("News Update Job Added")
+    else:
+        update_news_event = None
 
-    return render_template("index.html", updates = updates_scheduled, title = title, content = content, location= location, local_7day_infections = covid_data["location_last7days_cases"], nation_location = nation_location, national_7day_infections = covid_data["nation_last7days_cases"], hospital_cases = covid_data["nation_current_hospital_cases"], deaths_total = covid_data["nation_total_deaths"], news_articles = news_articles, image = "covid_molecule.jpg")
+    if (covid_data_selected is not None):
+        update_interval = calculate_delay(update_time, 10, clock)
+        update_covid_event = schedule_covid_updates \
+            (update_interval = update_interval, update_name = update_name)
+        log_scheduler("Covid Data Update Job Added")
+    else:
+        update_covid_event = None
+
+    return update_news_event, update_covid_event
 
 def index_refreshed():
     """
     Process calls  to the application when the page is beiing refreshed
     Ensures that all data is still present
     """
-    nation_location, location = locations()
-
-    news_articles = get_news_articles()
-    covid_data =  get_covid_data()
-    updates_scheduled = get_updates_scheduled()
-
-    return render_template("index.html", updates = updates_scheduled, title = title,location= location, local_7day_infections = covid_data["location_last7days_cases"], nation_location = nation_location, national_7day_infections = covid_data["nation_last7days_cases"], hospital_cases = covid_data["nation_current_hospital_cases"], deaths_total = covid_data["nation_total_deaths"], news_articles = news_articles, image = "covid_molecule.jpg")
+    return render_index()
 
 def remove_news_article(news_article):
     """
@@ -183,13 +349,7 @@ def remove_news_article(news_article):
     log.info("Processing notifications, news article removed")
     add_seen_news_article(news_article)
 
-    nation_location, location = locations()
-
-    news_articles = get_news_articles()
-    covid_data =  get_covid_data()
-    updates_scheduled = get_updates_scheduled()
-
-    return render_template("index.html", updates = updates_scheduled, title = title, location= location, local_7day_infections = covid_data["location_last7days_cases"], nation_location = nation_location, national_7day_infections = covid_data["nation_last7days_cases"], hospital_cases = covid_data["nation_current_hospital_cases"], deaths_total = covid_data["nation_total_deaths"], news_articles = news_articles, image = "covid_molecule.jpg")
+    return render_index()
 
 def delete_item_from_schedule(update_item):
     """
@@ -199,62 +359,128 @@ def delete_item_from_schedule(update_item):
     log.info("Scheduled item to delete: " + update_item)
     remove_scheduled_job(update_item)
 
+    return render_index()
+
+def render_index():
+    """
+    Process renders the dashboard page used by all of the handlers
+    The page is cached against the data version (and the areas shown), so it is only
+        rendered again after covid_data, news_articles or updates_scheduled change
+    Browsers sending a matching If-None-Match header get 304 Not Modified
+    """
+    data_version = get_data_version()
+
     nation_location, location = locations()
 
     news_articles = get_news_articles()
     covid_data = get_covid_data()
     updates_scheduled = get_updates_scheduled()
+    area_names = selected_areas()
+
+    #Only cache the page if no data changed while it was being gathered
+    if get_data_version() == data_version:
+        key = (data_version, nation_location, location, tuple(area_names))
+    else:
+        key = None
+
+    def render():
+        with render_seconds.time():
+            return render_template("index.html", updates = updates_scheduled, title = title, location= location, local_7day_infections = covid_data["location_last7days_cases"], nation_location = nation_location, national_7day_infections = covid_data["nation_last7days_cases"], hospital_cases = covid_data["nation_current_hospital_cases"], deaths_total = covid_data["nation_total_deaths"], news_articles = news_articles, areas = get_area_covid_data(area_names), image = "covid_molecule.jpg", data_version = data_version)
+
+    body, etag = get_page_cache().get_or_render(key, render)
+
+    response = make_response(body)
+    response.set_etag(etag)
 
-    return render_template("index.html", updates = updates_scheduled, title = title,location= location, local_7day_infections = covid_data["location_last7days_cases"], nation_location = nation_location, national_7day_infections = covid_data["nation_last7days_cases"], hospital_cases = covid_data["nation_current_hospital_cases"], deaths_total = covid_data["nation_total_deaths"], news_articles = news_articles, image = "covid_molecule.jpg")
+    return response.make_conditional(request)
 
 def review_updates_scheduled():
     """
-    Go through all dictionaries in updates_scheduled and
-        check if any have a absolute_delay_time in the past.
-    If in the past:
+    Go through the updates in updates_scheduled with an absolute_delay_time in the past
+        (found from the store's heap, so updates that are not due are not touched)
+    For each of them:
     - if repeat is set then create jobs in python scheduler for
         covid data (if set) and covid news (if set)
     - else remove the item from updates_scheduled
+    An update that cannot be handled is put back on the heap (see review_update_scheduled)
     """
 
     log.info("Reviewing the list of scheduled updates" )
     updates_scheduled = get_updates_scheduled()
-    for index, item in enumerate(updates_scheduled):
-        log.info("Checking ITEM {} {}".format(index + 1, item))
-        absolute_delay_time = item["absolute_delay_time"]
-        if time.time() > absolute_delay_time:
-            if item["repeat"]:
-                update_time = item["update_time"]
-                log.info("Creating new jobs in python scheduler for tomorrow at "+ update_time)
-                if item["update_covid_data"]:
-                    update_interval = calculate_delay(update_time, 10)
-                    update_covid_event = schedule_covid_updates(update_interval, item["title"])
-                    item["update_covid_event"] = update_covid_event
-                if item["update_news"]:
-                    update_interval = calculate_delay(update_time, 20)
-                    update_news_event = schedule_update_news(update_interval, item["title"])
-                    item["update_news_event"] = update_news_event
-                absolute_delay_time = calc_absolute_delay_time(update_time)
-                item["absolute_delay_time"] = absolute_delay_time
-                log_updates_scheduled("After review")
-                log_scheduler("After review")
-            else:
-                title = item["title"]
-                remove_item_from_scheduled_updates(title)
-                log_updates_scheduled("Removed " + title + " from scheduled updates ")
-
-def locations():
-    """
-    This function extracts data from the configuration file to set up
-        the national_location and location variable
-    This will help set up the locations for data to be pulled from the API
-    """
-    f = open('config.json',)
-    config_dict = json.load(f)
-    nation_location = config_dict["nation_location"]
-    location = config_dict["location"]
-
-    return nation_location, location
+    clock = read_clock()
+    for index, item in enumerate(updates_scheduled.pop_due(clock.timestamp)):
+        log.debug("Checking ITEM {} {}".format(index + 1, item))
+        try:
+            review_update_scheduled(item, clock)
+        except Exception:
+            log.exception("Could not review scheduled update " + item.title + \
+                          ", trying again in {} seconds".format(REVIEW_RETRY_DELAY))
+            updates_scheduled.requeue([item], retry_time = clock.timestamp + REVIEW_RETRY_DELAY)
+
+def review_update_scheduled(item, clock):
+    """
+    Creates tomorrow's jobs for a due repeating update, or removes a due update
+        that does not repeat
+    If creating the jobs fails, any already created are cancelled and the error is raised
+    """
+    if item.repeat:
+        update_time = item.update_time
+        log.info("Creating new jobs in python scheduler for tomorrow at "+ update_time)
+        new_events = {}
+        try:
+            if item.update_covid_data:
+                update_interval = calculate_delay(update_time, 10, clock)
+                new_events["update_covid_event"] = schedule_covid_updates(update_interval, item.title)
+            if item.update_news:
+                update_interval = calculate_delay(update_time, 20, clock)
+                new_events["update_news_event"] = schedule_update_news(update_interval, item.title)
+            reschedule_update_scheduled(item.title, update_time, clock, **new_events)
+        except Exception:
+            #Cancelling the jobs already created, so trying again does not run them twice
+            for event in new_events.values():
+                cancel_job(event)
+            raise
+        log_updates_scheduled("After review")
+        log_scheduler("After review")
+    else:
+        title = item.title
+        remove_item_from_scheduled_updates(title)
+        log_updates_scheduled("Removed " + title + " from scheduled updates ")
+
+def restore_updates_scheduled():
+    """
+    Replays the updates_scheduled journal at startup, so scheduled (and repeating)
+        updates survive a restart
+    The delays are calculated again from each update's time, then the journal is
+        compacted and used to record all further changes
+    """
+    journal = UpdatesJournal(get_config().get("updates_journal", "updates_journal.jsonl"))
+    clock = read_clock()
+    for record in journal.replay():
+        update_news_event, update_covid_event = schedule_update_jobs(record["title"], \
+            record["update_time"], record["update_news"], record["update_covid_data"], clock)
+        add_new_update_scheduled(title = record["title"], content = record["content"], update_time = record["update_time"], update_covid_data = record["update_covid_data"], update_news = record["update_news"], repeat = record["repeat"], update_covid_event = update_covid_event, update_news_event = update_news_event, clock = clock)
+
+    journal.compact()
+    set_updates_journal(journal)
+    log_updates_scheduled("Restored from journal")
+
+def selected_areas():
+    """
+    Process reads the areas to show from the "areas" request argument (comma separated)
+    If it is not given, the areas from the "areas" section of the config file are shown
+    """
+    area_names = request.args.get('areas')
+    if area_names:
+        return [area_name.strip() for area_name in area_names.split(",") if area_name.strip()]
+
+    return dashboard_area_names()
+
+#Restoring the scheduled updates from before a restart
+restore_updates_scheduled()
+
+#Running the scheduler and reviewing updates_scheduled in the background
+start_scheduler_worker(review = review_updates_scheduled)
 
 
 if __name__ == '__main__':
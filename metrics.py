@@ -0,0 +1,299 @@
+"""
+This module handles:
+    - counters, gauges and histograms of how the dashboard is running
+        (e.g. how long the covid and news API requests take, the bytes they return,
+        the latency of each route and the depth of the scheduler queue)
+    - timing functions with the timed decorator (or a histogram's time() context manager)
+    - writing all of the metrics in the Prometheus text format (served on /metrics)
+Recording a value takes a lock and, for a histogram, a bisect of its buckets,
+    so the metrics are cheap enough to leave on
+While the metrics are turned off (registry.enabled), counters and histograms record nothing
+"""
+
+#Importing modules
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+#Upper bounds (in seconds) of the buckets of timing histograms
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, \
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_value(value):
+    """
+    Returns a number as written in the Prometheus text format
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+def format_labels(names, values):
+    """
+    Returns the {name="value", ...} part of a line (an empty string without labels)
+    """
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") \
+               for value in values)
+
+    return "{" + ",".join(name + "=\"" + value + "\"" for name, value in zip(names, escaped)) + "}"
+
+class CounterValue:
+    """
+    This class holds the value of a counter (for one set of label values)
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount = 1):
+        """
+        Increases the counter by amount (nothing is recorded while the metrics are turned off)
+        """
+        if registry.enabled:
+            self.add(amount)
+
+    def add(self, amount):
+        """
+        Adds amount to the value
+        """
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, label_names, label_values):
+        return [name + format_labels(label_names, label_values) + " " + format_value(self.value)]
+
+class GaugeValue(CounterValue):
+    """
+    This class holds the value of a gauge (for one set of label values), which can go down
+    With set_function, the value is worked out when the metrics are read instead
+    A gauge is kept while the metrics are turned off, so each inc still has its dec
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def set(self, value):
+        """
+        Sets the gauge to value
+        """
+        with self.lock:
+            self.value = value
+
+    def inc(self, amount = 1):
+        """
+        Increases the gauge by amount
+        """
+        self.add(amount)
+
+    def dec(self, amount = 1):
+        """
+        Decreases the gauge by amount
+        """
+        self.add(-amount)
+
+    def set_function(self, function):
+        """
+        Reads the gauge by calling function() each time the metrics are written
+        """
+        self.function = function
+
+    def samples(self, name, label_names, label_values):
+        if self.function is not None:
+            self.value = self.function()
+
+        return super().samples(name, label_names, label_values)
+
+class HistogramValue:
+    """
+    This class holds the buckets, sum and count of a histogram (for one set of label values)
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Adds a value (e.g. seconds taken) to the histogram
+        Nothing is recorded while the metrics are turned off
+        """
+        if not registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the seconds taken by the block of a with statement
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name, label_names, label_values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(name + "_bucket" + format_labels(label_names + ("le",), \
+                label_values + (format_value(upper_bound),)) + " " + str(cumulative))
+        labels = format_labels(label_names, label_values)
+        lines.append(name + "_sum" + labels + " " + format_value(total))
+        lines.append(name + "_count" + labels + " " + str(cumulative))
+
+        return lines
+
+class Metric:
+    """
+    This class is a named metric, holding one value (counter, gauge or histogram)
+        for each set of label values used
+    A metric without label names has one value, metric.labels()
+    """
+
+    def __init__(self, kind, name, documentation, label_names, make_value):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.make_value = make_value
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *label_values):
+        """
+        Returns the value for a set of label values (made the first time they are used)
+        """
+        label_values = tuple(str(value) for value in label_values)
+        value = self.values.get(label_values)
+        if value is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(self.name + " has labels " + ", ".join(self.label_names))
+            with self.lock:
+                value = self.values.setdefault(label_values, self.make_value())
+
+        return value
+
+    def render(self):
+        """
+        Returns the lines of this metric in the Prometheus text format
+        """
+        lines = ["# HELP " + self.name + " " + self.documentation, \
+                 "# TYPE " + self.name + " " + self.kind]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.extend(value.samples(self.name, self.label_names, label_values))
+
+        return lines
+
+class MetricsRegistry:
+    """
+    This class holds the metrics of the dashboard by name
+    Asking for a metric that already exists returns it, so several modules can share one
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.enabled = True
+
+    def get_or_create(self, kind, name, documentation, label_names, make_value):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = Metric(kind, name, documentation, label_names, make_value)
+                self.metrics[name] = metric
+            elif metric.kind != kind:
+                raise ValueError(name + " is already a " + metric.kind)
+
+        return metric
+
+    def render(self):
+        """
+        Returns all of the metrics in the Prometheus text format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+#The metrics of the dashboard, served on /metrics
+registry = MetricsRegistry()
+
+#Content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def counter(name, documentation, label_names = ()):
+    """
+    Returns the counter with the name, made if it does not exist
+    """
+    return registry.get_or_create("counter", name, documentation, label_names, CounterValue)
+
+def gauge(name, documentation, label_names = ()):
+    """
+    Returns the gauge with the name, made if it does not exist
+    """
+    return registry.get_or_create("gauge", name, documentation, label_names, GaugeValue)
+
+def histogram(name, documentation, label_names = (), buckets = DEFAULT_BUCKETS):
+    """
+    Returns the histogram with the name, made if it does not exist
+    """
+    buckets = tuple(sorted(buckets))
+
+    return registry.get_or_create("histogram", name, documentation, label_names, \
+                                  lambda: HistogramValue(buckets))
+
+#Seconds taken by the functions on the hot path, labelled by function name
+function_seconds = histogram("dashboard_function_seconds", \
+                             "Seconds taken by instrumented dashboard functions", ("function",))
+
+#Bytes received from and failed requests to the covid and news APIs, labelled by API
+upstream_bytes = counter("dashboard_upstream_bytes_total", \
+                         "Bytes received from upstream APIs", ("api",))
+upstream_errors = counter("dashboard_upstream_errors_total", \
+                          "Failed requests to upstream APIs", ("api",))
+
+def timed(function):
+    """
+    Decorator recording the seconds a function takes in dashboard_function_seconds
+        (labelled with the function's name), including calls that raise an error
+    """
+    seconds = function_seconds.labels(function.__name__)
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds.observe(time.perf_counter() - start)
+
+    return timed_function
+
+def render_metrics():
+    """
+    Returns the dashboard's metrics in the Prometheus text format
+    """
+    return registry.render()
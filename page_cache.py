@@ -0,0 +1,112 @@
+"""
+This module handles:
+    - the data version, increased whenever covid_data, news_articles or updates_scheduled change
+    - caching rendered pages against the data version so unchanged pages are not rendered again
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import hashlib
+import threading
+from collections import OrderedDict
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#version of the dashboard data, increased on every change
+#(threads waiting for a change, e.g. the /events streams, are woken up by data_version_changed)
+data_version = 0
+data_version_lock = threading.Lock()
+data_version_changed = threading.Condition(data_version_lock)
+
+def bump_data_version(reason):
+    """
+    Process increases the data version so cached pages are rendered again
+    """
+    global data_version
+    with data_version_lock:
+        data_version += 1
+        log.info("Data version {} ({})".format(data_version, reason))
+        data_version_changed.notify_all()
+
+def wait_for_data_version(version, timeout):
+    """
+    Waits up to timeout seconds for the data version to be different from version
+    Returns the current data version
+    """
+    with data_version_lock:
+        data_version_changed.wait_for(lambda: data_version != version, timeout)
+
+        return data_version
+
+def get_data_version():
+    """
+    Returns the current data version
+    """
+    return data_version
+
+class PageCache:
+    """
+    This class keeps the most recently rendered pages, keyed on the data version
+        and anything else the page depends on (e.g. the areas shown)
+    Each page is stored as bytes with an ETag so browsers can be sent 304 Not Modified
+    """
+
+    def __init__(self, max_entries = 32):
+        self.max_entries = max_entries
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+        self.enabled = True
+
+    def get_or_render(self, key, render):
+        """
+        Returns (body, etag) for the key, calling render() to create the page if it is not cached
+        A key of None renders the page without caching it
+        """
+        if key is None:
+            body = render().encode("utf-8")
+            return body, hashlib.sha1(body).hexdigest()
+
+        with self.lock:
+            page = self.pages.get(key) if self.enabled else None
+            if page is not None:
+                self.pages.move_to_end(key)
+                self.counters["hits"] += 1
+                return page
+            self.counters["misses"] += 1
+
+        body = render().encode("utf-8")
+        page = (body, hashlib.sha1(body).hexdigest())
+
+        self.store(key, page)
+
+        return page
+
+    def store(self, key, page):
+        """
+        Stores a page, evicting the least recently used pages over max_entries
+        """
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_entries:
+                self.pages.popitem(last = False)
+
+    def clear(self):
+        """
+        Removes all of the cached pages
+        """
+        with self.lock:
+            self.pages.clear()
+
+#cache of the rendered dashboard page
+page_cache = PageCache()
+
+def get_page_cache():
+    """
+    Returns the page cache to be used in other modules
+    """
+    return page_cache
@@ -0,0 +1,117 @@
+"""
+This module handles the time arithmetic of scheduled updates:
+    - parsing an update time ("HH:MM") into seconds since midnight, once per distinct time
+    - working out the delay until an update time from one reading of the clock, so the
+        delays of a whole batch of updates (e.g. at startup or in a review) are consistent
+    - the time zone update times are in (the "timezone" in the config file, e.g.
+        "Europe/London", or the computer's local time zone), including the days
+        the clocks change for daylight saving time
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import functools
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+#Importing the shared configuration
+from config_handler import get_config
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+@functools.lru_cache(maxsize = 4096)
+def second_of_day(hours_minutes):
+    """
+    Returns the seconds since midnight of an update time in HH:MM format (e.g. 12:30)
+    Each distinct time is only parsed once
+    """
+    hours_minutes_list = hours_minutes.split(':')
+    hours = int(hours_minutes_list[0])
+    minutes = int(hours_minutes_list[1])
+
+    return (hours * 60 * 60) + (minutes * 60)
+
+@functools.lru_cache(maxsize = 16)
+def load_timezone(name):
+    """
+    Returns the time zone with the name, or None (the local time zone) if it is not known
+    """
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        log.warning("Unknown time zone " + name + ", using the local time zone")
+        return None
+
+def schedule_timezone():
+    """
+    Returns the time zone of the update times from the config file
+        (None for the computer's local time zone)
+    """
+    name = get_config().get("timezone")
+
+    return load_timezone(name) if name else None
+
+class ScheduleClock:
+    """
+    This class is one reading of the clock, used to work out the delays until update times
+    Update times are wall clock times in the time zone (None for local time), so on the
+        days the clocks change, the delay is the real number of seconds until then
+    Away from those days the delays are the same as the previous calculate_delay
+    """
+
+    def __init__(self, timezone = None, now = None):
+        self.timezone = timezone
+        self.timestamp = time.time() if now is None else now
+        wall_time = datetime.fromtimestamp(self.timestamp, timezone).replace(tzinfo = None)
+        self.midnight = wall_time.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+        self.seconds_since_midnight = (wall_time - self.midnight).total_seconds()
+        self.fire_timestamps = {}
+
+    def fire_timestamp(self, days, seconds):
+        """
+        Returns the timestamp of the wall clock time days after today's midnight plus seconds
+        """
+        key = (days, seconds)
+        timestamp = self.fire_timestamps.get(key)
+        if timestamp is None:
+            wall_time = self.midnight + timedelta(days = days, seconds = seconds)
+            if self.timezone is not None:
+                wall_time = wall_time.replace(tzinfo = self.timezone)
+            timestamp = wall_time.timestamp()
+            self.fire_timestamps[key] = timestamp
+
+        return timestamp
+
+    def delay(self, hours_minutes, delay_delta_seconds):
+        """
+        Returns the seconds until delay_delta_seconds after the next hours_minutes (HH:MM),
+            which is tomorrow if that is not at least delay_delta_seconds away today
+        """
+        seconds = second_of_day(hours_minutes)
+        days = 0 if seconds > self.seconds_since_midnight + delay_delta_seconds else 1
+
+        return self.fire_timestamp(days, seconds + delay_delta_seconds) - self.timestamp
+
+    def absolute_time(self, hours_minutes, delay_delta_seconds):
+        """
+        Returns the timestamp delay_delta_seconds after the next hours_minutes (HH:MM)
+        """
+        return self.timestamp + self.delay(hours_minutes, delay_delta_seconds)
+
+    def delays(self, update_times, delay_delta_seconds):
+        """
+        Returns the delays of a batch of update times, all from this reading of the clock
+        """
+        return [self.delay(update_time, delay_delta_seconds) for update_time in update_times]
+
+def read_clock():
+    """
+    Returns a ScheduleClock for now in the time zone from the config file
+    """
+    return ScheduleClock(schedule_timezone())
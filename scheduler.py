@@ -1,25 +1,282 @@
 """
 This module contains the schedular data used by the other modules
+It also runs the scheduler in a background worker thread, which hands the
+    scheduled jobs to a bounded thread pool so they never run in a request
 """
 
 #importing modules for logging
 import logging
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+import heapq
+import itertools
 import sched
+import threading
 import time
+from types import MappingProxyType
 
-#Setting up logging
-FORMAT = '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s'
+#Importing the shared configuration
+from config_handler import get_config
+
+#importing the data version so cached pages are rendered again after a change
+from page_cache import bump_data_version
+
+#importing the copy-on-write state, so readers always see a whole change to updates_scheduled
+from state import CopyOnWriteState
+
+#importing the sampler for the DEBUG dumps of every job and scheduled update
+from dashboard_logging import dump_sampler
+
+#importing the time arithmetic of update times (parsed once, one clock read per batch)
+from schedule_time import read_clock
+
+#importing the metrics of the scheduler (run time, queue depth and job lag)
+from metrics import counter, gauge, histogram, timed
+
+#importing the single flight calls, so duplicate jobs share one run
+from single_flight import SingleFlight
+
+#importing the fields of a scheduled update that are saved (and served by the json API)
+from scheduler_journal import JOURNAL_FIELDS
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
 log = logging.getLogger(__name__)
-logging.basicConfig(filename = 'sys.log', encoding='utf-8', format = FORMAT, level=logging.DEBUG)
 
 #python schedular
 scheduler = sched.scheduler(time.time, time.sleep)
 
-# updates_scheduled: a list of future scheduled updates stored in a dictionary
-#(this can have one or two jobs if both covid data and news are requested).
-updates_scheduled = []
+#Most seconds the worker waits before checking the scheduler and updates_scheduled again
+#(the same as the page refresh that used to run the scheduler)
+WORKER_MAX_WAIT = 60.0
+
+#Number of jobs that can be running or waiting to run at once
+MAX_PENDING_JOBS = 8
+
+#thread pool that runs the scheduled jobs, limited to MAX_PENDING_JOBS by job_slots
+job_executor = ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "scheduled-job")
+job_slots = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+
+#Default settings, used for anything missing from the "job_coalescing" section of the config file
+DEFAULT_COALESCING_SETTINGS = {"enabled": True, "window": 60}
+
+#runs of the scheduled jobs, so the same job due at about the same time is only run once
+job_flights = SingleFlight()
+
+#jobs added by schedule_job_once that have not started yet
+queued_jobs = set()
+queued_jobs_lock = threading.Lock()
+
+#background worker running the scheduler, and the event used to wake it when jobs are added
+scheduler_worker = None
+scheduler_wakeup = threading.Event()
+scheduler_stop = threading.Event()
+
+@dataclass(frozen = True)
+class ScheduledUpdate:
+    """
+    This class holds one scheduled update
+    (this can have one or two jobs if both covid data and news are requested).
+    It is read-only, a changed update is a new ScheduledUpdate (see dataclasses.replace)
+    """
+    __slots__ = ("title", "content", "update_time", "update_covid_data", "update_news", \
+                 "repeat", "update_covid_event", "update_news_event", "absolute_delay_time")
+    title: str
+    content: str
+    update_time: str
+    update_covid_data: object
+    update_news: object
+    repeat: object
+    update_covid_event: object
+    update_news_event: object
+    absolute_delay_time: float
+
+class UpdatesScheduledStore:
+    """
+    This class holds the scheduled updates in a dictionary keyed by title (in the order added)
+        and a min-heap of (due time, sequence number, title), so finding the due updates
+        only touches the updates that are due
+    Each update's live heap item is the one with its sequence number in live_items, so heap
+        items for removed, re-added or rescheduled updates, and items that have been
+        popped already, are skipped when they reach the top
+    The dictionary is published as read-only snapshots (copy-on-write), so reading never
+        blocks or sees half of a change, and changes are made one at a time
+        (the heap is only used by writers, under the same lock)
+    """
+
+    def __init__(self):
+        self.state = CopyOnWriteState(MappingProxyType({}))
+        self.due_heap = []
+        self.live_items = {}
+        self.sequence = itertools.count()
+
+    @property
+    def entries(self):
+        """
+        The current snapshot of the scheduled updates, a read-only dictionary keyed by title
+        """
+        return self.state.snapshot()
+
+    def add(self, entry):
+        """
+        Adds (or replaces) a scheduled update
+        """
+        def add_entry(entries):
+            added = dict(entries)
+            added[entry.title] = entry
+            self.push(entry, added)
+            return MappingProxyType(added)
+
+        self.state.update(add_entry)
+
+    def add_all(self, new_entries):
+        """
+        Adds (or replaces) several scheduled updates with a single copy of the dictionary
+        """
+        def add_entries(entries):
+            added = dict(entries)
+            for entry in new_entries:
+                added[entry.title] = entry
+                self.push(entry, added)
+            return MappingProxyType(added)
+
+        self.state.update(add_entries)
+
+    def requeue(self, due_entries, retry_time = None):
+        """
+        Puts updates returned by pop_due back on the heap, e.g. when they could not be handled
+        With retry_time, they are due again at retry_time instead of straight away
+            (their absolute_delay_time is not changed)
+        Updates that have since been removed, replaced or rescheduled are not put back
+        """
+        def push_entries(entries):
+            for entry in due_entries:
+                if entries.get(entry.title) is entry and entry.title not in self.live_items:
+                    self.push(entry, entries, retry_time)
+            return entries
+
+        self.state.update(push_entries)
+
+    def push(self, entry, entries, due_time = None):
+        """
+        Adds the update to the heap, due at due_time (its absolute_delay_time if None),
+            tidying the heap if it is mostly made of skipped items
+        The new heap item replaces any earlier one for the same title as its live item
+        entries is the dictionary being published, the write lock must already be held
+        """
+        if due_time is None:
+            due_time = entry.absolute_delay_time
+        sequence = next(self.sequence)
+        self.live_items[entry.title] = sequence
+        heapq.heappush(self.due_heap, (due_time, sequence, entry.title))
+        if len(self.due_heap) > 2 * len(entries) + 64:
+            self.due_heap = [item for item in self.due_heap if self.is_live(item)]
+            heapq.heapify(self.due_heap)
+
+    def is_live(self, item):
+        """
+        Returns True if the heap item is the live item of its update (not skipped)
+        """
+        _, sequence, title = item
+        return self.live_items.get(title) == sequence
+
+    def get(self, title):
+        """
+        Returns the scheduled update with the title, or None
+        """
+        return self.state.snapshot().get(title)
+
+    def remove(self, title):
+        """
+        Removes and returns the scheduled update with the title, or None if it is not present
+        """
+        removed = []
+
+        def remove_entry(entries):
+            if title not in entries:
+                return entries
+            remaining = dict(entries)
+            removed.append(remaining.pop(title))
+            self.live_items.pop(title, None)
+            return MappingProxyType(remaining)
+
+        self.state.update(remove_entry)
+
+        return removed[0] if removed else None
+
+    def reschedule(self, title, absolute_delay_time, **changes):
+        """
+        Changes when a scheduled update is next due (and any other fields in changes,
+            e.g. the events of its new jobs)
+        Returns the new scheduled update, or None if it has been removed
+        """
+        def reschedule_entry(entries):
+            if title not in entries:
+                return entries
+            entry = replace(entries[title], absolute_delay_time = absolute_delay_time, **changes)
+            rescheduled = dict(entries)
+            rescheduled[title] = entry
+            self.push(entry, rescheduled)
+            return MappingProxyType(rescheduled)
+
+        return self.state.update(reschedule_entry).get(title)
+
+    def pop_due(self, now):
+        """
+        Returns the scheduled updates due before now
+        They stay in the store until removed or rescheduled, but are only returned once
+            (until they are rescheduled, re-added or requeued)
+        """
+        due = []
+
+        def pop(entries):
+            while self.due_heap and self.due_heap[0][0] < now:
+                item = heapq.heappop(self.due_heap)
+                if self.is_live(item):
+                    title = item[2]
+                    del self.live_items[title]
+                    due.append(entries[title])
+            return entries
+
+        self.state.update(pop)
+
+        return due
+
+    def next_due_time(self):
+        """
+        Returns the earliest due time in the heap (None if it is empty)
+        """
+        due_heap = self.due_heap
+        if due_heap:
+            return due_heap[0][0]
+
+        return None
+
+    def __contains__(self, title):
+        return title in self.state.snapshot()
+
+    def __iter__(self):
+        return iter(self.state.snapshot().values())
+
+    def __len__(self):
+        return len(self.state.snapshot())
+
+# updates_scheduled: the future scheduled updates
+updates_scheduled = UpdatesScheduledStore()
+
+#Metrics read when /metrics is requested, and the seconds jobs start after they are due
+gauge("dashboard_scheduler_queue_depth", "Jobs waiting in the scheduler").labels() \
+    .set_function(lambda: len(scheduler.queue))
+gauge("dashboard_updates_scheduled", "Scheduled updates").labels() \
+    .set_function(lambda: len(updates_scheduled))
+job_lag_seconds = histogram("dashboard_scheduler_job_lag_seconds", \
+                            "Seconds between a job being due and starting").labels()
+job_runs = counter("dashboard_scheduled_job_runs_total", "Scheduled jobs run", ("job",))
+coalesced_jobs = counter("dashboard_coalesced_jobs_total", \
+                         "Scheduled jobs that shared the run of the same job", ("job",))
+
+#journal that records the changes to updates_scheduled (None until set at startup)
+updates_journal = None
 
 def get_scheduler():
     """
@@ -39,21 +296,33 @@ def log_scheduler(message):
     """
     Process used to log information easily in other modules
     Gathers number of items in schedule queue
+    The jobs themselves are only logged (at DEBUG) on the calls picked by the dump sampler
     """
-    log.info("Scheduler size: {}".format(len(scheduler.queue)))
+    jobs = scheduler.queue
+    log.info("Scheduler size: {}".format(len(jobs)))
 
-    for index, job in enumerate(scheduler.queue):
-        log.info("JOB {} {}".format((index + 1), job))
+    if dump_sampler.sample(log):
+        for index, job in enumerate(dump_sampler.items(jobs)):
+            log.debug("JOB {} {}".format((index + 1), job))
 
 def log_updates_scheduled(message):
     """
     Process used to log information easily in other modules
     Gathers number of items that have been updates
+    The items themselves are only logged (at DEBUG) on the calls picked by the dump sampler
     """
     log.info(" updates_scheduled size: {}".format(len(updates_scheduled)))
 
-    for index, item in enumerate(updates_scheduled):
-        log.info("ITEM {} {} ".format(index + 1, item))
+    if dump_sampler.sample(log):
+        for index, item in enumerate(dump_sampler.items(updates_scheduled)):
+            log.debug("ITEM {} {} ".format(index + 1, item))
+
+def set_updates_journal(journal):
+    """
+    Sets the journal used to record changes to updates_scheduled
+    """
+    global updates_journal
+    updates_journal = journal
 
 def get_updates_scheduled():
     """
@@ -61,104 +330,300 @@ def get_updates_scheduled():
     """
     return updates_scheduled
 
+def schedule_api_payload():
+    """
+    Returns updates_scheduled for the json API, keyed by title
+    (the scheduler events are left out)
+    """
+    return {"updates": {update.title: {field: getattr(update, field) for field in JOURNAL_FIELDS} \
+                        for update in updates_scheduled}}
+
+@timed
 def run_scheduler():
     """
     Process for schduling, states the size of the scheduler queue
     Makes sure blocking is set to False
+    Returns the seconds until the next scheduled event (None if there are none)
     """
     log.info("Size of scheduler queue (before testing) {}".format(len(scheduler.queue)))
     if not scheduler.empty():
         #Since blocking = false, this executes the scheduled events due to expire soonest (if any)
-        scheduler.run(blocking=False)
+        delay = scheduler.run(blocking=False)
         log_scheduler("Post schedular run")
+        return delay
+
+    return None
 
-def calc_absolute_delay_time(update_time):
+def schedule_job(delay, action, kwargs = None):
+    """
+    Adds a job to the scheduler, to be run on the job thread pool after delay seconds
+    A job with no delay is an instant job (e.g. "update now"), which only shares a run of
+        the same job that is still running, never one that has finished (see run_coalesced)
+    The worker is woken so it can take the new job into account
+    Returns the scheduler event, which can be cancelled
+    """
+    due_time = scheduler.timefunc() + delay
+    event = scheduler.enterabs(due_time, 1, dispatch_job, \
+                               argument = (action, due_time, delay <= 0), kwargs = kwargs or {})
+    scheduler_wakeup.set()
+
+    return event
+
+def schedule_job_once(action, kwargs = None):
+    """
+    Adds a job to run now, unless the same job (the same action and kwargs) was added
+        by an earlier call and has not started yet
+    Used to fetch data in the background when a request finds none, so every request
+        made before the fetch starts does not add another job
+    Returns the scheduler event, or None if the job was already waiting
+    """
+    key = job_key(action, kwargs or {})
+    with queued_jobs_lock:
+        if key in queued_jobs:
+            return None
+        queued_jobs.add(key)
+
+    log.info("Queueing background job {}".format(action.__name__))
+
+    return schedule_job(0, action, kwargs)
+
+def job_key(action, kwargs):
+    """
+    Returns the key of a job: its action's name and its kwargs
+    """
+    return (action.__name__, tuple(sorted(kwargs.items())))
+
+def dispatch_job(action, due_time, instant = False, **kwargs):
+    """
+    Hands a due job to the job thread pool
+    Waits for a free slot if MAX_PENDING_JOBS jobs are already running or waiting
+    """
+    job_slots.acquire()
+    log.info("Dispatching job {}".format(action.__name__))
+    job_executor.submit(run_job, action, kwargs, due_time, instant)
+
+def run_job(action, kwargs, due_time = None, instant = False):
+    """
+    Runs a job on the job thread pool, logging any error so the pool keeps running
+    The seconds between due_time and the job starting are recorded as the job lag
+    instant is True for a job added with no delay (see run_coalesced)
+    """
+    if due_time is not None:
+        job_lag_seconds.observe(max(time.time() - due_time, 0))
+    with queued_jobs_lock:
+        queued_jobs.discard(job_key(action, kwargs))
+    try:
+        run_coalesced(action, kwargs, due_time, instant = instant)
+    except Exception:
+        log.exception("Scheduled job {} failed".format(action.__name__))
+    finally:
+        job_slots.release()
+
+def coalescing_settings():
+    """
+    Returns the job coalescing settings from the config file, filled in with the defaults
+    """
+    settings = dict(DEFAULT_COALESCING_SETTINGS)
+    settings.update(get_config().get("job_coalescing", {}))
+
+    return settings
+
+def run_coalesced(action, kwargs, due_time = None, settings = None, instant = False):
+    """
+    Runs a job, unless the same job (the same action and kwargs, e.g. update_covid_data
+        for the same locations) is already running or was due within the coalescing window,
+        in which case it shares that run and its result instead of fetching again
+    An instant job (e.g. the user asking to update now) only shares a run that is still
+        running, so it always gets data fetched after it was asked for
+    settings are the coalescing settings (from the config file if None)
+    Returns the result of the job (None for a job sharing a run that has not finished)
+    """
+    if settings is None:
+        settings = coalescing_settings()
+    if not settings["enabled"]:
+        job_runs.labels(action.__name__).inc()
+        return action(**kwargs)
+    if due_time is None:
+        due_time = time.time()
+
+    window = None if instant else settings["window"]
+    future, ran = job_flights.run(job_key(action, kwargs), lambda: action(**kwargs), due_time, \
+                                  window)
+    if not ran:
+        coalesced_jobs.labels(action.__name__).inc()
+        log.info("Job {} shares a run of the same job".format(action.__name__))
+        return future.result() if future.done() else None
+    job_runs.labels(action.__name__).inc()
+
+    return future.result()
+
+def scheduler_loop(review):
+    """
+    The worker's loop: dispatches due jobs, then calls review (if given) to check
+        updates_scheduled, then sleeps until the next job or update is due, or until woken up
+    """
+    log.info("Scheduler worker started")
+    while not scheduler_stop.is_set():
+        try:
+            delay = run_scheduler()
+            if review is not None:
+                review()
+        except Exception:
+            log.exception("Scheduler worker run failed")
+            delay = None
+
+        next_due_time = updates_scheduled.next_due_time()
+        if next_due_time is not None and review is not None:
+            review_delay = max(next_due_time - time.time(), 0)
+            if delay is None or review_delay < delay:
+                delay = review_delay
+        if delay is None or delay > WORKER_MAX_WAIT:
+            delay = WORKER_MAX_WAIT
+        scheduler_wakeup.wait(delay)
+        scheduler_wakeup.clear()
+
+def start_scheduler_worker(review = None):
+    """
+    Starts the background worker that runs the scheduler (only once)
+    review is called on every run, e.g. to reschedule repeating updates
+    """
+    global scheduler_worker
+    if scheduler_worker is None:
+        scheduler_stop.clear()
+        scheduler_worker = threading.Thread(target = scheduler_loop, args = (review,), \
+                                            name = "scheduler-worker", daemon = True)
+        scheduler_worker.start()
+
+    return scheduler_worker
+
+def stop_scheduler_worker(timeout = None):
+    """
+    Stops the background worker
+    """
+    global scheduler_worker
+    if scheduler_worker is not None:
+        scheduler_stop.set()
+        scheduler_wakeup.set()
+        scheduler_worker.join(timeout)
+        scheduler_worker = None
+
+def calc_absolute_delay_time(update_time, clock = None):
     """
     Calculating sum of time and delay
+    clock is the ScheduleClock to use (a new reading of the clock if None)
     """
-    return time.time() + calculate_delay(update_time, 30)
+    if clock is None:
+        clock = read_clock()
+
+    return clock.absolute_time(update_time, 30)
 
 def add_new_update_scheduled(title, content, update_time, \
-        update_covid_data, update_news, repeat, update_covid_event, update_news_event):
+        update_covid_data, update_news, repeat, update_covid_event, update_news_event, \
+        clock = None):
     """
     Process adds a new schedule event and tracks what needs to be done
     """
-    absolute_delay_time = calc_absolute_delay_time(update_time)
-    new_schedule = {"title": title, "content": content, "update_time": update_time, "update_covid_data": update_covid_data, "update_news": update_news, "repeat": repeat, "update_covid_event": update_covid_event, "update_news_event": update_news_event, "absolute_delay_time": absolute_delay_time}
-    updates_scheduled.append(new_schedule)
+    absolute_delay_time = calc_absolute_delay_time(update_time, clock)
+    new_schedule = ScheduledUpdate(title, content, update_time, update_covid_data, update_news, \
+        repeat, update_covid_event, update_news_event, absolute_delay_time)
+    updates_scheduled.add(new_schedule)
+    if updates_journal is not None:
+        updates_journal.record_add(new_schedule)
+    bump_data_version("update scheduled")
+    scheduler_wakeup.set()
 
 def update_name_in_updates_scheduled(title):
     """
     Checking whether this update name already exists
     If so no new update is created and a warning is outputted into the log
     """
-    item_list = [item for item in updates_scheduled if item['title'] == title]
-    if (len(item_list) ==0):
-        return False
-    else:
+    if title in updates_scheduled:
         log.warning("Item already in list")
         return True
+    else:
+        return False
 
 def remove_item_from_scheduled_updates(title):
     """
     Removes an item from updates_scheduled
     """
-    global updates_scheduled
-    updates_scheduled = [item for item in updates_scheduled if item['title'] != title]
+    if updates_scheduled.remove(title) is not None:
+        if updates_journal is not None:
+            updates_journal.record_remove(title)
+        bump_data_version("scheduled update removed")
+
+def reschedule_update_scheduled(title, update_time, clock = None, **changes):
+    """
+    Moves a repeating update to its next absolute_delay_time
+    Any other changes (e.g. update_covid_event for the new job) are made at the same time
+    """
+    absolute_delay_time = calc_absolute_delay_time(update_time, clock)
+    if updates_scheduled.reschedule(title, absolute_delay_time, **changes) is None:
+        log.warning("Not rescheduling " + title + ", it has been removed")
+        return
+    if updates_journal is not None:
+        updates_journal.record_reschedule(title, absolute_delay_time)
+    bump_data_version("repeat update rescheduled")
+
+def cancel_job(event):
+    """
+    Cancels a job added by schedule_job
+    Returns False if the job has already run or been cancelled
+    """
+    try:
+        scheduler.cancel(event)
+    except ValueError:
+        return False
+
+    return True
 
 def remove_scheduled_job(title):
     """
     Gets the event(s) from updates_scheduled in order to cancel the event (job)
-    Removes the item from the list
+    Removes the item from the store
     """
 
-    global updates_scheduled
-
-    item_list = [item for item in updates_scheduled if item['title'] == title]
-    item_dict = item_list[0]
+    item = updates_scheduled.get(title)
+    if item is None:
+        log.warning("No scheduled update with title " + title)
+        return
 
-    if item_dict["update_covid_data"]:
-        update_covid_event = item_dict["update_covid_event"]
+    if item.update_covid_data:
         try:
-            scheduler.cancel(update_covid_event)
+            scheduler.cancel(item.update_covid_event)
             log.info("Scheduler size: {} ".format(len(scheduler.queue)))
         except ValueError:
             log.warning("Covid update job already completed or not present")
 
-    if item_dict["update_news"]:
-        update_covid_event = item_dict["update_news_event"]
+    if item.update_news:
         try:
-            scheduler.cancel(update_covid_event)
+            scheduler.cancel(item.update_news_event)
             log.info("Scheduler size: {} ".format(len(scheduler.queue)))
         except ValueError:
             log.warning("News update job already completed or no present")
 
     log.info("Update scheduled before, length = {} ".format(len(updates_scheduled)))
-    updates_scheduled = [item for item in updates_scheduled if item['title'] != title]
+    updates_scheduled.remove(title)
+    if updates_journal is not None:
+        updates_journal.record_remove(title)
+    bump_data_version("scheduled update removed")
 
     log.info("Update scheduled now, length = {} ".format(len(updates_scheduled)))
 
 #Refactor
-def calculate_delay(hours_minutes:str, delay_delta_seconds):
+def calculate_delay(hours_minutes:str, delay_delta_seconds, clock = None):
     """
     Calculate the delay for a scheduled event
     hours_minutes in HH:MN format (e.g. 12:30)
     delay_delta_seconds - used to prevent missing a schedule at the same time as hours_minutes
     and when a user schedules updates to both covid data and news
+    clock - the ScheduleClock to use, so a batch of updates shares one reading of the clock
+        (a new reading if None)
     """
 
-    hours_minutes_list = hours_minutes.split(':')
-    hours = int(hours_minutes_list[0])
-    minutes = int (hours_minutes_list[1])
-    seconds = ( ( hours * 60 * 60) + (minutes * 60))
-
-    now = datetime.now()
-    seconds_since_midnight = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
-
-    if seconds > (seconds_since_midnight + delay_delta_seconds):
-        delay = (seconds + delay_delta_seconds) - seconds_since_midnight
-    else:
-        delay = ((24 * 60 * 60) + delay_delta_seconds + seconds) - seconds_since_midnight
+    if clock is None:
+        clock = read_clock()
+    delay = clock.delay(hours_minutes, delay_delta_seconds)
 
     log.info("Delay: {} , hours_minutes: {}".format(delay, hours_minutes))
     return delay
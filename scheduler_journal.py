@@ -0,0 +1,136 @@
+"""
+This module handles:
+    - an append-only journal of the changes to updates_scheduled (add, remove, reschedule)
+    - replaying the journal at startup so scheduled updates survive a restart
+    - compacting the journal so startup time does not grow with its history
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import json
+import os
+import threading
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#Fields of a scheduled update that are saved in the journal
+#(the scheduler events are not saved, they are created again on replay)
+JOURNAL_FIELDS = ("title", "content", "update_time", "update_covid_data", "update_news", \
+                  "repeat", "absolute_delay_time")
+
+class UpdatesJournal:
+    """
+    This class writes one json line per change to updates_scheduled
+    It also keeps the live updates in memory, so compacting only needs to
+        rewrite them (to a temporary file that then replaces the journal)
+    The journal is compacted once compact_after lines have been written since the
+        last compaction and most of the lines are history
+    """
+
+    def __init__(self, path = "updates_journal.jsonl", compact_after = 1000):
+        self.path = path
+        self.compact_after = compact_after
+        self.live = {}
+        self.lines = 0
+        self.lines_since_compaction = 0
+        self.lock = threading.Lock()
+
+    def replay(self):
+        """
+        Reads the journal and returns the live scheduled updates (as dictionaries) in order
+        A partly written last line (from a crash) is ignored
+        """
+        self.live = {}
+        self.lines = 0
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, encoding = 'utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.warning("Ignoring unreadable journal line: " + line.strip())
+                    continue
+                self.apply(record)
+                self.lines += 1
+
+        log.info("Replayed {} journal lines into {} scheduled updates".format(self.lines, \
+                                                                              len(self.live)))
+        return list(self.live.values())
+
+    def apply(self, record):
+        """
+        Applies one journal record to the live updates
+        """
+        operation = record["op"]
+        if operation == "add":
+            self.live[record["title"]] = {field: record.get(field) for field in JOURNAL_FIELDS}
+        elif operation == "remove":
+            self.live.pop(record["title"], None)
+        elif operation == "reschedule" and record["title"] in self.live:
+            self.live[record["title"]]["absolute_delay_time"] = record["absolute_delay_time"]
+
+    def append(self, record):
+        """
+        Writes a record to the end of the journal and flushes it to disk
+        """
+        with self.lock:
+            self.apply(record)
+            with open(self.path, 'a', encoding = 'utf-8') as journal_file:
+                journal_file.write(json.dumps(record) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self.lines += 1
+            self.lines_since_compaction += 1
+
+            if self.lines_since_compaction >= self.compact_after and \
+                    self.lines > 2 * len(self.live):
+                self.compact_locked()
+
+    def record_add(self, entry):
+        """
+        Records a new scheduled update (a ScheduledUpdate)
+        """
+        record = {field: getattr(entry, field) for field in JOURNAL_FIELDS}
+        record["op"] = "add"
+        self.append(record)
+
+    def record_remove(self, title):
+        """
+        Records a scheduled update being removed
+        """
+        self.append({"op": "remove", "title": title})
+
+    def record_reschedule(self, title, absolute_delay_time):
+        """
+        Records a repeating update being rescheduled
+        """
+        self.append({"op": "reschedule", "title": title, \
+                     "absolute_delay_time": absolute_delay_time})
+
+    def compact(self):
+        """
+        Rewrites the journal with one add record per live scheduled update
+        """
+        with self.lock:
+            self.compact_locked()
+
+    def compact_locked(self):
+        """
+        Compacts the journal, the lock must already be held
+        """
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w', encoding = 'utf-8') as journal_file:
+            for record in self.live.values():
+                journal_file.write(json.dumps(dict(record, op = "add")) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary_path, self.path)
+
+        log.info("Compacted journal from {} to {} lines".format(self.lines, len(self.live)))
+        self.lines = len(self.live)
+        self.lines_since_compaction = 0
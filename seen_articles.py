@@ -0,0 +1,254 @@
+"""
+This module handles:
+    - remembering the titles of news articles marked as "seen" in a fixed amount of memory
+    - saving the seen titles to disk so dismissed headlines stay hidden after a restart
+        (in the background, at most once every save_delay seconds)
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import hashlib
+import json
+import atexit
+import math
+import os
+import threading
+from collections import OrderedDict
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+#Default settings, used for anything missing from the "seen_articles" section of the config file
+DEFAULT_SEEN_ARTICLES_SETTINGS = {"path": "seen_articles.bin", "capacity": 100_000, \
+                                  "error_rate": 0.001, "recent_size": 1000, "save_delay": 5.0}
+
+class BloomFilter:
+    """
+    This class is a Bloom filter sized for capacity items at error_rate false positives
+    It can say an item was added when it was not (a false positive) but never the opposite
+    """
+
+    def __init__(self, capacity, error_rate, bits = None, count = 0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+
+    def positions(self, item):
+        """
+        Returns the bit positions for an item (double hashing of a blake2b digest)
+        """
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size = 16).digest()
+        first_hash = int.from_bytes(digest[:8], "little")
+        second_hash = int.from_bytes(digest[8:], "little") | 1
+
+        return [(first_hash + index * second_hash) % self.size for index in range(self.hash_count)]
+
+    def add(self, item):
+        """
+        Adds an item to the filter
+        """
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) \
+                   for position in self.positions(item))
+
+    def is_full(self):
+        """
+        Returns True once capacity items have been added
+        """
+        return self.count >= self.capacity
+
+class SeenArticles:
+    """
+    This class holds the seen titles in a fixed amount of memory:
+    - an exact least recently used (LRU) dictionary of the recent_size most recent titles
+    - two Bloom filters: titles are added to the current one, and once it holds
+        capacity titles it becomes the previous one and a new current one is started
+    So memory never goes above two filters and the LRU, the false positive rate stays
+        at most about 2 * error_rate, and only titles two filters old are forgotten
+    """
+
+    def __init__(self, capacity = 100_000, error_rate = 0.001, recent_size = 1000, path = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.recent_size = recent_size
+        self.path = path
+        self.recent = OrderedDict()
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+
+    def add(self, title):
+        """
+        Marks a title as seen
+        """
+        self.recent[title] = True
+        self.recent.move_to_end(title)
+        while len(self.recent) > self.recent_size:
+            self.recent.popitem(last = False)
+
+        if title not in self.current:
+            if self.current.is_full():
+                log.info("Seen articles filter is full, starting a new one")
+                self.previous = self.current
+                self.current = BloomFilter(self.capacity, self.error_rate)
+            self.current.add(title)
+
+    def update(self, titles):
+        """
+        Marks several titles as seen
+        """
+        for title in titles:
+            self.add(title)
+
+    def __contains__(self, title):
+        if title in self.recent:
+            return True
+
+        return title in self.current or (self.previous is not None and title in self.previous)
+
+    def memory_bytes(self):
+        """
+        Returns the largest number of bytes the filters can use
+        """
+        return 2 * len(self.current.bits)
+
+    def to_bytes(self):
+        """
+        Returns the contents of the file the seen titles are saved in:
+            a json header line followed by the bits of the filters
+        """
+        header = {"capacity": self.capacity, "error_rate": self.error_rate, \
+                  "recent_size": self.recent_size, "recent": list(self.recent), \
+                  "current_count": self.current.count, \
+                  "previous_count": None if self.previous is None else self.previous.count}
+        previous_bits = b"" if self.previous is None else self.previous.bits
+
+        return json.dumps(header).encode("utf-8") + b"\n" + self.current.bits + previous_bits
+
+    def save(self, path = None, data = None):
+        """
+        Saves the seen titles to a file (written to a temporary file that replaces the old one)
+        data is the contents from to_bytes (taken now if None), so the seen titles can be
+            copied while no change is being made and written to the file afterwards
+        The temporary file is flushed to disk before it replaces the old one, so a crash
+            never leaves an empty or partly written file
+        """
+        path = path or self.path
+        if data is None:
+            data = self.to_bytes()
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'wb') as seen_file:
+            seen_file.write(data)
+            seen_file.flush()
+            os.fsync(seen_file.fileno())
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, capacity = 100_000, error_rate = 0.001, recent_size = 1000):
+        """
+        Loads the seen titles saved at path, or starts empty if there is no file
+        A saved file keeps the capacity and error rate it was created with
+        A file that cannot be read (e.g. empty or cut short) is logged and the seen titles
+            start empty, so the dashboard still starts
+        """
+        if not os.path.exists(path):
+            return cls(capacity, error_rate, recent_size, path = path)
+
+        try:
+            with open(path, 'rb') as seen_file:
+                header = json.loads(seen_file.readline())
+                bits = seen_file.read()
+
+            seen_articles = cls(header["capacity"], header["error_rate"], header["recent_size"], \
+                                path = path)
+            size = len(seen_articles.current.bits)
+            filter_count = 1 if header["previous_count"] is None else 2
+            if len(bits) != filter_count * size:
+                raise ValueError("expected {} bytes of filters, found {}".format( \
+                    filter_count * size, len(bits)))
+            seen_articles.current = BloomFilter(header["capacity"], header["error_rate"], \
+                                                bytearray(bits[:size]), header["current_count"])
+            if header["previous_count"] is not None:
+                seen_articles.previous = BloomFilter(header["capacity"], header["error_rate"], \
+                    bytearray(bits[size:2 * size]), header["previous_count"])
+            for title in header["recent"]:
+                seen_articles.recent[title] = True
+        except (OSError, ValueError, KeyError, TypeError):
+            log.exception("Could not load seen articles from " + path + ", starting empty")
+            return cls(capacity, error_rate, recent_size, path = path)
+        log.info("Loaded seen articles from " + path)
+
+        return seen_articles
+
+class DelayedSave:
+    """
+    This class calls save in a background thread at most once every delay seconds,
+        however often request_save is called, so dismissing several news articles
+        writes the seen titles file once
+    Anything still waiting is saved when the program exits
+    """
+
+    def __init__(self, save, delay = 5.0):
+        self.save = save
+        self.delay = delay
+        self.timer = None
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def request_save(self):
+        """
+        Saves in delay seconds, unless a save is already waiting
+        """
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = threading.Timer(self.delay, self.run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def run(self):
+        """
+        Saves (one save at a time), logging a save that fails
+        """
+        with self.lock:
+            self.timer = None
+        with self.save_lock:
+            try:
+                self.save()
+            except OSError:
+                log.exception("Could not save the seen news articles")
+
+    def flush(self):
+        """
+        Saves straight away if a save is waiting
+        """
+        with self.lock:
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+            self.run()
+
+def seen_articles_settings(settings):
+    """
+    Returns the "seen_articles" section of the config file with the defaults for anything missing
+    """
+    return dict(DEFAULT_SEEN_ARTICLES_SETTINGS, **settings)
+
+def load_seen_articles(settings):
+    """
+    Loads the seen titles described by the "seen_articles" section of the config file
+    """
+    settings = seen_articles_settings(settings)
+
+    return SeenArticles.load(settings["path"], settings["capacity"], settings["error_rate"], \
+                             settings["recent_size"])
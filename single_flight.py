@@ -0,0 +1,59 @@
+"""
+This module handles coalescing duplicate calls (single flight): calls with the same key
+    that overlap, or are due within a window of each other, share one call and its result
+This is used so several scheduled updates firing at the same time make one covid data
+    or news fetch instead of one each
+"""
+
+#Importing modules
+import threading
+from concurrent.futures import Future
+
+class Flight:
+    """
+    This class holds one call: the time it was due and the future of its result
+    """
+
+    def __init__(self, due_time):
+        self.due_time = due_time
+        self.future = Future()
+
+class SingleFlight:
+    """
+    This class runs calls by key, so that a call with the same key as another that is
+        still running, or that was due within window seconds of it, shares its result
+        instead of being made again
+    A call that fails is not shared with later calls, so they try again
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "coalesced": 0}
+
+    def run(self, key, function, due_time, window = 0.0):
+        """
+        Calls function() unless a call with the same key is running or was due within
+            window seconds of due_time (with a window of None, only a running call is shared)
+        Returns (future of the result, True if function was called by this run)
+        The future of a shared call may still be running, call result() to wait for it
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and (not flight.future.done() or (window is not None and \
+                                       abs(due_time - flight.due_time) <= window)):
+                self.counters["coalesced"] += 1
+                return flight.future, False
+            flight = Flight(due_time)
+            self.flights[key] = flight
+            self.counters["calls"] += 1
+
+        try:
+            flight.future.set_result(function())
+        except BaseException as error:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.future.set_exception(error)
+
+        return flight.future, True
@@ -0,0 +1,85 @@
+"""
+This module handles:
+    - holding the shared dashboard state (covid data, news articles and scheduled updates)
+        as immutable snapshots that are replaced, never changed (copy-on-write)
+    - freezing dictionaries and lists into read-only copies (FrozenDict and tuples)
+Readers take the current snapshot without a lock and can use it for as long as they like,
+    writers take a lock, build the next snapshot from a copy and swap it in with
+    one assignment, so a reader sees either the old or the new state and never half of it
+"""
+
+#Importing modules
+import threading
+from collections.abc import Mapping
+
+class CopyOnWriteState:
+    """
+    This class holds one immutable snapshot of some state
+    snapshot() never blocks, update() and replace() are run one at a time
+    """
+
+    def __init__(self, snapshot):
+        self.current = snapshot
+        self.write_lock = threading.Lock()
+
+    def snapshot(self):
+        """
+        Returns the current snapshot (which must not be changed)
+        """
+        return self.current
+
+    def update(self, change):
+        """
+        Calls change(snapshot), which returns the next snapshot, and publishes it
+        Writers are run one at a time, so change always gets the latest snapshot
+        Returns the new snapshot
+        """
+        with self.write_lock:
+            self.current = change(self.current)
+
+            return self.current
+
+    def replace(self, snapshot):
+        """
+        Publishes a new snapshot
+        """
+        with self.write_lock:
+            self.current = snapshot
+
+class FrozenDict(dict):
+    """
+    This class is a dictionary which cannot be changed after it is made, so a snapshot
+        can still be passed to code (and templates) expecting a dict
+    """
+
+    def read_only(self, *args, **kwargs):
+        raise TypeError("FrozenDict cannot be changed, publish a new snapshot instead")
+
+    __setitem__ = __delitem__ = __ior__ = read_only
+    clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+def freeze(value):
+    """
+    Returns a read-only copy of a value: dictionaries become FrozenDicts (keeping
+        their order) and lists become tuples, all the way down
+    """
+    if isinstance(value, Mapping):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+
+    return value
+
+def thaw(value):
+    """
+    Returns a plain copy of a frozen value (e.g. so it can be serialized to json)
+    """
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+
+    return value
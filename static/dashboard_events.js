@@ -0,0 +1,136 @@
+// Keeps the dashboard up to date with the changes pushed by /events (server-sent events)
+// Only the figures, news articles and scheduled updates that changed are updated,
+// so the page is not requested again every 60 seconds
+(function () {
+    if (!window.EventSource) {
+        // Browsers without server-sent events refresh the page as before
+        setTimeout(function () { window.location = "/index"; }, 60000);
+        return;
+    }
+
+    var source = new EventSource("/events?since=" + document.body.getAttribute("data-version"));
+
+    // Returns the items that changed in a section of an event (all of them for a full update)
+    function changedItems(message, section) {
+        if (message.full) {
+            return message.data[section] || {};
+        }
+        return message.changed[section] || {};
+    }
+
+    // Returns the keys removed from a section of an event
+    // (for a full update, the keys shown on the page that are no longer present)
+    function removedKeys(message, section, shownKeys) {
+        if (message.full) {
+            var items = message.data[section] || {};
+            return shownKeys.filter(function (key) { return !(key in items); });
+        }
+        return message.removed[section] || [];
+    }
+
+    function findToast(container, title) {
+        return container.querySelector('.toast[data-title="' + CSS.escape(title) + '"]');
+    }
+
+    // Builds a toast like the ones in index.html, with a close button sending name=title
+    function makeToast(title, content, name) {
+        var toast = document.createElement("div");
+        toast.className = "toast";
+        toast.setAttribute("data-autohide", "false");
+        toast.setAttribute("data-title", title);
+
+        var header = document.createElement("div");
+        header.className = "toast-header";
+        var strong = document.createElement("strong");
+        strong.className = "mr-auto";
+        strong.textContent = title;
+        var form = document.createElement("form");
+        form.action = "/index";
+        form.method = "get";
+        var button = document.createElement("button");
+        button.type = "submit";
+        button.className = "ml-2 mb-1 close";
+        button.setAttribute("data-dismiss", "toast");
+        button.setAttribute("aria-label", "Close");
+        button.name = name;
+        button.value = title;
+        button.innerHTML = '<span aria-hidden="true">&times;</span>';
+        form.appendChild(button);
+        header.appendChild(strong);
+        header.appendChild(form);
+
+        var body = document.createElement("div");
+        body.className = "toast-body";
+        body.textContent = content || "";
+
+        toast.appendChild(header);
+        toast.appendChild(body);
+        return toast;
+    }
+
+    // Applies the changes to a list of toasts (news articles or scheduled updates)
+    function updateToasts(containerId, message, section, name) {
+        var container = document.getElementById(containerId);
+        if (!container) {
+            return;
+        }
+        var shown = Array.prototype.map.call(container.querySelectorAll(".toast"),
+            function (toast) { return toast.getAttribute("data-title"); });
+
+        removedKeys(message, section, shown).forEach(function (title) {
+            var toast = findToast(container, title);
+            if (toast) {
+                toast.parentNode.removeChild(toast);
+            }
+        });
+
+        var items = changedItems(message, section);
+        Object.keys(items).forEach(function (title) {
+            var toast = findToast(container, title);
+            if (toast) {
+                toast.querySelector(".toast-body").textContent = items[title].content || "";
+            } else {
+                toast = makeToast(title, items[title].content, name);
+                container.appendChild(toast);
+                if (window.jQuery) {
+                    window.jQuery(toast).toast("show");
+                } else {
+                    toast.classList.add("show");
+                }
+            }
+        });
+    }
+
+    source.addEventListener("covid", function (event) {
+        var message = JSON.parse(event.data);
+        var dashboard = changedItems(message, "dashboard");
+        Object.keys(dashboard).forEach(function (key) {
+            var element = document.getElementById(key);
+            if (element) {
+                element.textContent = dashboard[key];
+            }
+        });
+
+        var areas = changedItems(message, "areas");
+        Object.keys(areas).forEach(function (areaName) {
+            var row = document.querySelector('tr[data-area="' + CSS.escape(areaName) + '"]');
+            if (!row) {
+                return;
+            }
+            Object.keys(areas[areaName]).forEach(function (field) {
+                var cell = row.querySelector('[data-field="' + field + '"]');
+                if (cell) {
+                    cell.textContent = areas[areaName][field];
+                }
+            });
+        });
+    });
+
+    source.addEventListener("news", function (event) {
+        updateToasts("news-articles", JSON.parse(event.data), "articles", "notif");
+    });
+
+    source.addEventListener("schedule", function (event) {
+        updateToasts("scheduled-updates", JSON.parse(event.data), "updates", "update_item");
+    });
+}());
@@ -0,0 +1,133 @@
+"""
+This module handles offline stand-ins for the covid and news APIs, used by the
+    benchmarks (and tests) so they run without a network connection or an API key:
+    - FakeCov19API, answering Cov19API requests from a recorded response
+    - FakeNewsClient, answering news API requests from a recorded response
+    - offline_upstreams, which points the dashboard at both for the length of a with block
+The recorded responses are in the fixtures directory:
+    - cov19api_nation_england.json, the Cov19API json for England on 2021-10-28
+        (the same figures as nation_2021-10-28.csv)
+    - newsapi_top_headlines.json, a news API top-headlines response
+"""
+
+#Importing modules
+import json
+import os
+import threading
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+#importing the modules whose upstream requests are replaced
+import covid_data_handler
+import covid_news_handling
+from covid_area_store import CovidAreaStore
+from covid_cache import CovidCache, MemoryCacheBackend
+from http_client import RateLimiter
+
+#Directory holding the recorded API responses
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def load_fixture(filename):
+    """
+    Returns the json of a recorded API response in the fixtures directory
+    """
+    with open(os.path.join(FIXTURES_DIRECTORY, filename), encoding = 'utf-8') as fixture:
+        return json.load(fixture)
+
+class UpstreamCalls:
+    """
+    This class counts the requests made to the fake APIs (safe to use from several threads)
+    """
+
+    def __init__(self):
+        self.covid = []
+        self.news = []
+        self.lock = threading.Lock()
+
+    def record(self, requests, request):
+        with self.lock:
+            requests.append(request)
+
+    def counts(self):
+        """
+        Returns the number of covid and news API requests made so far
+        """
+        with self.lock:
+            return {"covid": len(self.covid), "news": len(self.news)}
+
+def fake_cov19api(calls, fixture = "cov19api_nation_england.json", area_names = None):
+    """
+    Returns a class used in place of Cov19API, which answers from a recorded response
+    The recorded rows are returned under the areaName and areaType requested
+        (for each of area_names when only an areaType is given) and a date filter
+        returns only the rows for that date
+    Every request is recorded in calls.covid
+    """
+    recorded_rows = load_fixture(fixture)["data"]
+
+    class FakeCov19API:
+        """
+        This class answers Cov19API requests from the recorded response
+        """
+
+        def __init__(self, filters, structure, latest_by = None):
+            self.filters = dict(api_filter.split("=", 1) for api_filter in filters)
+            self.structure = structure
+
+        def get_json(self):
+            calls.record(calls.covid, self.filters)
+            area_type = self.filters.get("areaType", "nation")
+            names = [self.filters["areaName"]] if "areaName" in self.filters \
+                else area_names or [recorded_rows[0]["areaName"]]
+            date = self.filters.get("date")
+
+            rows = [dict(row, areaName = area_name, areaType = area_type) \
+                    for area_name in names for row in recorded_rows \
+                    if date is None or row["date"] == date]
+
+            return {"data": rows, "lastUpdate": recorded_rows[0]["date"], \
+                    "length": len(rows), "totalPages": 1}
+
+    return FakeCov19API
+
+class FakeNewsClient:
+    """
+    This class is used in place of the news API client (see http_client.ConditionalGetClient)
+    Every request is answered with the recorded response and recorded in calls.news
+    """
+
+    def __init__(self, calls, fixture = "newsapi_top_headlines.json"):
+        self.calls = calls
+        self.response = load_fixture(fixture)
+
+    def get_json(self, url, params = None):
+        query = parse_qs(urlparse(url).query)
+        self.calls.record(self.calls.news, {"q": query.get("q", [""])[0], \
+                                            "country": query.get("country", [""])[0]})
+
+        return self.response
+
+@contextmanager
+def offline_upstreams(area_names = None):
+    """
+    Points the dashboard at the fake covid and news APIs for the length of a with block
+    The covid cache, the stored covid areas and the news rate limiter are replaced as well,
+        so every request reaches the fakes straight away
+    Yields the UpstreamCalls counting the requests made
+    """
+    calls = UpstreamCalls()
+    saved = (covid_data_handler.Cov19API, covid_data_handler.covid_cache, \
+             covid_data_handler.covid_area_store, covid_news_handling.news_client, \
+             covid_news_handling.news_rate_limiter)
+
+    covid_data_handler.Cov19API = fake_cov19api(calls, area_names = area_names)
+    covid_data_handler.covid_cache = CovidCache(MemoryCacheBackend(), ttl = 0, stale_ttl = 0)
+    covid_data_handler.covid_area_store = CovidAreaStore()
+    covid_news_handling.news_client = FakeNewsClient(calls)
+    covid_news_handling.news_rate_limiter = RateLimiter(rate = 1e9, burst = 1e9)
+    try:
+        yield calls
+    finally:
+        covid_data_handler.Cov19API, covid_data_handler.covid_cache, \
+            covid_data_handler.covid_area_store, covid_news_handling.news_client, \
+            covid_news_handling.news_rate_limiter = saved
@@ -0,0 +1,91 @@
+"""
+This module is the production entry point of the dashboard, for a WSGI server e.g.
+
+    gunicorn --workers 1 --threads 16 --bind 127.0.0.1:5000 wsgi:app
+
+The covid data, news articles and scheduled updates are kept in the dashboard process
+    (and the scheduler worker runs in it), so the dashboard is run as one process serving
+    requests on many threads. A lock file makes sure a second process (e.g. a second
+    gunicorn worker) stops straight away instead of running a second scheduler
+    with its own copy of the data
+Each /events stream holds a thread, so the streams are limited to fewer than the threads
+    (max_streams in the "events" section of the config file)
+The stream limit is kept in the process, as it guards that process's threads: it is not
+    shared between processes, which is why the dashboard must run as a single process
+    (--workers 1). A second worker does not start, and says so on stderr as well as in the log
+
+It can also be run directly (python wsgi.py) to serve on a threaded Werkzeug server
+"""
+
+#importing modules for logging
+import logging
+
+#Importing modules
+import os
+import sys
+
+#fcntl is not available on Windows, where the lock file is not used
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#Importing the shared configuration
+from config_handler import get_config
+
+#Importing the logging pipeline, set up before the lock is taken
+from dashboard_logging import configure_logging
+
+#Setting up logging (configured once at startup, see dashboard_logging.py)
+log = logging.getLogger(__name__)
+
+def acquire_process_lock(path):
+    """
+    Takes an exclusive lock on the lock file, which is held until the process exits
+    Raises RuntimeError if another dashboard process already holds it
+    Returns the open lock file (None if locking is not available)
+    """
+    if fcntl is None:
+        log.warning("File locking is not available, not checking for other dashboard processes")
+        return None
+
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise RuntimeError("Another dashboard process holds " + path + ", run one process " \
+                           "with several threads (e.g. gunicorn --workers 1 --threads 16)")
+
+    lock_file.truncate(0)
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    log.info("Dashboard process lock " + path + " taken by process " + str(os.getpid()))
+
+    return lock_file
+
+configure_logging()
+
+#Taking the lock before main is imported, as importing main starts the scheduler worker
+#(the error is also written to stderr, as the log may only go to the log file)
+try:
+    process_lock = acquire_process_lock(get_config().get("process_lock", "dashboard.lock"))
+except RuntimeError as error:
+    log.error(str(error))
+    print("Dashboard not started: " + str(error), file = sys.stderr)
+    raise
+
+#Importing the flask application (this restores updates_scheduled and starts the scheduler)
+from main import app
+
+#the name some WSGI servers look for
+application = app
+
+if __name__ == '__main__':
+    """
+    Serving the dashboard on a threaded Werkzeug server
+    """
+    from werkzeug.serving import run_simple
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    run_simple("127.0.0.1", port, app, threaded = True)